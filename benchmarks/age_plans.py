@@ -0,0 +1,132 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from typing import Dict, List
+
+from dotenv import dotenv_values
+
+from benchmarks.generate import generate
+from benchmarks.run import RESULTS_PATH, SCHEMA_SQL, admin_execute
+from config.config import BATCH_SIZE
+from main import ROOM_COLUMNS, STUDENT_COLUMNS
+from modules.Database import Database
+from modules.IndexAdvisor import explain
+from modules.JSONFile import JSONFile
+from modules.Reports import REPORTS, install_schema, render_reports
+
+
+logger = logging.getLogger('age_plans')
+
+# age reports of sql-task.sql before the birth_ymd revision, with the index idx_student_birthday it proposed
+LEGACY_INDEXES = """
+    CREATE INDEX IF NOT EXISTS idx_student_birthday ON public.student(birthday);
+    CREATE INDEX IF NOT EXISTS idx_student_room ON public.student(room);
+    """
+LEGACY_REPORTS = {
+    "query2": """
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        COUNT(public.student.id) AS students_quantity,
+        AVG(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER AS average_age
+        FROM public.room
+            INNER JOIN public.student
+            ON public.room.id = public.student.room
+        GROUP BY public.room.id
+        ORDER BY average_age ASC
+        LIMIT 5
+        """,
+    "query3": """
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        COUNT(public.student.id) AS students_quantity,
+        MAX(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER -
+        MIN(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER AS stud_age_diff
+        FROM public.room
+            INNER JOIN public.student
+            ON public.room.id = public.student.room
+        GROUP BY public.room.id
+        ORDER BY stud_age_diff DESC, students_quantity ASC
+        LIMIT 5
+        """,
+}
+
+
+def _node_types(plan: dict) -> List[str]:
+    """Node types of the plan tree in depth-first order, scans with their relation.
+
+    :param plan: Plan node
+    :type plan: dict
+    :rtype: List[str]
+    """
+    node = plan["Node Type"] + (f" on {plan['Relation Name']}" if "Relation Name" in plan else "")
+    return [node] + [child for sub_plan in plan.get("Plans", []) for child in _node_types(sub_plan)]
+
+
+def measure(database: Database, queries: Dict[str, str], runs: int) -> Dict[str, dict]:
+    """Plan shape and average execution time of every query.
+
+    :param database: Database connection
+    :type database: Database
+    :param queries: Query names mapped to SQL
+    :type queries: Dict[str, str]
+    :param runs: Number of timed runs
+    :type runs: int
+    :rtype: Dict[str, dict]
+    """
+    results = {}
+    for name, query in queries.items():
+        outputs = [explain(database, query) for _ in range(runs)]
+        database.rollback()
+        results[name] = {"plan": _node_types(outputs[-1]["Plan"]),
+                         "execution_ms": round(sum(output["Execution Time"] for output in outputs) / runs, 3)}
+        logging.info(f"-- {name}: {results[name]['execution_ms']} ms, {' > '.join(results[name]['plan'])}")
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Plans and latency of the age reports before and after \
+                                                 the birth_ymd column and covering index \
+                                                 --example python -m benchmarks.age_plans 1000000")
+    parser.add_argument("students", type=int, help="Number of students")
+    parser.add_argument("--runs", type=int, default=5, help="Number of timed runs per query")
+
+    args = parser.parse_args()
+
+    env = dotenv_values(".env")
+    bench_config = dict(env, DB_DATABASE=f"{env['DB_DATABASE']}_age_{args.students}")
+    admin_execute(env, f"DROP DATABASE IF EXISTS {bench_config['DB_DATABASE']}")
+    admin_execute(env, f"CREATE DATABASE {bench_config['DB_DATABASE']}")
+    database = Database(bench_config)
+    database.connect(raise_error=True)
+    try:
+        with tempfile.TemporaryDirectory() as work_folder:
+            students_file = os.path.join(work_folder, "students.json")
+            rooms_file = os.path.join(work_folder, "rooms.json")
+            generate(students_file, rooms_file, args.students)
+            database.execute_query(SCHEMA_SQL + LEGACY_INDEXES)
+            database.bulk_load("room", ROOM_COLUMNS, JSONFile.iter_records(rooms_file), BATCH_SIZE)
+            database.bulk_load("student", STUDENT_COLUMNS, JSONFile.iter_records(students_file), BATCH_SIZE)
+            database.commit()
+        database.execute_maintenance("VACUUM ANALYZE")
+        before = measure(database, LEGACY_REPORTS, args.runs)
+
+        install_schema(database)
+        database.commit()
+        database.execute_maintenance("VACUUM ANALYZE")
+        revised = render_reports(database, {name: REPORTS[name] for name in LEGACY_REPORTS}, {})
+        after = measure(database, revised, args.runs)
+    finally:
+        database.close()
+        admin_execute(env, f"DROP DATABASE IF EXISTS {bench_config['DB_DATABASE']}")
+
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    filename = os.path.join(RESULTS_PATH, f"age_plans_{datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    with open(filename, "w") as f:
+        json.dump({"students": args.students, "before": before, "after": after,
+                   "speedup": {name: round(before[name]["execution_ms"] / max(after[name]["execution_ms"], 1e-6), 2)
+                               for name in before}}, f, indent=4)
+    logging.info(f"-- Age plan report saved into {filename}")
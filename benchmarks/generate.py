@@ -0,0 +1,104 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+from datetime import date, timedelta
+
+
+logger = logging.getLogger('generate')
+
+FIRST_NAMES = ("Aaron", "Alice", "Anna", "Brian", "Carol", "Christian", "Diana", "Edward", "Emma", "Frank",
+               "Grace", "Henry", "Irene", "Jack", "Julia", "Juan", "Kevin", "Laura", "Mark", "Nina",
+               "Oscar", "Peggy", "Paul", "Rachel", "Steven", "Tina", "Victor", "Wendy")
+LAST_NAMES = ("Adams", "Baker", "Bush", "Clark", "Davis", "Evans", "Ford", "Garcia", "Hill", "Jones",
+              "King", "Lee", "Lopez", "Miller", "Moore", "Nelson", "Perez", "Ryan", "Scott", "Smith",
+              "Taylor", "White", "Young")
+
+# birthdays are spread uniformly over the same range as in Source/students.json
+FIRST_BIRTHDAY = date(1903, 1, 1)
+LAST_BIRTHDAY = date(2019, 12, 31)
+
+
+def _room_name(number: int) -> str:
+    """Room name in the format of Source/rooms.json, shortened to fit room.name VARCHAR(10).
+
+    :param number: Room id
+    :type number: int
+    :rtype: str
+    """
+    name = f"Room #{number}"
+    return name if len(name) <= 10 else f"#{number}"
+
+
+def _write_array(filename: str, records) -> None:
+    """Write records as a JSON array, one record per line, without building the list in memory.
+
+    :param filename: Name of the output file
+    :type filename: str
+    :param records: Iterable of dicts
+    :rtype: None
+    """
+    with open(filename, "w") as f:
+        f.write("[")
+        separator = "\n"
+        for record in records:
+            f.write(separator + "    " + json.dumps(record, sort_keys=True))
+            separator = ",\n"
+        f.write("\n]\n")
+
+
+def generate(students_file: str, rooms_file: str, students: int, occupancy: float = 10.0,
+             female_ratio: float = 0.5, seed: int = 42) -> int:
+    """Generate deterministic students / rooms files in the format of the Source folder.
+
+    The same arguments always produce byte-identical files.
+
+    :param students_file: Name of the students file
+    :type students_file: str
+    :param rooms_file: Name of the rooms file
+    :type rooms_file: str
+    :param students: Number of students
+    :type students: int
+    :param occupancy: Average number of students per room
+    :type occupancy: float
+    :param female_ratio: Share of students with sex F
+    :type female_ratio: float
+    :param seed: Seed of the random generator
+    :type seed: int
+    :return: Number of generated rooms
+    :rtype: int
+    """
+    rooms = max(1, math.ceil(students / occupancy))
+    generator = random.Random(seed)
+    days = (LAST_BIRTHDAY - FIRST_BIRTHDAY).days
+
+    _write_array(rooms_file, ({"id": number, "name": _room_name(number)} for number in range(rooms)))
+    _write_array(students_file, (
+        {"birthday": (FIRST_BIRTHDAY + timedelta(days=generator.randrange(days + 1))).strftime("%Y-%m-%dT%H:%M:%S.%f"),
+         "id": number,
+         "name": f"{generator.choice(FIRST_NAMES)} {generator.choice(LAST_NAMES)}",
+         "room": generator.randrange(rooms),
+         "sex": "F" if generator.random() < female_ratio else "M"}
+        for number in range(students)))
+
+    logging.info(f"-- Generated {students} students in {rooms} rooms: {students_file}, {rooms_file}")
+    return rooms
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Synthetic dormitory data generator \
+                                                 --example python -m benchmarks.generate 1000000 data/")
+    parser.add_argument("students", type=int, help="Number of students (10^3 .. 10^7)")
+    parser.add_argument("folder", type=str, help="Output folder for students.json and rooms.json")
+    parser.add_argument("--occupancy", type=float, default=10.0, help="Average number of students per room")
+    parser.add_argument("--female-ratio", type=float, default=0.5, help="Share of students with sex F")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random generator")
+
+    args = parser.parse_args()
+
+    os.makedirs(args.folder, exist_ok=True)
+    generate(os.path.join(args.folder, "students.json"), os.path.join(args.folder, "rooms.json"),
+             args.students, args.occupancy, args.female_ratio, args.seed)
@@ -0,0 +1,173 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List
+
+from dotenv import dotenv_values
+from psycopg2 import Error
+
+from benchmarks.generate import generate
+from config.config import BATCH_SIZE
+from main import ROOM_COLUMNS, STUDENT_COLUMNS
+from modules.Database import SCHEMA_SQL, Database, admin_execute
+from modules.JSONFile import JSONFile
+from modules.Metrics import Metrics, counted
+from modules.ParallelLoader import ParallelLoader
+from modules.Query import export_rows
+from modules.Reports import REPORTS, install_schema
+
+
+logger = logging.getLogger('benchmark')
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class Benchmark:
+    """Class for timing every phase of a run on a throwaway database, phases are recorded with Metrics"""
+
+    def __init__(self) -> None:
+        """Initialize the Benchmark object.
+
+        :rtype: None
+        """
+        self.metrics = Metrics()
+
+    def run(self, config: dict, students: int, occupancy: float, female_ratio: float, seed: int,
+            work_path: str, workers: int = 4) -> Dict[str, Any]:
+        """Generate data of the given scale, load it into a fresh database and time every phase.
+
+        :param config: Configuration for the database connection (DB_DATABASE is replaced)
+        :type config: dict
+        :param students: Number of students
+        :type students: int
+        :param occupancy: Average number of students per room
+        :type occupancy: float
+        :param female_ratio: Share of students with sex F
+        :type female_ratio: float
+        :param seed: Seed of the generator
+        :type seed: int
+        :param work_path: Folder for generated files and exports
+        :type work_path: str
+        :param workers: Number of workers of the parallel load phase, 1 - serial load only
+        :type workers: int
+        :return: Run report of the phases, see Metrics.report
+        :rtype: Dict[str, Any]
+        """
+        students_file = os.path.join(work_path, "students.json")
+        rooms_file = os.path.join(work_path, "rooms.json")
+        with self.metrics.phase("generate") as phase:
+            rooms = generate(students_file, rooms_file, students, occupancy, female_ratio, seed)
+            phase.rows = students + rooms
+
+        with self.metrics.phase("json_parse") as phase:
+            phase.rows = sum(1 for _ in JSONFile.iter_records(rooms_file))
+            phase.rows += sum(1 for _ in JSONFile.iter_records(students_file))
+
+        bench_config = dict(config, DB_DATABASE=f"{config['DB_DATABASE']}_bench_{students}")
+        admin_execute(config, f"DROP DATABASE IF EXISTS {bench_config['DB_DATABASE']}")
+        admin_execute(config, f"CREATE DATABASE {bench_config['DB_DATABASE']}")
+        database = Database(bench_config)
+        database.connect(raise_error=True)
+        try:
+            database.execute_query(SCHEMA_SQL)
+            database.commit()
+
+            with self.metrics.phase("load", workers=1) as phase:
+                phase.rows = database.bulk_load("room", ROOM_COLUMNS, JSONFile.iter_records(rooms_file), BATCH_SIZE)
+                phase.rows += database.bulk_load("student", STUDENT_COLUMNS, JSONFile.iter_records(students_file),
+                                                 BATCH_SIZE)
+                database.commit()
+
+            # the same files again over parallel connections, committed with two-phase commit
+            loader = ParallelLoader(database, workers) if workers > 1 else None
+            try:
+                if loader is not None:
+                    loader.check()
+            except Error as e:
+                logging.info(f"-- Parallel load phase skipped: {e}")
+                loader = None
+            database.rollback()
+            if loader is not None:
+                database.execute_query("TRUNCATE student, room")
+                database.commit()
+                with self.metrics.phase("load", workers=workers) as phase:
+                    loaded = loader.load([("room", ROOM_COLUMNS, JSONFile.iter_records(rooms_file), "id"),
+                                          ("student", STUDENT_COLUMNS, JSONFile.iter_records(students_file), "room")],
+                                         BATCH_SIZE)
+                    phase.rows = sum(loaded.values())
+
+            with self.metrics.phase("install_schema"):
+                install_schema(database)
+                database.commit()
+
+            with self.metrics.phase("vacuum_analyze"):
+                database.execute_maintenance("VACUUM ANALYZE")
+
+            for name, report in REPORTS.items():
+                with self.metrics.phase("query", report=name) as phase:
+                    _, rows = report.stream(database, report.bind())
+                    phase.rows = sum(1 for _ in rows)
+
+            for file_format in ("json", "xml"):
+                for name, report in REPORTS.items():
+                    filename = os.path.join(work_path, f"{name}_result")
+                    with self.metrics.phase("export", report=name, format=file_format) as phase:
+                        column_names, rows = report.stream(database, report.bind())
+                        export_rows(column_names, counted(rows, phase), filename, file_format)
+                        phase.bytes = os.path.getsize(f"{filename}.{file_format}")
+            database.rollback()
+        finally:
+            database.close()
+            admin_execute(config, f"DROP DATABASE IF EXISTS {bench_config['DB_DATABASE']}")
+        return self.metrics.report()
+
+
+def save_report(scales: List[int], results: Dict[int, Dict[str, Any]], arguments: dict) -> str:
+    """Save benchmark results as a machine-readable JSON report.
+
+    :param scales: Benchmarked numbers of students
+    :type scales: List[int]
+    :param results: Run report of the phases per scale
+    :type results: Dict[int, Dict[str, Any]]
+    :param arguments: Generator arguments
+    :type arguments: dict
+    :return: Name of the report file
+    :rtype: str
+    """
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    filename = os.path.join(RESULTS_PATH, f"bench_{timestamp}.json")
+    report = {"timestamp": timestamp, "python": platform.python_version(), "platform": platform.platform(),
+              "arguments": arguments, "scales": {str(scale): results[scale] for scale in scales}}
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=4)
+    logging.info(f"-- Benchmark report saved into {filename}")
+    return filename
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of load and report phases on a throwaway database \
+                                                 --example python -m benchmarks.run --scales 1000 100000")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Numbers of students to benchmark (10^3 .. 10^7)")
+    parser.add_argument("--occupancy", type=float, default=10.0, help="Average number of students per room")
+    parser.add_argument("--female-ratio", type=float, default=0.5, help="Share of students with sex F")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the generator")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Workers of the parallel load phase, timed after the serial one (1 - skip it)")
+
+    args = parser.parse_args()
+
+    env = dotenv_values(".env")
+    all_results = {}
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as work_folder:
+            all_results[scale] = Benchmark().run(env, scale, args.occupancy, args.female_ratio, args.seed, work_folder,
+                                                 args.workers)
+    save_report(args.scales, all_results, {"occupancy": args.occupancy, "female_ratio": args.female_ratio,
+                                           "seed": args.seed, "workers": args.workers})
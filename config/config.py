@@ -3,6 +3,62 @@ import sys
 
 OUTPUT_PATH = 'results'
 
+# number of records sent to the DB in one COPY / multi-row INSERT statement
+BATCH_SIZE = 10000
+
+# number of rows fetched from a server-side cursor in one round trip while exporting
+FETCH_SIZE = 2000
+
+# compression levels of the compressed report files (--compress gzip / zstd)
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# folder and size (number of files) of the on-disk cache of report results
+RESULT_CACHE_PATH = f'{OUTPUT_PATH}/.cache'
+RESULT_CACHE_SIZE = 64
+
+# folder of the binary columnar snapshots of the source files (read with --snapshot)
+SNAPSHOT_PATH = f'{OUTPUT_PATH}/.snapshot'
+
+# records rejected by --validate, one JSON object per line with the reasons
+QUARANTINE_FILE = f'{OUTPUT_PATH}/quarantine.ndjson'
+
+# report service (--serve): listen address, number of rendered reports kept in memory
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8080
+SERVICE_CACHE_SIZE = 256
+
+# per-phase timings of the last run (JSON run report)
+RUN_REPORT_FILE = f'{OUTPUT_PATH}/run_report.json'
+
+# index advisor: tables smaller than this are fine with sequential scans, number of timed runs per query
+ADVISOR_MIN_ROWS = 5000
+ADVISOR_RUNS = 3
+ADVISOR_OUTPUT_FILE = f'{OUTPUT_PATH}/recommended_indexes.sql'
+
+# approximate reports (--approx): sampling method of TABLESAMPLE, seed of REPEATABLE (the same data gives
+# the same sample) and z of the ~95% confidence bounds; the bounds assume independently sampled rows, which
+# only BERNOULLI gives: SYSTEM reads fewer pages but takes whole pages, where students of a room are often
+# stored together, so its bounds would be too narrow
+APPROX_SAMPLE_METHOD = 'BERNOULLI'
+APPROX_SEED = 42
+APPROX_Z = 1.96
+
+# bounds of the DB connection pool (can be overridden with DB_POOL_MIN / DB_POOL_MAX in .env),
+# the minimum is opened up front, returned connections are kept open up to the maximum
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+
+# how many times a broken pooled connection is replaced before giving up
+POOL_CONNECT_ATTEMPTS = 3
+
+# seconds a parallel / shard loader waits on its queues before checking that the worker processes are alive
+LOADER_POLL_SECONDS = 1.0
+
+# lock_timeout of the parallel loader workers: a worker waiting for a prepared sibling (duplicate id) fails
+# instead of waiting forever
+LOADER_LOCK_TIMEOUT = '30s'
+
 
 # set logging output into console  (logging is more powerful and wide functioned than standard Error e:)
 """
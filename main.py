@@ -7,189 +7,515 @@
 # importing dotenv to move out credentials
 # importing logging for logs
 
-import tqdm
 import argparse
 import os
 import logging
+import sys
 
 
-from psycopg2 import Error
-from tqdm import tqdm
-from dotenv import dotenv_values
-from typing import Any
+from datetime import date
+from typing import Any, List, Optional, Sequence
 
-from config.config import OUTPUT_PATH
-from modules.JSONFile import JSONFile
-from modules.Database import Database
-from modules.Query import execute_and_save_query_json, execute_query_and_save_xml
+from config.config import OUTPUT_PATH, BATCH_SIZE, QUARANTINE_FILE, RUN_REPORT_FILE, SERVICE_HOST, SERVICE_PORT
 
+# Everything else is imported where it is used: a report-only run does not pay for tqdm, numpy,
+# multiprocessing or the loaders, and --help answers without touching psycopg2
 
-logger = logging.getLogger('main')
 
+logger = logging.getLogger('main')
 
-def main(students_file_path: str, rooms_file_path: str, output_format: str) -> Any:
+# columns of the tables in the order they are sent to the DB
+ROOM_COLUMNS = ("id", "name")
+STUDENT_COLUMNS = ("id", "birthday", "name", "room", "sex")
+
+# subcommands of the command line, the old form "main.py students rooms format" runs "run"
+COMMANDS = ("run", "load", "report", "index")
+
+# options a mode has no equivalent for and would silently ignore, rejected by parse_args: (flag, argument, default)
+# the local engine computes the reports in process from the files, nothing is loaded into the DB
+LOCAL_UNSUPPORTED = (("--validate", "validate", False), ("--workers", "workers", 1),
+                     ("--incremental", "incremental", False), ("--load-method insert", "load_method", "copy"),
+                     ("--room-stats", "room_stats", False), ("--check-room-stats", "check_room_stats", False),
+                     ("--refresh", "refresh", False), ("--advise-indexes", "advise_indexes", False),
+                     ("--apply-indexes", "apply_indexes", False), ("--serve", "serve", False),
+                     ("--approx", "approx", None))
+# the sharded mode loads with one process per shard and merges the shard aggregates in Python
+SHARDED_UNSUPPORTED = (("--workers", "workers", 1), ("--incremental", "incremental", False),
+                       ("--room-stats", "room_stats", False), ("--check-room-stats", "check_room_stats", False),
+                       ("--refresh", "refresh", False), ("--advise-indexes", "advise_indexes", False),
+                       ("--apply-indexes", "apply_indexes", False), ("--serve", "serve", False),
+                       ("--engine local", "engine", "db"), ("--approx", "approx", None))
+# the report service renders every report on request, uncompressed, and keeps it in memory
+SERVE_UNSUPPORTED = (("--refresh", "refresh", False), ("--compress", "compression", None), ("--approx", "approx", None))
+# the sampled reports are one aggregate over the table student, the result cache is not used
+APPROX_UNSUPPORTED = (("--refresh", "refresh", False), ("--room-stats", "room_stats", False))
+# the difference is applied over the main connection in one transaction
+INCREMENTAL_UNSUPPORTED = (("--workers", "workers", 1),)
+
+# exit status of the program: every requested step succeeded / a load or a report failed
+EXIT_OK = 0
+EXIT_FAILURE = 1
+
+# --compress choices mapped to the extension appended to the file format, see modules.OutputFile
+COMPRESSIONS = ("gzip", "zstd")
+
+
+def main(students_file_path: Optional[str], rooms_file_path: Optional[str], output_format: str,
+         batch_size: int = BATCH_SIZE, load_method: str = "copy", workers: int = 1,
+         incremental: bool = False, room_stats: bool = False, check_room_stats: bool = False,
+         refresh: bool = False, advise_indexes: bool = False, apply_indexes: bool = False,
+         top_n: Optional[int] = None, as_of: Optional[date] = None, room_ids: Optional[List[int]] = None,
+         engine: str = "db", snapshot: bool = False, compression: Optional[str] = None,
+         run_report_file: str = RUN_REPORT_FILE, prometheus_file: Optional[str] = None, shards: int = 1,
+         serve: bool = False, port: int = SERVICE_PORT, load_data: bool = True, export: bool = True,
+         validate: bool = False, quarantine_file: str = QUARANTINE_FILE, approx: Optional[float] = None) -> int:
     """
     Main program logic
 
     Args:
-        students_file_path (str): Path to the students file
-        rooms_file_path (str): Path to the rooms file
-        output_format (str): Output format (json or xml)
+        students_file_path (Optional[str]): Path to the students file (not needed without load_data)
+        rooms_file_path (Optional[str]): Path to the rooms file (not needed without load_data)
+        output_format (str): Output format (json, xml, ndjson or csv)
+        batch_size (int): Number of records sent to the DB in one statement
+        load_method (str): Bulk load method (copy or insert)
+        workers (int): Number of parallel loader processes (1 - load over the main connection)
+        incremental (bool): Apply only inserted, changed and removed records (upsert + delete)
+        room_stats (bool): Maintain the summary table room_stats and build reports from it
+        check_room_stats (bool): Compare room_stats with a full recompute before reporting
+        refresh (bool): Ignore cached report results and run every query
+        advise_indexes (bool): Explain the reports and save recommended indexes into ADVISOR_OUTPUT_FILE
+        apply_indexes (bool): Same as advise_indexes, but the recommended indexes are kept in the DB
+        top_n (Optional[int]): Number of rows of every report (default 5 for query2 and query3, all for the others)
+        as_of (Optional[date]): Date the ages are computed at (default today)
+        room_ids (Optional[List[int]]): Rooms included in the reports (default all)
+        engine (str): Where the reports are computed: db (load into PostgreSQL) or local (NumPy, no DB)
+        snapshot (bool): Read the files from memory-mapped columnar snapshots, JSON is parsed only when a file changed
+        compression (Optional[str]): Compress the result files on the fly (gzip or zstd), None - plain text
+        run_report_file (str): JSON file with wall time, rows, rows/sec, bytes and peak memory of every phase
+        prometheus_file (Optional[str]): Also save the phase metrics in the Prometheus text format
+        shards (int): Number of shard databases rooms and students are spread over by room id (1 - no sharding)
+        serve (bool): Keep running and serve the reports over HTTP from warm pooled connections instead of saving files
+        port (int): Port of the report service
+        load_data (bool): Load the source files into the DB (False - report on the data already loaded)
+        export (bool): Save the reports (False - only load and / or advise indexes)
+        validate (bool): Check the records before loading, rejected ones go to quarantine_file instead of the DB
+            (the DB engine only)
+        quarantine_file (str): NDJSON file with the rejected records and the reasons
+        approx (Optional[float]): Estimate the reports from this share of the students (TABLESAMPLE) with
+            confidence bounds instead of running the exact queries, None - exact reports
 
     Returns:
-        Any: Result of the main program logic
+        int: Exit status, EXIT_OK if every requested step succeeded, EXIT_FAILURE otherwise
     """
+    from modules.Metrics import metrics
+
+    metrics.reset()
+    params = {"top_n": top_n, "as_of": as_of, "room_ids": room_ids}
+
+    # Compressed results get the extension of the compression too: query1_result.csv.gz
+    if compression:
+        from modules.OutputFile import COMPRESSION_EXTENSIONS
+        output_format = f"{output_format}.{COMPRESSION_EXTENSIONS[compression]}"
+
+    # Source of the records: JSON parser or binary snapshots with the same iter_records / iter_batches
+    if snapshot:
+        from modules.ColumnarCache import ColumnarCache
+        columnar = reader = ColumnarCache()
+    else:
+        from modules.JSONFile import JSONFile
+        columnar, reader = None, JSONFile
+
+    if validate and load_data:
+        # Records the tables would refuse are set aside, so one bad record does not abort the whole load
+        from modules.RecordValidator import RecordValidator
+        reader = RecordValidator({rooms_file_path: "room", students_file_path: "student"}, reader,
+                                 quarantine_file, batch_size)
+
+    if engine == "local":
+        # The same reports computed in process from the files, nothing is loaded into the DB
+        from modules.LocalEngine import LocalEngine
+        if not os.path.exists(OUTPUT_PATH):
+            os.makedirs(OUTPUT_PATH)
+        local_engine = LocalEngine(students_file_path, rooms_file_path, columnar)
+        local_engine.load()
+        saved = local_engine.run_reports(OUTPUT_PATH, output_format, params)
+        save_metrics(run_report_file, prometheus_file)
+        return EXIT_OK if all(saved.values()) else EXIT_FAILURE
+
+    from dotenv import dotenv_values
+    from psycopg2 import Error
+
     # Load the environment variables from the .env file
     config = dotenv_values(".env")
 
+    if shards > 1:
+        # Every room lives with its students on shard room_id % shards, the shard aggregates are merged in Python
+        from modules.Sharding import ShardedDatabase
+        status = EXIT_OK
+        try:
+            sharded = ShardedDatabase(config, shards, load_method)
+            if load_data:
+                sharded.install()
+                sharded.load([("room", ROOM_COLUMNS, reader.iter_records(rooms_file_path), "id"),
+                              ("student", STUDENT_COLUMNS, reader.iter_records(students_file_path), "room")],
+                             batch_size)
+            if export:
+                if not os.path.exists(OUTPUT_PATH):
+                    os.makedirs(OUTPUT_PATH)
+                if not all(sharded.run_reports(OUTPUT_PATH, output_format, params).values()):
+                    status = EXIT_FAILURE
+        except (Error, ValueError, OSError) as e:
+            logging.error(f"-- Error in sharded mode {e}")
+            status = EXIT_FAILURE
+        save_metrics(run_report_file, prometheus_file)
+        return status
+
+    from modules.Database import Database
+    from modules.Reports import REPORTS, ROOM_STATS_REPORTS, install_schema, schema_installed
+    from modules.RoomStats import RoomStats
+
     # Create an instance of the DatabaseConnection class
     database = Database(config)
-    database.connect()
-
-    # Read JSON files
-    rooms = JSONFile.read_file(rooms_file_path)
-    students = JSONFile.read_file(students_file_path)
+    if not database.connect():
+        save_metrics(run_report_file, prometheus_file)
+        return EXIT_FAILURE
 
-    # Insert data into the table room (In DBMS)
     try:
-        for room in tqdm(rooms, desc=f"-- Inserting values into table room DB {database.config['DB_DATABASE']}"):
-            insert_query = f"INSERT INTO room(id, name) VALUES ({room['id']}, '{room['name']}')"
-            database.execute_query(insert_query)
-
-        for student in tqdm(students,
-                            desc=f"-- Inserting values into table student DB {database.config['DB_DATABASE']}"):
-            insert_query = f"INSERT INTO student(id, birthday, name, room, sex) " \
-                           f"VALUES ({student['id']}, '{student['birthday']}', '{student['name']}', " \
-                           f"{student['room']}, '{student['sex']}')"
-            database.execute_query(insert_query)
-
-        database.commit()  # saving transaction result
-        logging.info("-- Data inserted")
-    except Error as e:
+        with metrics.phase("schema"):
+            if load_data or advise_indexes or apply_indexes:
+                # Only missing objects are created, the DDL locks the tables and is kept off the report path
+                install_schema(database)
+                if room_stats:
+                    RoomStats.install(database)
+                database.commit()
+            else:
+                installed = all(schema_installed(database)) and (not room_stats or RoomStats.installed(database))
+                database.rollback()
+                if not installed:
+                    logging.error("-- The reports need the schema installed by the load or index command")
+                    database.close()
+                    save_metrics(run_report_file, prometheus_file)
+                    return EXIT_FAILURE
+
+        if load_data:
+            if validate and not incremental:
+                # the records are added to the rows in the tables, their ids are taken and their rooms are known
+                reader.add_existing(database)
+            load_files(database, students_file_path, rooms_file_path, batch_size, load_method, workers,
+                       incremental, room_stats, reader)
+            logging.info("-- Data inserted")
+    except (Error, ValueError, OSError) as e:
+        # Reports of a half-loaded or unchanged DB would look like the result of this run, nothing is exported
+        database.rollback()
         logging.error(f"-- Error inserting data {e}")
+        database.close()
+        save_metrics(run_report_file, prometheus_file)
+        return EXIT_FAILURE
 
     # Creating folder for result files IF NOT EXISTS
     if not os.path.exists(OUTPUT_PATH):
         os.makedirs(OUTPUT_PATH)
         logging.info("-- Folder 'results' created")
 
-    # Executing and saving queries
+    # Executing and saving queries, every report runs concurrently on its own connection
+    status = EXIT_OK
     try:
-        query1 = """
-            SELECT public.room.id AS room_id,
-            public.room."name" AS room_name,
-            COUNT(public.student.id) AS students_quantity
-
-            FROM public.room
-                INNER JOIN public.student
-                ON public.room.id = public.student.room 
-            GROUP BY public.room.id
-            ORDER BY public.room.id; 
-            """
-        database.execute_query(query1)  # executing query
-        result = database.cursor.fetchall()  # collecting information from query
-
-        filename1 = f'{OUTPUT_PATH}/query1_result'  # join folder name + file name = results/query1_r.js
-        if output_format == "json":  # selecting by user before launch .py
-            filename1 += ".json"  # concatenate filename + .json
-            execute_and_save_query_json(database, result, filename1)  # executing function for json
-        elif output_format == "xml":  # selecting by user before launch
-            filename1 += ".xml"  # concatenate filename + .xml
-            execute_query_and_save_xml(database, result, filename1)  # executing function for xml
-
-        query2 = """
-            SELECT public.room.id AS room_id,
-            public.room."name" AS room_name,
-            COUNT(public.student.id) AS students_quantity,
-            AVG(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER AS average_age
-
-            FROM public.room
-                INNER JOIN public.student
-                ON public.room.id = public.student.room
-            GROUP BY public.room.id 
-            ORDER BY average_age ASC
-            LIMIT 5;
-            """
-
-        database.execute_query(query2)
-        result = database.cursor.fetchall()
-
-        filename2 = f'{OUTPUT_PATH}/query2_result'
-        if output_format == "json":
-            filename2 += ".json"
-            execute_and_save_query_json(database, result, filename2)
-        elif output_format == "xml":
-            filename2 += ".xml"
-            execute_query_and_save_xml(database, result, filename2)
-
-        query3 = """
-            SELECT public.room.id AS room_id,
-            public.room."name" AS room_name,
-            COUNT(public.student.id) AS students_quantity,
-            MAX(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER -
-            MIN(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER AS stud_age_diff
-
-            FROM public.room
-                INNER JOIN public.student
-                ON public.room.id = public.student.room
-            GROUP BY public.room.id
-            ORDER BY stud_age_diff DESC, students_quantity ASC
-            LIMIT 5;
-            """
-
-        database.execute_query(query3)
-        result = database.cursor.fetchall()
-
-        filename3 = f'{OUTPUT_PATH}/query3_result'
-        if output_format == "json":
-            filename3 += ".json"
-            execute_and_save_query_json(database, result, filename3)
-        elif output_format == "xml":
-            filename3 += ".xml"
-            execute_query_and_save_xml(database, result, filename3)
-
-        query4 = """
-            SELECT public.room.id AS room_id,
-            public.room."name" AS room_name,
-            STRING_AGG(public.student.sex, ', ' ORDER BY public.student.sex) AS genders_in_room
-
-            FROM public.room
-                INNER JOIN public.student
-                ON public.room.id = public.student.room
-            WHERE public.student.sex IN (UPPER('M'), UPPER('F'))
-            GROUP BY public.room.id
-            HAVING COUNT(DISTINCT public.student.sex) = 2
-            ORDER BY public.room.id;
-            """
-
-        database.execute_query(query4)
-        result = database.cursor.fetchall()
-
-        filename4 = f'{OUTPUT_PATH}/query4_result'
-        if output_format == "json":
-            filename4 += ".json"
-            execute_and_save_query_json(database, result, filename4)
-        elif output_format == "xml":
-            filename4 += ".xml"
-            execute_query_and_save_xml(database, result, filename4)
-
-    except Error as e:
+        if check_room_stats and RoomStats.check(database):
+            status = EXIT_FAILURE
+
+        reports = ROOM_STATS_REPORTS if room_stats else REPORTS
+        if advise_indexes or apply_indexes:
+            from modules.IndexAdvisor import IndexAdvisor
+            from modules.Reports import render_reports
+            IndexAdvisor(database, render_reports(database, reports, params)).run(apply=apply_indexes)
+
+        if export and serve:
+            # Reports are rendered on request and kept in memory until the data changes, POST /load reloads the files
+            from modules.OutputFile import split_format
+            from modules.ReportService import ReportService
+            sources = [("room", ROOM_COLUMNS, rooms_file_path),
+                       ("student", STUDENT_COLUMNS, students_file_path)] if load_data else []
+            service = ReportService(database, reports, sources, split_format(output_format)[0], batch_size,
+                                    load_method, reader)
+            service.serve(SERVICE_HOST, port)
+        elif export and approx:
+            # One sampled aggregate instead of four exact queries, saved as <name>_approx_result.<format>
+            from modules.ApproxReports import ApproxReports
+            if not all(ApproxReports(database, approx).run_reports(OUTPUT_PATH, output_format, params).values()):
+                status = EXIT_FAILURE
+        elif export:
+            import asyncio
+            from modules.AsyncReports import run_reports
+            from modules.ResultCache import ResultCache, data_fingerprint
+
+            # unchanged data + unchanged query = the result file is copied from the cache
+            cache = ResultCache(refresh=refresh)
+            source_files = (students_file_path, rooms_file_path) if load_data else ()
+            fingerprint = data_fingerprint(database, source_files)
+            with metrics.phase("reports", format=output_format):
+                saved = asyncio.run(run_reports(database, reports, OUTPUT_PATH, output_format, cache, fingerprint,
+                                                params))
+            cache.log_stats()
+            if not all(saved.values()):
+                status = EXIT_FAILURE
+
+    except (Error, OSError) as e:
         logging.error(f"Error while executing queries {e}")
+        status = EXIT_FAILURE
 
     finally:
         database.close()  # closing cursor and connection
+        save_metrics(run_report_file, prometheus_file)
+    return status
 
 
-if __name__ == "__main__":
+def load_files(database: Any, students_file_path: str, rooms_file_path: str, batch_size: int, load_method: str,
+               workers: int, incremental: bool, room_stats: bool, reader: Any) -> None:
+    """
+    Load the source files into the DB, rooms before students
+
+    Args:
+        database (Database): Connected database
+        students_file_path (str): Path to the students file
+        rooms_file_path (str): Path to the rooms file
+        batch_size (int): Number of records sent to the DB in one statement
+        load_method (str): Bulk load method (copy or insert)
+        workers (int): Number of parallel loader processes (1 - load over the main connection)
+        incremental (bool): Apply only inserted, changed and removed records (upsert + delete)
+        room_stats (bool): Rebuild room_stats after a parallel load
+        reader (Any): JSONFile or ColumnarCache, source of the records
+
+    Raises:
+        Error: If the load failed, the transaction of the main connection is left for the caller to roll back
+    """
+    from modules.RoomStats import RoomStats
+
+    if incremental:
+        # Only the difference between the files and the tables is applied, re-runs are idempotent
+        from modules.IncrementalLoader import IncrementalLoader
+        loader = IncrementalLoader(database, batch_size, load_method)
+        loader.load([("room", ROOM_COLUMNS, reader.iter_records(rooms_file_path)),
+                     ("student", STUDENT_COLUMNS, reader.iter_records(students_file_path))])
+        database.commit()
+    elif workers > 1:
+        # Every worker writes its rooms with their students into the tables, all workers commit together (2PC)
+        # Row by row trigger maintenance of room_stats is skipped, it is rebuilt once afterwards
+        from modules.ParallelLoader import ParallelLoader
+        loader = ParallelLoader(database, workers, load_method, RoomStats.DEFER_QUERY if room_stats else None)
+        loader.load([("room", ROOM_COLUMNS, reader.iter_records(rooms_file_path), "id"),
+                     ("student", STUDENT_COLUMNS, reader.iter_records(students_file_path), "room")], batch_size)
+        if room_stats:
+            RoomStats.rebuild(database)
+        database.commit()
+    else:
+        from tqdm import tqdm
+
+        # Read JSON files lazily, records are parsed while they are being loaded into the DB
+        rooms = reader.iter_records(rooms_file_path)
+        students = reader.iter_records(students_file_path)
+
+        # Insert data into the table room (In DBMS) batch by batch with COPY (or multi-row INSERT)
+        database.bulk_load("room", ROOM_COLUMNS,
+                           tqdm(rooms, desc=f"-- Inserting values into table room DB {database.config['DB_DATABASE']}"),
+                           batch_size, load_method)
+
+        database.bulk_load("student", STUDENT_COLUMNS,
+                           tqdm(students,
+                                desc=f"-- Inserting values into table student DB {database.config['DB_DATABASE']}"),
+                           batch_size, load_method)
+
+        database.commit()  # saving transaction result
+
+
+def save_metrics(run_report_file: str, prometheus_file: Optional[str] = None) -> None:
+    """
+    Save the phase metrics of the run
+
+    Args:
+        run_report_file (str): JSON run report file
+        prometheus_file (Optional[str]): Prometheus text format file, None - not saved
+    """
+    from modules.Metrics import metrics
+
+    try:
+        metrics.save_json(run_report_file)
+        if prometheus_file:
+            metrics.save_prometheus(prometheus_file)
+    except OSError as e:
+        logging.error(f"-- Error while saving run metrics {e}")
+
+
+def sample_fraction(value: str) -> float:
+    """
+    Parse the --approx sample fraction
+
+    Args:
+        value (str): Command line value
+
+    Returns:
+        float: Share of the students in the sample
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is not in (0, 1]
+    """
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError(f"sample fraction must be in (0, 1], got {value}")
+    return fraction
+
+
+def row_count(value: str) -> int:
+    """
+    Parse the --top-n number of rows
+
+    Args:
+        value (str): Command line value
+
+    Returns:
+        int: Number of rows (0 - an empty top)
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is negative
+    """
+    count = int(value)
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"number of rows must not be negative, got {value}")
+    return count
+
+
+def parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    """
+    Parse the command line
+
+    Subcommands:
+        run     load the source files and save the reports (the default, "main.py students rooms format")
+        load    only load the source files into the DB
+        report  only save the reports of the data already in the DB, the source files are not read
+        index   explain the reports and save (or apply) recommended indexes
+
+    Args:
+        argv (Sequence[str]): Command line arguments without the program name
+
+    Returns:
+        argparse.Namespace: Keyword arguments of main (and the subcommand in "command")
+    """
+    argv = list(argv)
+    if argv and argv[0] not in COMMANDS and not argv[0].startswith("-"):
+        argv.insert(0, "run")  # the command line before the subcommands
+
+    # options shared by the subcommands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--room-stats", action="store_true",
+                        help="Maintain the per-room summary table room_stats and read reports from it")
+    common.add_argument("--run-report", dest="run_report_file", default=RUN_REPORT_FILE,
+                        help=f"JSON file with time, rows/sec, bytes and peak memory per phase "
+                             f"(default {RUN_REPORT_FILE})")
+    common.add_argument("--prometheus", dest="prometheus_file",
+                        help="Also write the phase metrics into this Prometheus text format file")
+
+    # options of the subcommands that read the source files
+    sources = argparse.ArgumentParser(add_help=False)
+    sources.add_argument("students_file_path", metavar="students", help="Path to the students file")
+    sources.add_argument("rooms_file_path", metavar="rooms", help="Path to the rooms file")
+    sources.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                         help=f"Number of records sent to the DB in one statement (default {BATCH_SIZE})")
+    sources.add_argument("--load-method", choices=["copy", "insert"], default="copy",
+                         help="Bulk load with COPY FROM STDIN or with multi-row INSERT (default copy)")
+    sources.add_argument("--workers", type=int, default=1,
+                         help="Number of parallel loader processes, each with its own DB connection, committed "
+                              "together with two-phase commit (needs max_prepared_transactions >= N, default 1)")
+    sources.add_argument("--incremental", action="store_true",
+                         help="Upsert changed records and delete removed ones instead of inserting everything")
+    sources.add_argument("--snapshot", action="store_true",
+                         help="Read the source files from memory-mapped binary snapshots (built when a file changes)")
+    sources.add_argument("--validate", action="store_true",
+                         help="Check types, lengths, dates, sexes, duplicate ids and room references before loading, "
+                              "rejected records are skipped (and deleted by --incremental) and written into "
+                              "--quarantine (not with --engine local)")
+    sources.add_argument("--quarantine", dest="quarantine_file", default=QUARANTINE_FILE,
+                         help=f"File for the records rejected by --validate (default {QUARANTINE_FILE})")
+
+    # options of the subcommands that save reports
+    reporting = argparse.ArgumentParser(add_help=False)
+    reporting.add_argument("output_format", metavar="format", choices=["json", "xml", "ndjson", "csv"],
+                           help="Output format (json, xml, newline-delimited json or csv with a header row)")
+    reporting.add_argument("--check-room-stats", action="store_true",
+                           help="Check room_stats against a full recompute from the table student")
+    reporting.add_argument("--refresh", action="store_true",
+                           help="Ignore cached report results and run every query again")
+    reporting.add_argument("--advise-indexes", action="store_true",
+                           help="Explain the report queries, measure them and save recommended CREATE INDEX statements")
+    reporting.add_argument("--apply-indexes", action="store_true",
+                           help="Like --advise-indexes, but keep the recommended indexes in the DB")
+    reporting.add_argument("--compress", dest="compression", choices=COMPRESSIONS,
+                           help="Compress the result files while they are written (.gz or .zst is appended)")
+    reporting.add_argument("--serve", action="store_true",
+                           help=f"Serve the reports over HTTP (GET /reports/<name>?format=...) "
+                                f"on {SERVICE_HOST} instead of writing result files")
+    reporting.add_argument("--port", type=int, default=SERVICE_PORT,
+                           help=f"Port of the report service (default {SERVICE_PORT})")
+    reporting.add_argument("--approx", type=sample_fraction, metavar="FRACTION",
+                           help="Estimate the reports from a TABLESAMPLE of this share of the students (e.g. 0.05) "
+                                "with ~95%% bounds and uncertain top-N rows flagged, saved as <name>_approx_result")
+
+    # report parameters
+    params = argparse.ArgumentParser(add_help=False)
+    params.add_argument("--top-n", type=row_count,
+                        help="Number of rows of every report (default 5 rows of query2 and query3, all of the others)")
+    params.add_argument("--as-of", type=date.fromisoformat,
+                        help="Date the ages are computed at, YYYY-MM-DD (default today)")
+    params.add_argument("--room", type=int, nargs="+", dest="room_ids",
+                        help="Include only these room ids in the reports")
+
+    # sharding
+    sharding = argparse.ArgumentParser(add_help=False)
+    sharding.add_argument("--shards", type=int, default=1,
+                          help="Spread rooms and students over N databases by room id (DB_SHARDS in .env or "
+                               "<DB_DATABASE>_shard<n>), load them in parallel and merge the reports (default 1)")
 
     parser = argparse.ArgumentParser(description="Database Query and Export \
                                                  --example Python file.py source/students.json source/rooms.json json")
-    parser.add_argument("students", type=str, help="Path to the students file")
-    parser.add_argument("rooms", type=str, help="Path to the rooms file")
-    parser.add_argument("format", choices=["json", "xml"], help="Output format (json or xml)")
-
-    args = parser.parse_args()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", parents=[sources, reporting, params, sharding, common],
+                              help="Load the source files and save the reports")
+    run.add_argument("--engine", choices=["db", "local"], default="db",
+                     help="Compute the reports in PostgreSQL or in process with NumPy without a DB (default db)")
+
+    load = commands.add_parser("load", parents=[sources, sharding, common],
+                               help="Only load the source files into the DB")
+    load.set_defaults(output_format="json", export=False)
+
+    report = commands.add_parser("report", parents=[reporting, params, sharding, common],
+                                 help="Save the reports of the data already in the DB")
+    report.set_defaults(students_file_path=None, rooms_file_path=None, load_data=False)
+
+    index = commands.add_parser("index", parents=[params, common],
+                                help="Explain the reports and save recommended CREATE INDEX statements")
+    index.add_argument("--apply", dest="apply_indexes", action="store_true",
+                       help="Keep the recommended indexes in the DB")
+    index.set_defaults(students_file_path=None, rooms_file_path=None, output_format="json",
+                       advise_indexes=True, load_data=False, export=False)
+
+    args = parser.parse_args(argv)
+    # a mode which would silently ignore some of the given options refuses them
+    command = commands.choices[args.command]
+    modes = (("--engine local", getattr(args, "engine", "db") == "local", LOCAL_UNSUPPORTED),
+             ("--shards", getattr(args, "shards", 1) > 1, SHARDED_UNSUPPORTED),
+             ("--serve", getattr(args, "serve", False), SERVE_UNSUPPORTED),
+             ("--approx", getattr(args, "approx", None) is not None, APPROX_UNSUPPORTED),
+             ("--incremental", getattr(args, "incremental", False), INCREMENTAL_UNSUPPORTED))
+    for mode, active, options in modes:
+        ignored = [flag for flag, name, default in options if getattr(args, name, default) != default]
+        if active and ignored:
+            command.error(f"{', '.join(ignored)} cannot be used with {mode}")
+    if getattr(args, "quarantine_file", QUARANTINE_FILE) != QUARANTINE_FILE and not args.validate:
+        command.error("--quarantine needs --validate, only rejected records are written into it")
+    return args
 
-    main(args.students, args.rooms, args.format)
 
+if __name__ == "__main__":
 
+    args = vars(parse_args(sys.argv[1:]))
+    args.pop("command")
+    sys.exit(main(**args))
@@ -0,0 +1,359 @@
+import logging
+import math
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config.config import APPROX_SAMPLE_METHOD, APPROX_SEED, APPROX_Z
+from modules.Database import Database
+from modules.LocalEngine import export_reports
+from modules.Metrics import metrics
+from modules.Reports import AS_OF_YMD, REPORTS, ROOM_FILTER
+
+
+logger = logging.getLogger('approx_reports')
+
+# per-room sums of a sample of the students, {method} is SYSTEM or BERNOULLI
+SAMPLE_QUERY = f"""
+    SELECT public.room.id AS room_id,
+    public.room."name" AS room_name,
+    COUNT(*) AS sampled,
+    SUM(({AS_OF_YMD} - public.student.birth_ymd) / 10000) AS age_sum,
+    SUM((({AS_OF_YMD} - public.student.birth_ymd) / 10000) ^ 2) AS age_square_sum,
+    MIN(public.student.birth_ymd) AS min_birth_ymd,
+    MAX(public.student.birth_ymd) AS max_birth_ymd,
+    COUNT(*) FILTER (WHERE public.student.sex = 'F') AS female_quantity
+
+    FROM public.room
+        INNER JOIN public.student TABLESAMPLE {{method}} (%(percent)s) REPEATABLE (%(seed)s)
+        ON public.room.id = public.student.room
+    WHERE {ROOM_FILTER}
+    GROUP BY public.room.id
+    ORDER BY public.room.id;
+    """
+
+
+def _round_half_away(value: float) -> int:
+    """Round like AVG(...)::INTEGER does: halves away from zero.
+
+    :param value: Value to round
+    :type value: float
+    :rtype: int
+    """
+    return int(math.copysign(math.floor(abs(value) + 0.5), value))
+
+
+def _full_years(ymd_difference: int) -> int:
+    """Full years from a difference of YYYYMMDD integers, truncated toward zero like in SQL.
+
+    :param ymd_difference: as_of_ymd - birth_ymd
+    :type ymd_difference: int
+    :rtype: int
+    """
+    return int(math.copysign(abs(ymd_difference) // 10000, ymd_difference))
+
+
+def _t_quantile(z: float, degrees: int) -> float:
+    """Student t quantile with the same confidence as the normal quantile z (Cornish-Fisher expansion).
+
+    :param z: Normal quantile
+    :type z: float
+    :param degrees: Degrees of freedom
+    :type degrees: int
+    :rtype: float
+    """
+    return (z + (z ** 3 + z) / (4 * degrees) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * degrees ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * degrees ** 3))
+
+
+def _range_share(sampled: int, alpha: float) -> float:
+    """Share of the true age range the range of a sample is below only with probability alpha.
+
+    For n values spread evenly over a range, the sample range covers a share x of it with
+    P(share <= x) = n * x^(n-1) - (n-1) * x^n; the equation P = alpha is solved by bisection.
+
+    :param sampled: Number of sampled students of the room (at least 2)
+    :type sampled: int
+    :param alpha: Probability the bound fails
+    :type alpha: float
+    :rtype: float
+    """
+    low, high = 0.0, 1.0
+    for _ in range(50):
+        middle = (low + high) / 2
+        if sampled * middle ** (sampled - 1) - (sampled - 1) * middle ** sampled < alpha:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+class SampledRooms:
+    """Per-room sums of a sample of the students and the four reports estimated from them
+
+    Every estimated value comes with ~95% bounds (*_low / *_high columns): counts assume every
+    student was sampled independently with the same probability, average ages use the sample
+    variance, and the age difference of the sample is a lower bound of the true one (its upper
+    bound assumes birthdays spread evenly inside a room). Rooms without a sampled student are
+    missing. The top-N reports flag rows whose bounds overlap the bounds of a room outside of
+    the top, their place in the top is not certain.
+    """
+
+    def __init__(self, rows: Sequence[tuple], fraction: float, as_of: date, z: float = APPROX_Z) -> None:
+        """Initialize the SampledRooms object.
+
+        :param rows: Rows of SAMPLE_QUERY ordered by room id
+        :type rows: Sequence[tuple]
+        :param fraction: Share of the students in the sample (0 < fraction <= 1)
+        :type fraction: float
+        :param as_of: Date ages are computed at
+        :type as_of: date
+        :param z: z value of the bounds
+        :type z: float
+        :rtype: None
+        """
+        self.rows = list(rows)
+        self.fraction = fraction
+        self.z = z
+        self.alpha = math.erfc(z / math.sqrt(2)) / 2  # one-sided, the same confidence as +- z
+        self.as_of_ymd = as_of.year * 10000 + as_of.month * 100 + as_of.day
+
+        # rooms with a single sampled student have no variance of their own, the pooled one is used
+        deviations = sum(square_sum - age_sum * age_sum / sampled
+                         for _, _, sampled, age_sum, square_sum, *_ in self.rows if sampled > 1)
+        degrees = sum(sampled - 1 for _, _, sampled, *_ in self.rows if sampled > 1)
+        self.pooled_variance = deviations / degrees if degrees else 0.0
+        # no room spans more than all students, the bound of the whole sample caps the bounds of the rooms
+        sampled = sum(row[2] for row in self.rows)
+        spread = (self._difference(min(row[5] for row in self.rows), max(row[6] for row in self.rows))
+                  if self.rows else 0)
+        self.spread_high = math.floor((spread + 1) / _range_share(sampled, self.alpha)) + 1 if sampled > 1 else spread
+
+    def _difference(self, min_birth_ymd: int, max_birth_ymd: int) -> int:
+        """Difference in full years between the oldest and the youngest birthday, as in query3.
+
+        :param min_birth_ymd: Birthday of the oldest student
+        :type min_birth_ymd: int
+        :param max_birth_ymd: Birthday of the youngest student
+        :type max_birth_ymd: int
+        :rtype: int
+        """
+        return _full_years(self.as_of_ymd - min_birth_ymd) - _full_years(self.as_of_ymd - max_birth_ymd)
+
+    def count(self, sampled: int) -> Tuple[int, int, int]:
+        """Estimated number of students from the number of sampled ones, with bounds.
+
+        :param sampled: Number of sampled students
+        :type sampled: int
+        :return: Estimate, lower and upper bound
+        :rtype: Tuple[int, int, int]
+        """
+        estimate = sampled / self.fraction
+        # score interval: every N with (sampled - N f)^2 <= z^2 N f (1 - f), holds up better than
+        # estimate +- z * error for the few students sampled from one room
+        f = self.fraction
+        middle = 2 * sampled * f + self.z ** 2 * f * (1 - f)
+        half_width = math.sqrt(max(middle ** 2 - 4 * f * f * sampled * sampled, 0.0))
+        low, high = (middle - half_width) / (2 * f * f), (middle + half_width) / (2 * f * f)
+        return round(estimate), max(sampled, math.floor(low)), math.ceil(high)
+
+    def average(self, sampled: int, age_sum: int, square_sum: int) -> Tuple[float, float, float]:
+        """Estimated average age of a room, with bounds.
+
+        :param sampled: Number of sampled students
+        :type sampled: int
+        :param age_sum: Sum of their ages
+        :type age_sum: int
+        :param square_sum: Sum of the squares of their ages
+        :type square_sum: int
+        :return: Estimate, lower and upper bound
+        :rtype: Tuple[float, float, float]
+        """
+        average = age_sum / sampled
+        if sampled > 1:
+            # t instead of z, a room rarely has more than a few dozen sampled students
+            variance = (square_sum - age_sum * age_sum / sampled) / (sampled - 1)
+            quantile = _t_quantile(self.z, sampled - 1)
+        else:
+            variance, quantile = self.pooled_variance, self.z
+        error = quantile * math.sqrt(max(variance, 0.0) / sampled * (1 - self.fraction))
+        return average, math.floor((average - error) * 10) / 10, math.ceil((average + error) * 10) / 10
+
+    def difference(self, sampled: int, min_birth_ymd: int, max_birth_ymd: int) -> Tuple[int, int, int]:
+        """Estimated age difference of a room (the one of the sample), with bounds.
+
+        :param sampled: Number of sampled students
+        :type sampled: int
+        :param min_birth_ymd: Birthday of the oldest sampled student
+        :type min_birth_ymd: int
+        :param max_birth_ymd: Birthday of the youngest sampled student
+        :type max_birth_ymd: int
+        :return: Estimate, lower and upper bound
+        :rtype: Tuple[int, int, int]
+        """
+        difference = self._difference(min_birth_ymd, max_birth_ymd)
+        if self.fraction >= 1:
+            return difference, difference, difference
+        if sampled < 2:
+            return difference, difference, max(difference, self.spread_high)
+        # the birthdays of the sample span less than difference + 1 years, truncated ages add one more year
+        high = math.floor((difference + 1) / _range_share(sampled, self.alpha)) + 1
+        return difference, difference, max(difference, min(high, self.spread_high))
+
+    def _uncertain(self, order: List[int], top_n: Optional[int], low: List[float], high: List[float],
+                   ascending: bool) -> List[bool]:
+        """Flag rows of the top whose bounds overlap the bounds of a room outside of the top.
+
+        :param order: Indexes of the rooms in the order of the report
+        :type order: List[int]
+        :param top_n: Number of rows of the report (None - all rooms, nothing is uncertain)
+        :type top_n: Optional[int]
+        :param low: Lower bounds of the ranked value
+        :type low: List[float]
+        :param high: Upper bounds of the ranked value
+        :type high: List[float]
+        :param ascending: The smallest values are on the top
+        :type ascending: bool
+        :return: Flag of every row of the top (all False when the whole table was sampled)
+        :rtype: List[bool]
+        """
+        top, rest = order[slice(top_n)], order[len(order[slice(top_n)]):]
+        if not rest or self.fraction >= 1:
+            return [False] * len(top)
+        if ascending:
+            best_rest = min(low[index] for index in rest)
+            return [high[index] >= best_rest for index in top]
+        best_rest = max(high[index] for index in rest)
+        return [best_rest >= low[index] for index in top]
+
+    def query1(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms and the estimated number of students in each of them, ordered by room id.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        rows = [(room_id, room_name, *self.count(sampled))
+                for room_id, room_name, sampled, *_ in self.rows[slice(params["top_n"])]]
+        return ["room_id", "room_name", "students_quantity", "students_quantity_low", "students_quantity_high"], \
+            iter(rows)
+
+    def query2(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms with the smallest estimated average age, ties ordered by room id.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        averages = [self.average(sampled, age_sum, square_sum)
+                    for _, _, sampled, age_sum, square_sum, *_ in self.rows]
+        rounded = [_round_half_away(average) for average, _, _ in averages]
+        order = sorted(range(len(self.rows)), key=lambda index: (rounded[index], self.rows[index][0]))
+        flags = self._uncertain(order, params["top_n"], [low for _, low, _ in averages],
+                                [high for _, _, high in averages], ascending=True)
+        rows = [(self.rows[index][0], self.rows[index][1], self.count(self.rows[index][2])[0], rounded[index],
+                 averages[index][1], averages[index][2], flag) for index, flag in zip(order, flags)]
+        return ["room_id", "room_name", "students_quantity", "average_age", "average_age_low", "average_age_high",
+                "rank_uncertain"], iter(rows)
+
+    def query3(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms with the biggest estimated difference in the age of students.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        differences = [self.difference(sampled, min_birth_ymd, max_birth_ymd)
+                       for _, _, sampled, _, _, min_birth_ymd, max_birth_ymd, _ in self.rows]
+        counts = [self.count(row[2])[0] for row in self.rows]
+        order = sorted(range(len(self.rows)),
+                       key=lambda index: (-differences[index][0], counts[index], self.rows[index][0]))
+        flags = self._uncertain(order, params["top_n"], [low for _, low, _ in differences],
+                                [high for _, _, high in differences], ascending=False)
+        rows = [(self.rows[index][0], self.rows[index][1], counts[index], *differences[index], flag)
+                for index, flag in zip(order, flags)]
+        return ["room_id", "room_name", "students_quantity", "stud_age_diff", "stud_age_diff_low",
+                "stud_age_diff_high", "rank_uncertain"], iter(rows)
+
+    def query4(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms where students of both sexes were sampled (rooms with few students of one sex may be missing).
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        rows = []
+        for room_id, room_name, sampled, _, _, _, _, females in self.rows:
+            if 0 < females < sampled:
+                female_count, male_count = self.count(females), self.count(sampled - females)
+                # the same F, F, ..., M string as the exact report, from the estimated counts
+                genders = ", ".join(["F"] * female_count[0] + ["M"] * male_count[0])
+                rows.append((room_id, room_name, genders, *female_count, *male_count))
+        return ["room_id", "room_name", "genders_in_room", "female_quantity", "female_quantity_low",
+                "female_quantity_high", "male_quantity", "male_quantity_low", "male_quantity_high"], \
+            iter(rows[slice(params["top_n"])])
+
+
+class ApproxReports:
+    """Class for estimating the four reports from a TABLESAMPLE of the students
+
+    One aggregate over fraction of the students replaces the four exact queries, the results
+    are saved as <name>_approx_result.<format> next to the exact ones.
+    """
+
+    def __init__(self, database: Database, fraction: float, method: str = APPROX_SAMPLE_METHOD,
+                 seed: int = APPROX_SEED, z: float = APPROX_Z) -> None:
+        """Initialize the ApproxReports object.
+
+        :param database: Database connection
+        :type database: Database
+        :param fraction: Share of the students in the sample (0 < fraction <= 1)
+        :type fraction: float
+        :param method: TABLESAMPLE method, BERNOULLI (rows) or SYSTEM (pages, the bounds come out too narrow)
+        :type method: str
+        :param seed: Seed of REPEATABLE, the same data and seed give the same sample
+        :type seed: int
+        :param z: z value of the bounds
+        :type z: float
+        :rtype: None
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError(f"Sample fraction must be in (0, 1], got {fraction}")
+        if method not in ("SYSTEM", "BERNOULLI"):
+            raise ValueError(f"Unknown sampling method {method}")
+        self.database = database
+        self.fraction = fraction
+        self.method = method
+        self.seed = seed
+        self.z = z
+
+    def sample(self, params: Dict[str, Any]) -> SampledRooms:
+        """Aggregate a sample of the students per room.
+
+        :param params: Keyword arguments of Report.bind (top_n, as_of, room_ids)
+        :type params: Dict[str, Any]
+        :rtype: SampledRooms
+        """
+        bound = REPORTS["query1"].bind(**params)
+        with metrics.phase("sample", method=self.method, fraction=self.fraction) as phase:
+            self.database.cursor.execute(SAMPLE_QUERY.format(method=self.method),
+                                         {"as_of": bound["as_of"], "room_ids": bound["room_ids"],
+                                          "percent": self.fraction * 100, "seed": self.seed})
+            rows = self.database.cursor.fetchall()
+            phase.rows = len(rows)
+        logging.info(f"-- {sum(row[2] for row in rows)} students of {len(rows)} rooms sampled "
+                     f"({self.method} {self.fraction:.2%}) in {phase.seconds:.3f}s")
+        return SampledRooms(rows, self.fraction, bound["as_of"], self.z)
+
+    def run_reports(self, output_path: str, file_format: str, params: Dict[str, Any]) -> Dict[str, bool]:
+        """Estimate every report of REPORTS and save it as <output_path>/<name>_approx_result.<format>.
+
+        :param output_path: Folder of the result files
+        :type output_path: str
+        :param file_format: Output format, see export_rows ("json", "xml", "ndjson", "csv", "csv.gz", ...)
+        :type file_format: str
+        :param params: Keyword arguments of Report.bind (top_n, as_of, room_ids)
+        :type params: Dict[str, Any]
+        :return: Report names mapped to True if the file was saved
+        :rtype: Dict[str, bool]
+        """
+        return export_reports(self.sample(params), output_path, file_format, params, "approx", "approx_result")
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from psycopg2 import Error
+
+from modules.Database import Database
+from modules.Metrics import counted, metrics
+from modules.Query import export_rows
+from modules.Reports import Report
+from modules.ResultCache import ResultCache
+
+
+logger = logging.getLogger('async_reports')
+
+
+def _run_report(database: Database, report: Report, params: Dict[str, Any], filename: str, file_format: str,
+                cache: Optional[ResultCache] = None, fingerprint: str = "") -> Tuple[float, bool]:
+    """Run one report on its own pooled connection and stream the result into the file.
+
+    :param database: Database with a connection pool
+    :type database: Database
+    :param report: Report from the registry
+    :type report: Report
+    :param params: Keyword arguments of Report.bind
+    :type params: Dict[str, Any]
+    :param filename: Name of the output file without extension
+    :type filename: str
+    :param file_format: Output format, see export_rows ("json", "xml", "ndjson", "csv", "csv.gz", ...)
+    :type file_format: str
+    :param cache: Result cache, None - always run the query
+    :type cache: Optional[ResultCache]
+    :param fingerprint: Data fingerprint used in the cache key
+    :type fingerprint: str
+    :return: Report time in seconds (query + export) and True if the result file was saved or taken from cache
+    :rtype: Tuple[float, bool]
+    """
+    with metrics.phase("report", report=report.name) as phase:
+        with database.session() as session:
+            bound = report.bind(**params)
+            key = ResultCache.key(report.render(session, bound), file_format, fingerprint) if cache else None
+            cached = bool(cache) and cache.get(key, f"{filename}.{file_format}")
+            if cached:
+                phase.labels["cached"] = "true"
+                saved = False
+            else:
+                # rows are written while the server is still sending them, export overlaps execution
+                try:
+                    column_names, rows = report.stream(session, bound)
+                    saved = export_rows(column_names, counted(rows, phase), filename, file_format)
+                except Error as e:
+                    logging.error(f"-- Error while executing report {report.name} {e}")
+                    saved = False
+        if cache and saved:
+            cache.put(key, f"{filename}.{file_format}")
+    if phase.labels.get("cached"):
+        logging.info(f"-- Report {report.name} taken from cache in {phase.seconds:.3f}s")
+    else:
+        logging.info(f"-- Report {report.name} done in {phase.seconds:.2f}s")
+    return phase.seconds, bool(cached or saved)
+
+
+async def run_reports(database: Database, reports: Dict[str, Report], output_path: str, file_format: str,
+                      cache: Optional[ResultCache] = None, fingerprint: str = "",
+                      params: Optional[Dict[str, Any]] = None) -> Dict[str, bool]:
+    """Run all reports concurrently, each on a separate connection from the pool.
+
+    psycopg2 releases the GIL while waiting for the server, so reports running in threads
+    overlap their queries and file writes; total time is close to the slowest report.
+
+    :param database: Database with a connection pool (max size >= number of reports + 1)
+    :type database: Database
+    :param reports: Report names mapped to registry reports
+    :type reports: Dict[str, Report]
+    :param output_path: Folder for result files
+    :type output_path: str
+    :param file_format: Output format, see export_rows ("json", "xml", "ndjson", "csv", "csv.gz", ...)
+    :type file_format: str
+    :param cache: Result cache, None - always run the queries
+    :type cache: Optional[ResultCache]
+    :param fingerprint: Data fingerprint used in the cache keys
+    :type fingerprint: str
+    :param params: Keyword arguments of Report.bind (top_n, as_of, room_ids)
+    :type params: Optional[Dict[str, Any]]
+    :return: Report names mapped to True if the file was saved (or taken from cache)
+    :rtype: Dict[str, bool]
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(reports), thread_name_prefix="report") as executor:
+        tasks = [loop.run_in_executor(executor, _run_report, database, report, params or {},
+                                      f"{output_path}/{name}_result", file_format, cache, fingerprint)
+                 for name, report in reports.items()]
+        results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    logging.info(f"-- {len(reports)} reports done in {elapsed:.2f}s "
+                 f"(sum of report times {sum(seconds for seconds, _ in results):.2f}s)")
+    return {name: saved for name, (_, saved) in zip(reports, results)}
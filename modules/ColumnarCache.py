@@ -0,0 +1,352 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by --snapshot
+    np = None
+
+from config.config import SNAPSHOT_PATH
+from modules.JSONFile import JSONFile
+from modules.Metrics import metrics
+
+
+logger = logging.getLogger('columnar_cache')
+
+# file of the snapshot with the source file identity and the column layout
+META_FILE = "meta.json"
+
+# number of bytes hashed at once when the source file identity is checked
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# number of records converted back into dicts at once by Snapshot.records
+RECORDS_CHUNK_SIZE = 10000
+
+# number of records parsed and appended to the snapshot columns at once by ColumnarCache.build
+BUILD_CHUNK_SIZE = 100000
+
+
+def file_hash(file_path: str) -> str:
+    """sha256 of the file content.
+
+    :param file_path: Path to the file
+    :type file_path: str
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_npy(target: str, source: str, dtype: Any, count: int) -> None:
+    """Turn a file of raw values into a .npy file, the values are copied in chunks and the source is removed.
+
+    :param target: Path to the .npy file
+    :type target: str
+    :param source: Path to the file with count values of dtype
+    :type source: str
+    :param dtype: Type of the values
+    :type dtype: Any
+    :param count: Number of values
+    :type count: int
+    :rtype: None
+    """
+    with open(target, "wb") as out, open(source, "rb") as raw:
+        np.lib.format.write_array_header_1_0(out, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                   "fortran_order": False, "shape": (count,)})
+        shutil.copyfileobj(raw, out, HASH_CHUNK_SIZE)
+    os.remove(source)
+
+
+class Snapshot:
+    """Columns of one source file: fixed-width int64 arrays and string columns as a UTF-8 blob + offsets
+
+    The arrays are memory-mapped (np.load with mmap_mode="r"), so opening a snapshot costs a few
+    milliseconds and the pages are shared by every process reading the same snapshot.
+    """
+
+    def __init__(self, path: str, meta: Dict[str, Any]) -> None:
+        """Open the snapshot files of the folder.
+
+        :param path: Folder of the snapshot
+        :type path: str
+        :param meta: Content of meta.json
+        :type meta: Dict[str, Any]
+        :rtype: None
+        """
+        self.path = path
+        self.count = meta["count"]
+        self.kinds: Dict[str, str] = dict(meta["columns"])
+        self.arrays: Dict[str, "np.ndarray"] = {}
+        for name, kind in self.kinds.items():
+            if kind == "int":
+                self.arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            else:
+                self.arrays[f"{name}.blob"] = np.load(os.path.join(path, f"{name}.blob.npy"), mmap_mode="r")
+                self.arrays[f"{name}.offsets"] = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+
+    def column(self, name: str) -> "np.ndarray":
+        """Integer column as a memory-mapped int64 array.
+
+        :param name: Column name
+        :type name: str
+        :rtype: np.ndarray
+        """
+        return self.arrays[name]
+
+    def prefix(self, name: str, width: int) -> "np.ndarray":
+        """First width bytes of every value of a string column as an (count, width) uint8 array.
+
+        Used to decode fixed-format values (dates, one letter codes) without building Python strings.
+
+        :param name: Column name
+        :type name: str
+        :param width: Number of bytes, every value must be at least that long
+        :type width: int
+        :rtype: np.ndarray
+        """
+        blob, offsets = self.arrays[f"{name}.blob"], self.arrays[f"{name}.offsets"]
+        return blob[offsets[:-1, None] + np.arange(width)]
+
+    def strings(self, name: str, start: int = 0, stop: Optional[int] = None) -> List[str]:
+        """Values start..stop of a string column decoded into Python strings.
+
+        :param name: Column name
+        :type name: str
+        :param start: First record
+        :type start: int
+        :param stop: Record after the last one, None - till the end
+        :type stop: Optional[int]
+        :rtype: List[str]
+        """
+        blob, offsets = self.arrays[f"{name}.blob"], self.arrays[f"{name}.offsets"]
+        bounds = offsets[start:(self.count if stop is None else stop) + 1].tolist()
+        data = blob[bounds[0]:bounds[-1]].tobytes()
+        return [data[begin - bounds[0]:end - bounds[0]].decode() for begin, end in zip(bounds, bounds[1:])]
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """Yield the records as dicts, the same as JSONFile.iter_records of the source file.
+
+        Only RECORDS_CHUNK_SIZE records are converted into Python objects at a time.
+
+        :rtype: Iterator[Dict[str, Any]]
+        """
+        for start in range(0, self.count, RECORDS_CHUNK_SIZE):
+            stop = min(start + RECORDS_CHUNK_SIZE, self.count)
+            values = [self.column(name)[start:stop].tolist() if kind == "int" else self.strings(name, start, stop)
+                      for name, kind in self.kinds.items()]
+            for row in zip(*values):
+                yield dict(zip(self.kinds, row))
+
+
+class ColumnarCache:
+    """Class for reading source files through binary columnar snapshots instead of parsing JSON
+
+    A snapshot is built on the first read of a file (one full parse) and reused while the size and
+    mtime of the file are unchanged; if only the mtime changed, the content hash decides. The
+    iter_records / iter_batches methods have the same signature as the JSONFile ones.
+    """
+
+    def __init__(self, cache_path: str = SNAPSHOT_PATH) -> None:
+        """Initialize the ColumnarCache object.
+
+        :param cache_path: Folder of the snapshots
+        :type cache_path: str
+        :rtype: None
+        """
+        if np is None:
+            raise ImportError("numpy is required for the columnar snapshots (pip install numpy)")
+        self.cache_path = cache_path
+
+    def snapshot_path(self, file_path: str) -> str:
+        """Folder of the snapshot of a source file: <file name>-<hash of the absolute path>.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :rtype: str
+        """
+        path_hash = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:12]
+        return os.path.join(self.cache_path, f"{os.path.basename(file_path)}-{path_hash}")
+
+    def open(self, file_path: str) -> Optional[Snapshot]:
+        """Memory-map the snapshot of a source file, building it first if it is missing or stale.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :return: Snapshot, None if the file cannot be stored in columns (mixed types, missing keys)
+        :rtype: Optional[Snapshot]
+        """
+        path = self.snapshot_path(file_path)
+        stat = os.stat(file_path)
+        meta_file = os.path.join(path, META_FILE)
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta["size"] == stat.st_size:
+                if meta["mtime_ns"] != stat.st_mtime_ns and meta["sha256"] == file_hash(file_path):
+                    # touched but not changed, the snapshot stays valid
+                    meta["mtime_ns"] = stat.st_mtime_ns
+                    self._write_meta(path, meta)
+                if meta["mtime_ns"] == stat.st_mtime_ns:
+                    with metrics.phase("snapshot", file=os.path.basename(file_path)) as phase:
+                        snapshot = Snapshot(path, meta)
+                        phase.rows, phase.bytes = snapshot.count, stat.st_size
+                    logging.info(f"-- Snapshot of {file_path} memory-mapped from {path}")
+                    return snapshot
+        return self.build(file_path)
+
+    def build(self, file_path: str) -> Optional[Snapshot]:
+        """Parse the source file once and write its columns into the snapshot folder.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :return: Snapshot, None if the file cannot be stored in columns
+        :rtype: Optional[Snapshot]
+        """
+        started = time.perf_counter()
+        stat = os.stat(file_path)
+        sha256 = file_hash(file_path)
+
+        # written into a temporary folder and renamed, readers never see a half written snapshot
+        path = self.snapshot_path(file_path)
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(temporary_path, exist_ok=True)
+        try:
+            layout = self._write_columns(file_path, temporary_path)
+        except BaseException:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            raise
+        if layout is None:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            return None
+        count, columns = layout
+
+        meta = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256,
+                "count": count, "columns": list(columns.items())}
+        self._write_meta(temporary_path, meta)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(temporary_path, path)
+
+        logging.info(f"-- Snapshot of {file_path} ({count} records) created in {time.perf_counter() - started:.2f}s")
+        return Snapshot(path, meta)
+
+    @staticmethod
+    def _write_columns(file_path: str, path: str) -> Optional[Tuple[int, Dict[str, str]]]:
+        """Write the columns of the source file into the folder, BUILD_CHUNK_SIZE records at a time.
+
+        Every chunk is appended to files of raw values, which become .npy files at the end, so memory
+        usage does not depend on the size of the file.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :param path: Folder the column files are written into
+        :type path: str
+        :return: Number of records and the kind ("int" or "str") of every column, None if the file
+            cannot be stored in columns
+        :rtype: Optional[Tuple[int, Dict[str, str]]]
+        """
+        kinds: Dict[str, str] = {}
+        files: Dict[str, Any] = {}
+        lengths: Dict[str, int] = {}  # bytes written into the blob of every string column
+        count = 0
+        records = JSONFile.iter_records(file_path)
+        try:
+            while True:
+                chunk = list(islice(records, BUILD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                if not count and isinstance(chunk[0], dict):
+                    # the first record decides the layout, every other one must match it
+                    kinds = {name: {int: "int", str: "str"}.get(type(value), "") for name, value in chunk[0].items()}
+                    for name, kind in kinds.items():
+                        if kind == "int":
+                            files[name] = open(os.path.join(path, f"{name}.raw"), "wb")
+                        elif kind == "str":
+                            files[f"{name}.blob"] = open(os.path.join(path, f"{name}.blob.raw"), "wb")
+                            files[f"{name}.offsets"] = open(os.path.join(path, f"{name}.offsets.raw"), "wb")
+                            np.zeros(1, dtype=np.int64).tofile(files[f"{name}.offsets"])
+                            lengths[name] = 0
+                if any(not isinstance(record, dict) or record.keys() != kinds.keys() for record in chunk):
+                    logging.error(f"-- {file_path} has records with different keys, snapshot not created")
+                    return None
+
+                for name, kind in kinds.items():
+                    column = [record[name] for record in chunk]
+                    if kind == "int" and all(type(value) is int for value in column):
+                        np.array(column, dtype=np.int64).tofile(files[name])
+                    elif kind == "str" and all(type(value) is str for value in column):
+                        encoded = [value.encode() for value in column]
+                        offsets = np.cumsum([len(value) for value in encoded], dtype=np.int64) + lengths[name]
+                        files[f"{name}.blob"].write(b"".join(encoded))
+                        offsets.tofile(files[f"{name}.offsets"])
+                        lengths[name] = int(offsets[-1])
+                    else:
+                        logging.error(f"-- Column {name} of {file_path} is neither integer nor string, "
+                                      f"snapshot not created")
+                        return None
+                count += len(chunk)
+        finally:
+            for f in files.values():
+                f.close()
+
+        for name, kind in kinds.items():
+            if kind == "int":
+                _write_npy(os.path.join(path, f"{name}.npy"), os.path.join(path, f"{name}.raw"), np.int64, count)
+            else:
+                _write_npy(os.path.join(path, f"{name}.blob.npy"), os.path.join(path, f"{name}.blob.raw"),
+                           np.uint8, lengths[name])
+                _write_npy(os.path.join(path, f"{name}.offsets.npy"), os.path.join(path, f"{name}.offsets.raw"),
+                           np.int64, count + 1)
+        return count, kinds
+
+    @staticmethod
+    def _write_meta(path: str, meta: Dict[str, Any]) -> None:
+        """Write meta.json of a snapshot atomically.
+
+        :param path: Folder of the snapshot
+        :type path: str
+        :param meta: Source file identity and column layout
+        :type meta: Dict[str, Any]
+        :rtype: None
+        """
+        temporary_file = os.path.join(path, f"{META_FILE}.tmp-{os.getpid()}")
+        with open(temporary_file, "w") as f:
+            json.dump(meta, f)
+        os.replace(temporary_file, os.path.join(path, META_FILE))
+
+    def iter_records(self, file_path: str) -> Iterator[Any]:
+        """Yield the records of a source file from its snapshot (falls back to JSON parsing).
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :rtype: Iterator[Any]
+        """
+        snapshot = self.open(file_path)
+        if snapshot is None:
+            return JSONFile.iter_records(file_path)
+        return snapshot.records()
+
+    def iter_batches(self, file_path: str, batch_size: int) -> Iterator[List[Any]]:
+        """Yield the records of a source file in lists of batch_size records.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :param batch_size: Number of records in one batch
+        :type batch_size: int
+        :rtype: Iterator[List[Any]]
+        """
+        records = self.iter_records(file_path)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                return
+            yield batch
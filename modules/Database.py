@@ -1,40 +1,243 @@
+import csv
+import io
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Optional, Sequence
+
 import psycopg2
-from psycopg2 import Error
+from psycopg2 import Error, InterfaceError, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR, connection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import logging
 
+from config.config import POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_CONNECT_ATTEMPTS
+from modules.Metrics import metrics
+
 logger = logging.getLogger('database')
 
+# schema of sql-task.sql without indexes, for databases created by the program (benchmarks, shards)
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS room (
+        id SERIAL NOT NULL PRIMARY KEY,
+        name VARCHAR (10)
+    );
+    CREATE TABLE IF NOT EXISTS student (
+        id SERIAL NOT NULL PRIMARY KEY,
+        birthday TIMESTAMP NOT NULL,
+        "name" VARCHAR (20) NOT NULL,
+        room INTEGER NOT NULL REFERENCES room(id),
+        sex CHAR NOT NULL CHECK (sex IN ('F', 'M'))
+    );
+    """
+
+
+def admin_execute(config: dict, query: str) -> Any:
+    """Execute a statement on the maintenance database "postgres" in autocommit mode.
+
+    :param config: Configuration for the database connection
+    :type config: dict
+    :param query: SQL statement
+    :type query: str
+    :return: Rows of the statement (None if it returns no rows)
+    :rtype: Any
+    """
+    connection = psycopg2.connect(user=config["DB_USERNAME"], password=config["DB_PASSWORD"],
+                                  host=config["DB_HOST"], port=config["DB_PORT"], database="postgres")
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            return cursor.fetchall() if cursor.description else None
+    finally:
+        connection.close()
+
+
+class _CopyNull(int):
+    """NULL marker of copy_records, a number, so csv.QUOTE_NONNUMERIC writes it as an unquoted \\N"""
+
+    def __str__(self) -> str:
+        return "\\N"
+
+
+COPY_NULL = _CopyNull()
+
+
+def _batches(records: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    """Split an iterable of records into lists of at most batch_size records.
+
+    :param records: Records to be split
+    :type records: Iterable[dict]
+    :param batch_size: Maximal number of records in one batch
+    :type batch_size: int
+    :rtype: Iterator[List[dict]]
+    """
+    iterator = iter(records)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class PreparedConnection(connection):
+    """psycopg2 connection which remembers the statements PREPAREd in its session"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class IdleConnectionPool(ThreadedConnectionPool):
+    """Thread-safe pool which keeps returned connections open up to maxconn
+
+    ThreadedConnectionPool closes every connection given back while minconn connections are idle,
+    so with a small minconn each session would open a new backend (and lose its prepared statements).
+    Here minconn connections are opened up front and a returned connection is kept while fewer than
+    maxconn are idle.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, *args, **kwargs) -> None:
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.minconn = maxconn  # the limit of idle connections checked by putconn
+
 
 class Database:
-    """Making class for connection and basic DB operations"""
+    """Making class for connection and basic DB operations
+
+    Connections are taken from a pool. connect() checks out the main connection (self.connection,
+    self.cursor) and session() hands out additional pooled connections wrapped into Database objects,
+    so every method of this class works the same way inside a session.
+    """
 
-    def __init__(self, config: dict) -> None:
+    def __init__(self, config: dict, min_connections: Optional[int] = None,
+                 max_connections: Optional[int] = None) -> None:
         """Initialize the Database object.
 
         :param config: Configuration for the database connection
         :type config: dict
+        :param min_connections: Number of connections opened with the pool
+        :type min_connections: Optional[int]
+        :param max_connections: Maximal number of connections in the pool, returned ones are kept open
+        :type max_connections: Optional[int]
         :rtype: None
         """
 
         self.config = config
+        self.min_connections = min_connections or int(config.get("DB_POOL_MIN") or POOL_MIN_SIZE)
+        self.max_connections = max(max_connections or int(config.get("DB_POOL_MAX") or POOL_MAX_SIZE),
+                                   self.min_connections)
+        self.pool = None
         self.connection = None
         self.cursor = None
 
-    def connect(self) -> None:
-        """Make a connection to the database.
+    def connect(self, raise_error: bool = False) -> bool:
+        """Create the connection pool and check out the main connection.
 
-        :rtype: None
+        A failed connection is logged and leaves the object unconnected (pool, connection and cursor are None).
+
+        :param raise_error: Re-raise the connection error instead of returning False
+        :type raise_error: bool
+        :return: True if connected
+        :rtype: bool
+        :raises Error: If the connection failed and raise_error is set
         """
         try:
-            self.connection = psycopg2.connect(user=self.config["DB_USERNAME"],
+            self.pool = IdleConnectionPool(self.min_connections, self.max_connections,
+                                               user=self.config["DB_USERNAME"],
                                                password=self.config["DB_PASSWORD"],
                                                host=self.config["DB_HOST"],
                                                port=self.config["DB_PORT"],
-                                               database=self.config["DB_DATABASE"])
+                                               database=self.config["DB_DATABASE"],
+                                               connection_factory=PreparedConnection)
+            self.connection = self._acquire()
             self.cursor = self.connection.cursor()  # initializing cursor
             logging.info("-- Connected to database...")
+            return True
         except Error as e:
             logging.error(f"-- Failed to connect to database: {e}")
+            if self.pool is not None:
+                self.pool.closeall()
+            self.pool = self.connection = self.cursor = None
+            if raise_error:
+                raise
+            return False
+
+    @staticmethod
+    def _is_alive(connection: Any) -> bool:
+        """Health check of a connection (closed flag + round trip with SELECT 1).
+
+        :param connection: psycopg2 connection
+        :type connection: Any
+        :rtype: bool
+        """
+        if connection.closed:
+            return False
+        status = connection.get_transaction_status()
+        if status == TRANSACTION_STATUS_INERROR:
+            return True  # the server answered with an error, so the connection itself works
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            if status == TRANSACTION_STATUS_IDLE:
+                connection.rollback()  # do not leave the health check transaction open
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def _acquire(self) -> Any:
+        """Take a healthy connection from the pool, broken ones are dropped and replaced.
+
+        :return: psycopg2 connection
+        :rtype: Any
+        :raises OperationalError: If no healthy connection was obtained
+        """
+        for _ in range(POOL_CONNECT_ATTEMPTS):
+            connection = self.pool.getconn()
+            if self._is_alive(connection):
+                return connection
+            logging.warning("-- Broken connection dropped from the pool, reconnecting...")
+            self.pool.putconn(connection, close=True)
+        raise OperationalError(f"no healthy connection after {POOL_CONNECT_ATTEMPTS} attempts")
+
+    def reconnect(self) -> None:
+        """Replace the main connection if it is broken.
+
+        :rtype: None
+        """
+        if self.connection is not None and self._is_alive(self.connection):
+            return
+        if self.connection is not None:
+            self.pool.putconn(self.connection, close=True)
+        self.connection = self._acquire()
+        self.cursor = self.connection.cursor()
+        logging.info("-- Reconnected to database")
+
+    @contextmanager
+    def session(self) -> Iterator["Database"]:
+        """Check out a pooled connection for the duration of the with-block.
+
+        The transaction is committed when the block ends normally and rolled back on exception,
+        the connection goes back to the pool (closed if it got broken).
+
+        :return: Database object bound to the checked out connection
+        :rtype: Iterator[Database]
+        """
+        session = Database(self.config, self.min_connections, self.max_connections)
+        session.pool = self.pool
+        session.connection = self._acquire()
+        session.cursor = session.connection.cursor()
+        try:
+            yield session
+            session.connection.commit()
+        except Exception:
+            if not session.connection.closed:
+                session.connection.rollback()
+            raise
+        finally:
+            if not session.cursor.closed:
+                session.cursor.close()
+            self.pool.putconn(session.connection, close=bool(session.connection.closed))
 
     def execute_query(self, query: str) -> None:
         """Execute a query on the database.
@@ -45,6 +248,113 @@ class Database:
         """
         self.cursor.execute(query)
 
+    def execute_file(self, file_path: str) -> None:
+        """Execute all statements of an SQL file.
+
+        :param file_path: Path to the SQL file
+        :type file_path: str
+        :rtype: None
+        """
+        with open(file_path, "r") as f:
+            self.cursor.execute(f.read())
+
+    def fetch_all(self, query: str) -> List[tuple]:
+        """Execute a query and return all rows of the result.
+
+        :param query: SQL query to be executed
+        :type query: str
+        :return: Rows of the result
+        :rtype: List[tuple]
+        """
+        self.cursor.execute(query)
+        return self.cursor.fetchall()
+
+    def copy_records(self, table: str, columns: Sequence[str], records: List[dict]) -> None:
+        """Send one batch of records to the table with COPY ... FROM STDIN.
+
+        Records are serialized as CSV into an in-memory buffer, so quoting of names
+        with apostrophes or commas is done by the csv module and not by hand. Strings are
+        always quoted and None is written as an unquoted \\N, so an empty name stays an
+        empty string (as with insert_records) instead of becoming NULL.
+
+        :param table: Name of the target table
+        :type table: str
+        :param columns: Names of the columns to be filled, in the order of the COPY statement
+        :type columns: Sequence[str]
+        :param records: Batch of records (dicts with keys = columns)
+        :type records: List[dict]
+        :rtype: None
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerows([COPY_NULL if (value := record[column]) is None else value for column in columns]
+                         for record in records)
+        buffer.seek(0)
+
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        self.cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+    def insert_records(self, table: str, columns: Sequence[str], records: List[dict]) -> None:
+        """Send one batch of records to the table with a single multi-row INSERT.
+
+        :param table: Name of the target table
+        :type table: str
+        :param columns: Names of the columns to be filled
+        :type columns: Sequence[str]
+        :param records: Batch of records (dicts with keys = columns)
+        :type records: List[dict]
+        :rtype: None
+        """
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        execute_values(self.cursor,
+                       f"INSERT INTO {table} ({column_list}) VALUES %s",
+                       [tuple(record[column] for column in columns) for record in records],
+                       page_size=len(records))
+
+    def bulk_load(self, table: str, columns: Sequence[str], records: Iterable[dict],
+                  batch_size: int, method: str = "copy") -> int:
+        """Load records into the table batch by batch (without commit).
+
+        :param table: Name of the target table
+        :type table: str
+        :param columns: Names of the columns to be filled
+        :type columns: Sequence[str]
+        :param records: Records to be loaded, any iterable (list or generator)
+        :type records: Iterable[dict]
+        :param batch_size: Number of records sent in one statement
+        :type batch_size: int
+        :param method: "copy" for COPY FROM STDIN or "insert" for multi-row INSERT fallback
+        :type method: str
+        :return: Number of loaded rows
+        :rtype: int
+        """
+        load_batch = self.copy_records if method == "copy" else self.insert_records
+
+        with metrics.phase("load", table=table, method=method) as phase:
+            for batch in _batches(records, batch_size):
+                load_batch(table, columns, batch)
+                phase.rows += len(batch)
+
+        logging.info(f"-- {phase.rows} rows loaded into {table} with {method} in {phase.seconds:.2f}s "
+                     f"({phase.rows_per_second:.0f} rows/sec)")
+        return phase.rows
+
+    def execute_maintenance(self, query: str) -> None:
+        """Execute a statement which cannot run inside a transaction block (VACUUM, CREATE INDEX CONCURRENTLY).
+
+        The current transaction is committed first.
+
+        :param query: SQL statement to be executed
+        :type query: str
+        :rtype: None
+        """
+        self.connection.commit()
+        self.connection.autocommit = True
+        try:
+            self.cursor.execute(query)
+        finally:
+            self.connection.autocommit = False
+
     def commit(self) -> None:
         """Commit the changes made to the database.
 
@@ -52,11 +362,26 @@ class Database:
         """
         self.connection.commit()
 
+    def rollback(self) -> None:
+        """Roll back the current transaction.
+
+        :rtype: None
+        """
+        self.connection.rollback()
+
     def close(self) -> None:
-        """Close the cursor and the database connection.
+        """Close the cursor, return the main connection and close every connection of the pool.
+
+        Does nothing if the object is not connected (connect() failed or close() was already called).
 
         :rtype: None
         """
-        self.cursor.close()
-        self.connection.close()
+        if self.pool is None:
+            return
+        if self.cursor is not None and not self.cursor.closed:
+            self.cursor.close()
+        if self.connection is not None:
+            self.pool.putconn(self.connection)
+        self.pool.closeall()
+        self.pool = self.connection = self.cursor = None
         logging.info("-- DB connection closed")
@@ -0,0 +1,124 @@
+import logging
+import time
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from modules.Database import Database
+
+
+logger = logging.getLogger('incremental_loader')
+
+
+class IncrementalLoader:
+    """Class for idempotent re-loading: only inserted, changed and removed records touch the tables
+
+    Every source file is bulk loaded into a temporary staging table first, then the staging table
+    is diffed against the target table: new and changed rows are applied with INSERT ... ON CONFLICT,
+    rows missing from the source are deleted. Unchanged rows are not rewritten at all.
+    """
+
+    def __init__(self, database: Database, batch_size: int, method: str = "copy", key: str = "id") -> None:
+        """Initialize the IncrementalLoader object.
+
+        :param database: Database connection, the whole load runs in its current transaction
+        :type database: Database
+        :param batch_size: Number of records sent to the staging table in one statement
+        :type batch_size: int
+        :param method: Bulk load method, "copy" or "insert"
+        :type method: str
+        :param key: Primary key column of the loaded tables
+        :type key: str
+        :rtype: None
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.method = method
+        self.key = key
+
+    def stage(self, table: str, columns: Sequence[str], records: Iterable[dict]) -> int:
+        """Load records into the temporary table stage_<table> (dropped on commit).
+
+        :param table: Name of the target table
+        :type table: str
+        :param columns: Names of the loaded columns
+        :type columns: Sequence[str]
+        :param records: Records of the source file
+        :type records: Iterable[dict]
+        :return: Number of staged rows
+        :rtype: int
+        """
+        self.database.execute_query(f"CREATE TEMP TABLE stage_{table} (LIKE {table}) ON COMMIT DROP")
+        rows = self.database.bulk_load(f"stage_{table}", columns, records, self.batch_size, self.method)
+        self.database.execute_query(f"ANALYZE stage_{table}")  # the planner needs statistics for the diff
+        return rows
+
+    def upsert(self, table: str, columns: Sequence[str]) -> Tuple[int, int]:
+        """Insert new and update changed rows of the table from its staging table.
+
+        :param table: Name of the target table
+        :type table: str
+        :param columns: Names of the compared and updated columns
+        :type columns: Sequence[str]
+        :return: Number of inserted and number of updated rows
+        :rtype: Tuple[int, int]
+        """
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        values = [f'"{column}"' for column in columns if column != self.key]
+        assignments = ", ".join(f"{value} = EXCLUDED.{value}" for value in values)
+        changed = f"({', '.join(f'{table}.{value}' for value in values)}) IS DISTINCT FROM " \
+                  f"({', '.join(f'EXCLUDED.{value}' for value in values)})"
+
+        # xmax = 0 only for freshly inserted row versions, so inserts and updates are counted separately
+        self.database.execute_query(f"""
+            WITH changes AS (
+                INSERT INTO {table} ({column_list})
+                SELECT {column_list} FROM stage_{table}
+                ON CONFLICT ({self.key}) DO UPDATE SET {assignments}
+                WHERE {changed}
+                RETURNING (xmax = 0) AS inserted
+            )
+            SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM changes
+            """)
+        inserted, updated = self.database.cursor.fetchone()
+        return inserted, updated
+
+    def delete_missing(self, table: str) -> int:
+        """Delete rows of the table which are absent in its staging table.
+
+        :param table: Name of the target table
+        :type table: str
+        :return: Number of deleted rows
+        :rtype: int
+        """
+        self.database.execute_query(f"""
+            DELETE FROM {table}
+            WHERE NOT EXISTS (SELECT 1 FROM stage_{table} WHERE stage_{table}.{self.key} = {table}.{self.key})
+            """)
+        return self.database.cursor.rowcount
+
+    def load(self, tables: List[Tuple[str, Sequence[str], Iterable[dict]]]) -> Dict[str, Dict[str, int]]:
+        """Apply the source files to the tables (without commit).
+
+        Tables must be listed parents first: upserts run in this order and deletes in the reverse
+        one, so foreign keys hold at every step.
+
+        :param tables: (table, columns, records) for every table, parents first
+        :type tables: List[Tuple[str, Sequence[str], Iterable[dict]]]
+        :return: Counts of inserted, updated and deleted rows per table
+        :rtype: Dict[str, Dict[str, int]]
+        """
+        started = time.perf_counter()
+        for table, columns, records in tables:
+            self.stage(table, columns, records)
+
+        stats = {}
+        for table, columns, _ in tables:
+            inserted, updated = self.upsert(table, columns)
+            stats[table] = {"inserted": inserted, "updated": updated}
+        for table, _, _ in reversed(tables):
+            stats[table]["deleted"] = self.delete_missing(table)
+
+        for table, counts in stats.items():
+            logging.info(f"-- {table}: {counts['inserted']} inserted, {counts['updated']} updated, "
+                         f"{counts['deleted']} deleted")
+        logging.info(f"-- Incremental load done in {time.perf_counter() - started:.2f}s")
+        return stats
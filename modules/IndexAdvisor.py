@@ -0,0 +1,345 @@
+import logging
+import re
+import time
+from typing import Dict, List, Tuple
+
+from psycopg2 import Error
+
+from config.config import ADVISOR_MIN_ROWS, ADVISOR_RUNS, ADVISOR_OUTPUT_FILE
+from modules.Database import Database
+
+
+logger = logging.getLogger('index_advisor')
+
+# alias.column references inside plan expressions (EXPLAIN VERBOSE qualifies every column)
+COLUMN_REFERENCE = re.compile(r'"?([A-Za-z_]\w*)"?\."?([A-Za-z_]\w*)"?')
+
+# a bare alias.column item of a Sort Key / Group Key, optionally parenthesized and cast
+PLAIN_REFERENCE = re.compile(r'\(*"?([A-Za-z_]\w*)"?\."?([A-Za-z_]\w*)"?\)*(?:::[\w ]+)?(?: DESC| ASC)?')
+
+# plan node fields whose columns decide the order an index should deliver (joins, grouping, sorting)
+KEY_FIELDS = ("Hash Cond", "Merge Cond", "Join Filter", "Group Key", "Sort Key")
+
+# key fields whose items are whole expressions: only bare columns can be delivered by an index,
+# a sort on avg(student.birth_ymd) says nothing about the order of student.birth_ymd
+ORDER_FIELDS = ("Group Key", "Sort Key")
+
+# key columns + included columns of every existing index of the given tables
+EXISTING_INDEXES_QUERY = """
+    SELECT t.relname, ARRAY_AGG(a.attname::TEXT ORDER BY k.ord)
+    FROM pg_index i
+        INNER JOIN pg_class t ON t.oid = i.indrelid
+        INNER JOIN pg_namespace n ON n.oid = t.relnamespace
+        INNER JOIN LATERAL UNNEST(i.indkey) WITH ORDINALITY AS k(attnum, ord) ON true
+        INNER JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+    WHERE n.nspname = 'public' AND t.relname = ANY(%s)
+    GROUP BY i.indexrelid, t.relname
+    """
+
+
+class IndexCandidate:
+    """Index proposed for a table: key columns (join / group / filter order) and covering INCLUDE columns"""
+
+    def __init__(self, table: str, columns: List[str], include: List[str], reasons: List[str]) -> None:
+        """Initialize the IndexCandidate object.
+
+        :param table: Name of the table
+        :type table: str
+        :param columns: Key columns of the index
+        :type columns: List[str]
+        :param include: Non-key columns stored in the index for index-only scans
+        :type include: List[str]
+        :param reasons: Plan findings the index is expected to remove
+        :type reasons: List[str]
+        :rtype: None
+        """
+        self.table = table
+        self.columns = columns
+        self.include = [column for column in include if column not in columns]
+        self.reasons = reasons
+
+    @property
+    def name(self) -> str:
+        """Name of the index, idx_<table>_<key columns>.
+
+        :rtype: str
+        """
+        return f"idx_{self.table}_{'_'.join(self.columns)}"
+
+    def sql(self) -> str:
+        """CREATE INDEX statement for the candidate.
+
+        :rtype: str
+        """
+        columns = ", ".join(f'"{column}"' for column in self.columns)
+        statement = f"CREATE INDEX IF NOT EXISTS {self.name} ON public.{self.table}({columns})"
+        if self.include:
+            include = ", ".join(f'"{column}"' for column in self.include)
+            statement += f" INCLUDE ({include})"
+        return statement
+
+    def merge(self, other: "IndexCandidate") -> None:
+        """Absorb another candidate of the same table with the same leading column.
+
+        :param other: Another candidate
+        :type other: IndexCandidate
+        :rtype: None
+        """
+        if len(other.columns) > len(self.columns):
+            self.columns = other.columns
+        self.include = [column for column in dict.fromkeys(self.include + other.include)
+                        if column not in self.columns]
+        self.reasons += [reason for reason in other.reasons if reason not in self.reasons]
+
+
+def explain(database: Database, query: str) -> dict:
+    """Run EXPLAIN (ANALYZE, BUFFERS, VERBOSE, FORMAT JSON) for the query.
+
+    :param database: Database connection
+    :type database: Database
+    :param query: SQL query
+    :type query: str
+    :return: Explain output: {"Plan": {...}, "Execution Time": ..., ...}
+    :rtype: dict
+    """
+    database.execute_query(f"EXPLAIN (ANALYZE, BUFFERS, VERBOSE, FORMAT JSON) {query.strip().rstrip(';')}")
+    return database.cursor.fetchone()[0][0]
+
+
+def _nodes(plan: dict) -> List[dict]:
+    """Flatten the plan tree into a list of nodes.
+
+    :param plan: Plan node
+    :type plan: dict
+    :rtype: List[dict]
+    """
+    nodes = [plan]
+    for child in plan.get("Plans", []):
+        nodes += _nodes(child)
+    return nodes
+
+
+def _references(value: object, alias: str) -> List[str]:
+    """Columns of the alias referenced in a plan field (string or list of strings), in order.
+
+    :param value: Plan field value
+    :type value: object
+    :param alias: Alias of the scanned relation
+    :type alias: str
+    :rtype: List[str]
+    """
+    texts = value if isinstance(value, list) else [value or ""]
+    columns = [column for text in texts for found_alias, column in COLUMN_REFERENCE.findall(text)
+               if found_alias == alias]
+    return list(dict.fromkeys(columns))
+
+
+def _plain_references(value: object, alias: str) -> List[str]:
+    """Columns of the alias that are whole items of a Sort Key / Group Key list, in order.
+
+    :param value: Plan field value
+    :type value: object
+    :param alias: Alias of the scanned relation
+    :type alias: str
+    :rtype: List[str]
+    """
+    columns = []
+    for text in value or []:
+        match = PLAIN_REFERENCE.fullmatch(text.strip())
+        if match and match.group(1) == alias:
+            columns.append(match.group(2))
+    return list(dict.fromkeys(columns))
+
+
+def analyze_plan(name: str, plan: dict, min_rows: int = ADVISOR_MIN_ROWS) -> Tuple[List[str], List[IndexCandidate]]:
+    """Find sequential scans, sorts and hash aggregates in a plan and propose indexes for them.
+
+    For every large sequentially scanned table the index key is made of its columns used by joins,
+    grouping and sorting above the scan, followed by its filter columns; the remaining columns
+    used by the other plan nodes are included so the scan can become index-only.
+
+    :param name: Report name (used in findings)
+    :type name: str
+    :param plan: Explain output of the report query
+    :type plan: dict
+    :param min_rows: Tables with fewer rows are skipped
+    :type min_rows: int
+    :return: Findings and index candidates
+    :rtype: Tuple[List[str], List[IndexCandidate]]
+    """
+    nodes = _nodes(plan["Plan"])
+    findings = []
+    for node in nodes:
+        if node["Node Type"] == "Sort":
+            findings.append(f"{name}: Sort on {', '.join(node.get('Sort Key', []))} ({node.get('Sort Method', '')})")
+        elif node["Node Type"] == "Aggregate" and node.get("Strategy") == "Hashed":
+            findings.append(f"{name}: HashAggregate on {', '.join(node.get('Group Key', []))}")
+
+    candidates = []
+    for node in nodes:
+        if node["Node Type"] != "Seq Scan":
+            continue
+        table, alias = node["Relation Name"], node.get("Alias", node["Relation Name"])
+        rows = node.get("Actual Rows", node.get("Plan Rows", 0)) * node.get("Actual Loops", 1)
+        findings.append(f"{name}: Seq Scan on {table} ({rows} rows)")
+        if rows < min_rows:
+            continue
+
+        keys, used = [], []
+        for other in nodes:
+            for field in KEY_FIELDS:
+                if field in ORDER_FIELDS:
+                    keys += _plain_references(other.get(field), alias)
+                else:
+                    keys += _references(other.get(field), alias)
+            # a Seq Scan outputs the whole physical tuple, the columns really needed are the ones above it
+            if other is not node:
+                used += _references(other.get("Output"), alias)
+        filters = _references(node.get("Filter"), alias)
+        columns = list(dict.fromkeys(keys + filters))
+        if not columns:
+            continue  # the whole table is needed in no particular order, an index would not help
+
+        reasons = [f"{name}: Seq Scan on {table}"]
+        candidates.append(IndexCandidate(table, columns, list(dict.fromkeys(used)), reasons))
+    return findings, candidates
+
+
+class IndexAdvisor:
+    """Class for recommending indexes from the plans of the report queries"""
+
+    def __init__(self, database: Database, reports: Dict[str, str], runs: int = ADVISOR_RUNS,
+                 min_rows: int = ADVISOR_MIN_ROWS) -> None:
+        """Initialize the IndexAdvisor object.
+
+        :param database: Database connection
+        :type database: Database
+        :param reports: Report names mapped to their SQL queries
+        :type reports: Dict[str, str]
+        :param runs: Number of timed runs per query
+        :type runs: int
+        :param min_rows: Tables with fewer rows are not indexed
+        :type min_rows: int
+        :rtype: None
+        """
+        self.database = database
+        self.reports = reports
+        self.runs = runs
+        self.min_rows = min_rows
+
+    def measure(self) -> Dict[str, float]:
+        """Average execution time of every report in milliseconds (from EXPLAIN ANALYZE).
+
+        :rtype: Dict[str, float]
+        """
+        return {name: sum(explain(self.database, query)["Execution Time"] for _ in range(self.runs)) / self.runs
+                for name, query in self.reports.items()}
+
+    def recommend(self) -> Tuple[List[str], List[IndexCandidate]]:
+        """Explain every report and merge the index candidates per table.
+
+        :return: Plan findings and recommended indexes (existing indexes are skipped)
+        :rtype: Tuple[List[str], List[IndexCandidate]]
+        """
+        findings = []
+        merged: Dict[Tuple[str, str], IndexCandidate] = {}
+        for name, query in self.reports.items():
+            report_findings, candidates = analyze_plan(name, explain(self.database, query), self.min_rows)
+            findings += report_findings
+            for candidate in candidates:
+                key = (candidate.table, candidate.columns[0])
+                if key in merged:
+                    merged[key].merge(candidate)
+                else:
+                    merged[key] = candidate
+
+        tables = list({candidate.table for candidate in merged.values()})
+        self.database.cursor.execute(EXISTING_INDEXES_QUERY, (tables,))
+        existing = self.database.cursor.fetchall()
+        self.database.rollback()  # nothing to keep from the explain runs
+
+        recommended = []
+        for candidate in merged.values():
+            wanted = candidate.columns + candidate.include
+            covered = any(table == candidate.table and columns[:len(candidate.columns)] == candidate.columns
+                          and set(wanted) <= set(columns) for table, columns in existing)
+            if covered:
+                logging.info(f"-- {candidate.name} skipped, an existing index already covers it")
+            else:
+                recommended.append(candidate)
+        return findings, recommended
+
+    def run(self, output_file: str = ADVISOR_OUTPUT_FILE, apply: bool = False) -> List[IndexCandidate]:
+        """Recommend indexes, measure report latency with and without them and write the SQL file.
+
+        The indexes are created for the measurement and dropped again unless apply is True.
+
+        :param output_file: Name of the SQL file with CREATE INDEX statements
+        :type output_file: str
+        :param apply: Keep the created indexes
+        :type apply: bool
+        :return: Recommended indexes
+        :rtype: List[IndexCandidate]
+        """
+        findings, recommended = self.recommend()
+        for finding in findings:
+            logging.info(f"-- {finding}")
+
+        before = self.measure()
+        created = []
+        after = before
+        try:
+            for candidate in recommended:
+                self.database.execute_query(f"SELECT to_regclass('public.{candidate.name}') IS NULL")
+                if self.database.cursor.fetchone()[0]:
+                    started = time.perf_counter()
+                    self.database.execute_query(candidate.sql())
+                    created.append(candidate)
+                    logging.info(f"-- Index {candidate.name} created in {time.perf_counter() - started:.2f}s")
+            self.database.commit()
+
+            # index-only scans need an up to date visibility map and statistics
+            for table in dict.fromkeys(candidate.table for candidate in created):
+                self.database.execute_maintenance(f"VACUUM ANALYZE public.{table}")
+            after = self.measure()
+        except Error as e:
+            self.database.rollback()
+            logging.error(f"-- Error while measuring recommended indexes {e}")
+        finally:
+            if not apply:
+                for candidate in created:
+                    self.database.execute_query(f"DROP INDEX IF EXISTS public.{candidate.name}")
+                self.database.commit()
+        self.database.rollback()  # closing the transaction of the last explain run
+
+        self.write(output_file, findings, recommended, before, after)
+        return recommended
+
+    @staticmethod
+    def write(output_file: str, findings: List[str], recommended: List[IndexCandidate],
+              before: Dict[str, float], after: Dict[str, float]) -> None:
+        """Write the recommended CREATE INDEX statements with the plan findings and timings as comments.
+
+        :param output_file: Name of the SQL file
+        :type output_file: str
+        :param findings: Plan findings
+        :type findings: List[str]
+        :param recommended: Recommended indexes
+        :type recommended: List[IndexCandidate]
+        :param before: Report latency without the indexes, ms
+        :type before: Dict[str, float]
+        :param after: Report latency with the indexes, ms
+        :type after: Dict[str, float]
+        :rtype: None
+        """
+        with open(output_file, "w") as f:
+            f.write("-- 'indexes recommended by the index advisor from EXPLAIN (ANALYZE, BUFFERS) of the reports'\n\n")
+            for finding in findings:
+                f.write(f"-- {finding}\n")
+            f.write("\n")
+            for name in before:
+                f.write(f"-- {name}: {before[name]:.2f} ms -> {after[name]:.2f} ms\n")
+            f.write("\n")
+            for candidate in recommended:
+                f.write(f"-- {'; '.join(candidate.reasons)}\n{candidate.sql()};\n\n")
+        logging.info(f"-- Recommended indexes saved into {output_file}")
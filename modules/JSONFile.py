@@ -1,9 +1,23 @@
 import json
 import logging
-from typing import Any
+import os
+import time
+from itertools import islice
+from typing import Any, Iterator, List
+
+from modules.Metrics import metrics
 
 logger = logging.getLogger('JSONFile')
 
+# number of characters read from the file at once by the streaming reader
+CHUNK_SIZE = 64 * 1024
+
+# longest item of the array the streaming reader keeps in memory, a longer one is reported as invalid
+MAX_ITEM_SIZE = 1024 * 1024
+
+# characters that may follow a complete number or literal (true, false, null) inside an array
+DELIMITERS = frozenset(",] \t\r\n")
+
 
 class JSONFile:
     """ Making class for reading JSON files, r-attribute means reading only"""
@@ -24,3 +38,132 @@ class JSONFile:
                 return json.load(f)
         except FileNotFoundError as e:
             logging.error(f"-- Error reading JSON file {e}")  # throw error if file not found
+
+    @staticmethod
+    def iter_records(file_path: str, chunk_size: int = CHUNK_SIZE, max_item_size: int = MAX_ITEM_SIZE) -> Iterator[Any]:
+        """Reads a JSON file with a top-level array and yields its items one by one.
+
+        The file is read in chunks and only the not yet parsed tail of the array is kept
+        in memory, so memory usage does not depend on the size of the file.
+
+        Args:
+            file_path: The path to the JSON file.
+            chunk_size: Number of characters read from the file at once.
+            max_item_size: Longest item in characters, a longer (or malformed) one is not read till the end of the file.
+
+        Yields:
+            Items of the top-level array.
+
+        Raises:
+            FileNotFoundError: If the file does not exist, a missing file is not an empty array.
+            json.JSONDecodeError: If the file is not a valid JSON array.
+
+        """
+        decoder = json.JSONDecoder()
+        f = open(file_path, "r")
+
+        # time spent in the parser only, without the time the consumer spends on every item
+        busy = 0.0
+        count = 0
+        resumed = time.perf_counter()
+
+        with f:
+            buffer = ""
+            pos = 0
+            offset = 0  # position of the buffer in the file
+            eof = False
+            expect_item = True  # True - waiting for an item, False - waiting for ',' or ']'
+            after_comma = False  # True if the awaited item must be there, as "[1,]" is not valid JSON
+            started = False  # True after the opening '[' was found
+
+            while True:
+                # skipping whitespaces between tokens
+                while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                    pos += 1
+
+                # reading next chunk if the parsed part was exhausted
+                if pos >= len(buffer):
+                    if eof:
+                        raise json.JSONDecodeError("Unexpected end of JSON array", buffer, pos)
+                    offset += len(buffer)
+                    buffer = f.read(chunk_size)
+                    pos = 0
+                    eof = not buffer
+                    continue
+
+                char = buffer[pos]
+                if not started:
+                    if char != "[":
+                        raise json.JSONDecodeError("Expected top-level JSON array", buffer, pos)
+                    started = True
+                    pos += 1
+                elif char == "]":
+                    if after_comma:
+                        raise json.JSONDecodeError("Expecting value after ','", buffer, pos)
+                    # only whitespaces may follow the array, like in json.load
+                    rest = buffer[pos + 1:]
+                    while rest:
+                        if rest.strip(" \t\r\n"):
+                            raise json.JSONDecodeError("Extra data after JSON array", buffer, pos + 1)
+                        rest = f.read(chunk_size)
+                    busy += time.perf_counter() - resumed
+                    metrics.record("parse", busy, count, os.path.getsize(file_path), file=os.path.basename(file_path))
+                    return
+                elif not expect_item:
+                    if char != ",":
+                        raise json.JSONDecodeError("Expected ',' or ']'", buffer, pos)
+                    expect_item = after_comma = True
+                    pos += 1
+                else:
+                    try:
+                        item, end = decoder.raw_decode(buffer, pos)
+                    except json.JSONDecodeError:
+                        end = None
+                    # a number or literal cut by the chunk border is parsed as a shorter valid one ("1." -> 1),
+                    # it is complete only if a delimiter follows it in the buffer
+                    if end is not None and not eof and char not in "{[\"":
+                        token_end = end
+                        while token_end < len(buffer) and buffer[token_end] not in DELIMITERS:
+                            token_end += 1
+                        if token_end == len(buffer):
+                            end = None
+                    # an item cut by the chunk border (or touching it) needs more data
+                    if end is None or (end == len(buffer) and not eof):
+                        if eof:
+                            raise json.JSONDecodeError(f"Invalid item in JSON array at character {offset + pos}",
+                                                       buffer, pos)
+                        if len(buffer) - pos > max_item_size:
+                            raise json.JSONDecodeError(f"Invalid item in JSON array at character {offset + pos} "
+                                                       f"(or longer than {max_item_size} characters)", buffer, pos)
+                        chunk = f.read(chunk_size)
+                        eof = not chunk
+                        offset += pos
+                        buffer = buffer[pos:] + chunk  # dropping already parsed part
+                        pos = 0
+                        continue
+                    busy += time.perf_counter() - resumed
+                    count += 1
+                    yield item
+                    resumed = time.perf_counter()
+                    pos = end
+                    expect_item = after_comma = False
+
+    @staticmethod
+    def iter_batches(file_path: str, batch_size: int, chunk_size: int = CHUNK_SIZE) -> Iterator[List[Any]]:
+        """Reads a JSON file with a top-level array and yields its items in lists of batch_size.
+
+        Args:
+            file_path: The path to the JSON file.
+            batch_size: Maximal number of items in one batch.
+            chunk_size: Number of characters read from the file at once.
+
+        Yields:
+            Lists of items of the top-level array.
+
+        """
+        records = JSONFile.iter_records(file_path, chunk_size)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                return
+            yield batch
@@ -0,0 +1,347 @@
+import logging
+import os
+import time
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by --engine local
+    np = None
+
+from modules.ColumnarCache import ColumnarCache
+from modules.JSONFile import JSONFile
+from modules.Metrics import counted, metrics
+from modules.Query import export_rows
+from modules.Reports import REPORTS
+
+
+logger = logging.getLogger('local_engine')
+
+
+def _ymd(characters: "np.ndarray") -> "np.ndarray":
+    """Convert ISO birthdays ("2011-08-22T00:00:00.000000") into YYYYMMDD integers without a Python loop.
+
+    :param characters: First 10 bytes of every birthday as a (count, 10) uint8 array
+    :type characters: np.ndarray
+    :return: Array of YYYYMMDD integers, the same values as the column student.birth_ymd
+    :rtype: np.ndarray
+    """
+    digits = characters.astype(np.int64) - ord("0")
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+    return year * 10000 + month * 100 + day
+
+
+def _as_of_ymd(as_of: date) -> int:
+    """As-of date as YYYYMMDD integer.
+
+    :param as_of: Date ages are computed at
+    :type as_of: date
+    :rtype: int
+    """
+    return as_of.year * 10000 + as_of.month * 100 + as_of.day
+
+
+def _full_years(ymd_difference: "np.ndarray") -> "np.ndarray":
+    """Full years from a difference of YYYYMMDD integers, integer division truncates toward zero like in SQL.
+
+    :param ymd_difference: as_of_ymd - birth_ymd
+    :type ymd_difference: np.ndarray
+    :rtype: np.ndarray
+    """
+    return np.sign(ymd_difference) * (np.abs(ymd_difference) // 10000)
+
+
+class RoomAggregates:
+    """Per-room aggregates the four reports are computed from
+
+    Every column can be merged from partial aggregates of disjoint sets of students (sums are
+    added, minimums and maximums are compared), so the same class finishes the reports of the
+    local engine and of the sharded mode.
+    """
+
+    def __init__(self, rooms: "np.ndarray", counts: "np.ndarray", age_sums: "np.ndarray", min_birth_ymd: "np.ndarray",
+                 max_birth_ymd: "np.ndarray", females: "np.ndarray", room_names: Dict[int, Any]) -> None:
+        """Initialize the RoomAggregates object.
+
+        :param rooms: Room ids, ascending and unique
+        :type rooms: np.ndarray
+        :param counts: Number of students per room
+        :type counts: np.ndarray
+        :param age_sums: Sum of the full years of the students at the as-of date
+        :type age_sums: np.ndarray
+        :param min_birth_ymd: Earliest birthday as YYYYMMDD integer
+        :type min_birth_ymd: np.ndarray
+        :param max_birth_ymd: Latest birthday as YYYYMMDD integer
+        :type max_birth_ymd: np.ndarray
+        :param females: Number of students with sex F (the others are M)
+        :type females: np.ndarray
+        :param room_names: Room ids mapped to room names
+        :type room_names: Dict[int, Any]
+        :rtype: None
+        """
+        self.rooms = rooms
+        self.counts = counts
+        self.age_sums = age_sums
+        self.min_birth_ymd = min_birth_ymd
+        self.max_birth_ymd = max_birth_ymd
+        self.females = females
+        self.room_names = room_names
+
+    @staticmethod
+    def merge(parts: List["RoomAggregates"]) -> "RoomAggregates":
+        """Combine partial aggregates, a room may appear in several parts.
+
+        :param parts: Partial aggregates (e.g. one per shard)
+        :type parts: List[RoomAggregates]
+        :rtype: RoomAggregates
+        """
+        room_names = {}
+        for part in parts:
+            room_names.update(part.room_names)
+        rooms, inverse = np.unique(np.concatenate([part.rooms for part in parts] or [np.empty(0, np.int64)]),
+                                   return_inverse=True)
+
+        def combine(column: str, ufunc: "np.ufunc", initial: int) -> "np.ndarray":
+            merged = np.full(len(rooms), initial, dtype=np.int64)
+            values = np.concatenate([getattr(part, column) for part in parts] or [np.empty(0, np.int64)])
+            ufunc.at(merged, inverse, values)
+            return merged
+
+        return RoomAggregates(rooms, combine("counts", np.add, 0), combine("age_sums", np.add, 0),
+                              combine("min_birth_ymd", np.minimum, np.iinfo(np.int64).max),
+                              combine("max_birth_ymd", np.maximum, np.iinfo(np.int64).min),
+                              combine("females", np.add, 0), room_names)
+
+    def _rows(self, rooms: "np.ndarray", *columns: "np.ndarray") -> Iterator[tuple]:
+        """Result rows with Python values (room id, room name, columns...).
+
+        :param rooms: Room ids
+        :type rooms: np.ndarray
+        :param columns: Other columns of the result
+        :type columns: np.ndarray
+        :rtype: Iterator[tuple]
+        """
+        for values in zip(rooms.tolist(), *(column.tolist() for column in columns)):
+            yield (values[0], self.room_names[values[0]]) + tuple(values[1:])
+
+    def query1(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms and the number of students in each of them, ordered by room id.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        limit = slice(params["top_n"])
+        return ["room_id", "room_name", "students_quantity"], self._rows(self.rooms[limit], self.counts[limit])
+
+    def query2(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms with the smallest average age, ties ordered by room id.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        total, counts = self.age_sums, self.counts
+        # AVG(...)::INTEGER rounds half away from zero, done in integers to avoid float ties
+        average = np.sign(total) * ((2 * np.abs(total) + counts) // np.maximum(2 * counts, 1))
+        order = np.lexsort((self.rooms, average))[slice(params["top_n"])]
+        return (["room_id", "room_name", "students_quantity", "average_age"],
+                self._rows(self.rooms[order], counts[order], average[order]))
+
+    def query3(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms with the biggest difference in the age of students.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        as_of_ymd = _as_of_ymd(params["as_of"])
+        difference = _full_years(as_of_ymd - self.min_birth_ymd) - _full_years(as_of_ymd - self.max_birth_ymd)
+        order = np.lexsort((self.rooms, self.counts, -difference))[slice(params["top_n"])]
+        return (["room_id", "room_name", "students_quantity", "stud_age_diff"],
+                self._rows(self.rooms[order], self.counts[order], difference[order]))
+
+    def query4(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms where students of both sexes live.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        females, males = self.females, self.counts - self.females
+        mixed = np.flatnonzero((females > 0) & (males > 0))[slice(params["top_n"])]
+        # STRING_AGG(sex, ', ' ORDER BY sex): all F before all M
+        genders = [", ".join(["F"] * f + ["M"] * m) for f, m in zip(females[mixed].tolist(), males[mixed].tolist())]
+        return (["room_id", "room_name", "genders_in_room"],
+                self._rows(self.rooms[mixed], np.array(genders, dtype=object)))
+
+
+class LocalEngine:
+    """Class for computing the reports in process from columnar NumPy arrays, without a database
+
+    The students file is read once into arrays (room id, birthday as YYYYMMDD integer, female flag)
+    sorted by room, so every per-room aggregate is a single ufunc.reduceat over contiguous groups.
+    Values, column names, ordering and tie-breaks are the same as in REPORTS, so the result files
+    are byte-identical to the ones exported from the DB.
+    """
+
+    def __init__(self, students_file_path: str, rooms_file_path: str,
+                 columnar: Optional[ColumnarCache] = None) -> None:
+        """Initialize the LocalEngine object.
+
+        :param students_file_path: Path to the students file
+        :type students_file_path: str
+        :param rooms_file_path: Path to the rooms file
+        :type rooms_file_path: str
+        :param columnar: Read the files through memory-mapped snapshots instead of parsing JSON
+        :type columnar: Optional[ColumnarCache]
+        :rtype: None
+        """
+        if np is None:
+            raise ImportError("numpy is required for the local engine (pip install numpy)")
+        self.students_file_path = students_file_path
+        self.rooms_file_path = rooms_file_path
+        self.columnar = columnar
+        self.room_names: Dict[int, Any] = {}
+        self.room = self.birth_ymd = self.female = None
+
+    def load(self) -> None:
+        """Read both files into columns, students of unknown rooms are dropped (like the INNER JOIN).
+
+        :rtype: None
+        """
+        started = time.perf_counter()
+        reader = self.columnar or JSONFile
+        self.room_names = {record["id"]: record["name"] for record in reader.iter_records(self.rooms_file_path)}
+
+        snapshot = self.columnar.open(self.students_file_path) if self.columnar else None
+        if snapshot is not None and snapshot.count:
+            # the columns come straight from the memory-mapped arrays, no Python object per student
+            room = np.asarray(snapshot.column("room"))
+            birth_ymd = _ymd(snapshot.prefix("birthday", 10))
+            female = snapshot.prefix("sex", 1)[:, 0] == ord("F")
+        else:
+            rooms, birthdays, sexes = [], [], []
+            for record in JSONFile.iter_records(self.students_file_path):
+                rooms.append(record["room"])
+                birthdays.append(record["birthday"])
+                sexes.append(record["sex"])
+
+            room = np.array(rooms, dtype=np.int64)
+            # fixed width bytes keep only the date part, every character becomes one uint8 digit
+            birth_ymd = _ymd(np.array(birthdays, dtype="S10").view(np.uint8).reshape(-1, 10))
+            female = np.array(sexes, dtype="S1") == b"F"
+
+        known = np.isin(room, np.fromiter(self.room_names, dtype=np.int64, count=len(self.room_names)))
+        order = np.argsort(room[known], kind="stable")
+        self.room, self.birth_ymd, self.female = room[known][order], birth_ymd[known][order], female[known][order]
+        elapsed = time.perf_counter() - started
+        metrics.record("load", elapsed, len(self.room), table="student", method="local")
+        logging.info(f"-- {len(self.room)} students in {len(self.room_names)} rooms loaded in {elapsed:.2f}s")
+
+    def aggregates(self, params: Dict[str, Any]) -> "RoomAggregates":
+        """Per-room aggregates of the selected rooms, one ufunc.reduceat per column.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: RoomAggregates
+        """
+        room, birth_ymd, female = self.room, self.birth_ymd, self.female
+        if params["room_ids"] is not None:
+            selected = np.isin(room, np.array(params["room_ids"], dtype=np.int64))
+            room, birth_ymd, female = room[selected], birth_ymd[selected], female[selected]
+        rooms, starts, counts = np.unique(room, return_index=True, return_counts=True)
+        if not len(starts):
+            return RoomAggregates(rooms, counts, counts, counts, counts, counts, self.room_names)
+
+        ages = _full_years(_as_of_ymd(params["as_of"]) - birth_ymd)
+        return RoomAggregates(rooms, counts, np.add.reduceat(ages, starts),
+                              np.minimum.reduceat(birth_ymd, starts), np.maximum.reduceat(birth_ymd, starts),
+                              np.add.reduceat(female.astype(np.int64), starts), self.room_names)
+
+    def query1(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms and the number of students in each of them, see RoomAggregates.query1.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        return self.aggregates(params).query1(params)
+
+    def query2(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms with the smallest average age, see RoomAggregates.query2.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        return self.aggregates(params).query2(params)
+
+    def query3(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms with the biggest difference in the age of students, see RoomAggregates.query3.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        return self.aggregates(params).query3(params)
+
+    def query4(self, params: Dict[str, Any]) -> Tuple[List[str], Iterator[tuple]]:
+        """Rooms where students of both sexes live, see RoomAggregates.query4.
+
+        :param params: Report parameters, see Report.bind
+        :type params: Dict[str, Any]
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        return self.aggregates(params).query4(params)
+
+    def run_reports(self, output_path: str, file_format: str, params: Dict[str, Any]) -> Dict[str, bool]:
+        """Compute every report of REPORTS and save it as <output_path>/<name>_result.<format>.
+
+        :param output_path: Folder of the result files
+        :type output_path: str
+        :param file_format: Output format, see export_rows ("json", "xml", "ndjson", "csv", "csv.gz", ...)
+        :type file_format: str
+        :param params: Keyword arguments of Report.bind (top_n, as_of, room_ids)
+        :type params: Dict[str, Any]
+        :return: Report names mapped to True if the file was saved
+        :rtype: Dict[str, bool]
+        """
+        # as-of date and room filter are shared by all reports, the aggregates are computed once
+        with metrics.phase("aggregate", engine="local") as phase:
+            aggregates = self.aggregates(REPORTS["query1"].bind(**params))
+            phase.rows = len(aggregates.rooms)
+        return export_reports(aggregates, output_path, file_format, params, "local")
+
+
+def export_reports(aggregates: Any, output_path: str, file_format: str, params: Dict[str, Any],
+                   engine: str, suffix: str = "result") -> Dict[str, bool]:
+    """Finish every report of REPORTS from the per-room aggregates, save it as <output_path>/<name>_<suffix>.<format>.
+
+    :param aggregates: Per-room aggregates computed with the same as-of date and room filter
+        (RoomAggregates, or any object with the query1..query4 methods)
+    :type aggregates: Any
+    :param output_path: Folder of the result files
+    :type output_path: str
+    :param file_format: Output format, see export_rows ("json", "xml", "ndjson", "csv", "csv.gz", ...)
+    :type file_format: str
+    :param params: Keyword arguments of Report.bind (top_n, as_of, room_ids)
+    :type params: Dict[str, Any]
+    :param engine: Engine name used in logs and metrics (local, sharded, approx)
+    :type engine: str
+    :param suffix: Suffix of the result file names
+    :type suffix: str
+    :return: Report names mapped to True if the file was saved
+    :rtype: Dict[str, bool]
+    """
+    saved = {}
+    for name, report in REPORTS.items():
+        with metrics.phase("report", report=report.name, engine=engine) as phase:
+            column_names, rows = getattr(aggregates, name)(report.bind(**params))
+            saved[name] = export_rows(column_names, counted(rows, phase),
+                                      os.path.join(output_path, f"{name}_{suffix}"), file_format)
+        logging.info(f"-- Report {name} computed ({engine}) in {phase.seconds:.3f}s")
+    return saved
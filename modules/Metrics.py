@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is reported as 0
+    resource = None
+
+
+logger = logging.getLogger('metrics')
+
+# prefix of the metric names in the Prometheus text file
+METRIC_PREFIX = "dormitory"
+
+# Prometheus metrics written for every phase: (name, help, Phase attribute)
+PHASE_METRICS = (
+    ("phase_duration_seconds", "Wall time of the phase", "seconds"),
+    ("phase_rows", "Rows processed by the phase", "rows"),
+    ("phase_rows_per_second", "Rows processed per second of wall time", "rows_per_second"),
+    ("phase_bytes", "Bytes read or written by the phase", "bytes"),
+    ("phase_peak_memory_bytes", "Peak resident memory of the process at the end of the phase", "peak_memory"),
+)
+
+
+def counted(rows: Iterable[Any], phase: "Phase") -> Iterator[Any]:
+    """Pass rows through, counting them into phase.rows.
+
+    :param rows: Rows of a result or records of a file
+    :type rows: Iterable[Any]
+    :param phase: Phase the rows belong to
+    :type phase: Phase
+    :rtype: Iterator[Any]
+    """
+    for row in rows:
+        phase.rows += 1
+        yield row
+
+
+def peak_memory() -> int:
+    """Peak resident set size of the process in bytes (0 if unknown).
+
+    :rtype: int
+    """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+class Phase:
+    """Measurements of one phase of a run (loading a table, parsing a file, running a report...)"""
+
+    def __init__(self, name: str, labels: Dict[str, Any]) -> None:
+        """Initialize the Phase object.
+
+        :param name: Phase name: load, parse, report, export...
+        :type name: str
+        :param labels: What the phase worked on: table, file, report, format...
+        :type labels: Dict[str, Any]
+        :rtype: None
+        """
+        self.name = name
+        self.labels = {key: str(value) for key, value in labels.items()}
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.peak_memory = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        """Throughput of the phase.
+
+        :rtype: float
+        """
+        return self.rows / self.seconds if self.seconds > 0 else float(self.rows)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Phase as a JSON object of the run report.
+
+        :rtype: Dict[str, Any]
+        """
+        return {"phase": self.name, "labels": self.labels, "seconds": round(self.seconds, 6), "rows": self.rows,
+                "rows_per_second": round(self.rows_per_second, 1), "bytes": self.bytes,
+                "peak_memory_bytes": self.peak_memory}
+
+
+class Metrics:
+    """Class for collecting per-phase timings of a run and saving them as JSON / Prometheus text files
+
+    Phases may be recorded from several threads (reports run concurrently) and may be nested.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the Metrics object.
+
+        :rtype: None
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the recorded phases and restart the run clock.
+
+        :rtype: None
+        """
+        with self.lock:
+            self.phases: List[Phase] = []
+            self.started = time.perf_counter()
+            self.started_at = datetime.now()
+
+    @contextmanager
+    def phase(self, name: str, **labels: Any) -> Iterator[Phase]:
+        """Measure the wall time of the block, the block fills rows and bytes of the yielded Phase.
+
+        :param name: Phase name
+        :type name: str
+        :param labels: What the phase worked on
+        :type labels: Any
+        :rtype: Iterator[Phase]
+        """
+        phase = Phase(name, labels)
+        started = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds = time.perf_counter() - started
+            self._add(phase)
+
+    def record(self, name: str, seconds: float, rows: int = 0, size: int = 0, **labels: Any) -> Phase:
+        """Record a phase measured elsewhere (e.g. time spent inside a generator).
+
+        :param name: Phase name
+        :type name: str
+        :param seconds: Wall time of the phase
+        :type seconds: float
+        :param rows: Rows processed
+        :type rows: int
+        :param size: Bytes read or written
+        :type size: int
+        :param labels: What the phase worked on
+        :type labels: Any
+        :rtype: Phase
+        """
+        phase = Phase(name, labels)
+        phase.seconds, phase.rows, phase.bytes = seconds, rows, size
+        self._add(phase)
+        return phase
+
+    def _add(self, phase: Phase) -> None:
+        """Store a finished phase.
+
+        :param phase: Finished phase
+        :type phase: Phase
+        :rtype: None
+        """
+        phase.peak_memory = peak_memory()
+        with self.lock:
+            self.phases.append(phase)
+        logging.debug(f"-- Phase {phase.name} {phase.labels}: {phase.seconds:.3f}s, {phase.rows} rows "
+                      f"({phase.rows_per_second:.0f} rows/sec), {phase.bytes} bytes")
+
+    def report(self) -> Dict[str, Any]:
+        """Run report: start time, total wall time, peak memory and every phase in the order they finished.
+
+        :rtype: Dict[str, Any]
+        """
+        with self.lock:
+            phases = [phase.as_dict() for phase in self.phases]
+        return {"started_at": self.started_at.isoformat(timespec="seconds"),
+                "seconds": round(time.perf_counter() - self.started, 6),
+                "peak_memory_bytes": peak_memory(), "phases": phases}
+
+    def save_json(self, filename: str) -> None:
+        """Save the run report as a JSON file.
+
+        :param filename: Name of the JSON file
+        :type filename: str
+        :rtype: None
+        """
+        _write_atomically(filename, json.dumps(self.report(), indent=2) + "\n")
+        logging.info(f"-- Run report saved into {filename}")
+
+    def save_prometheus(self, filename: str) -> None:
+        """Save the run report in the Prometheus text format (for the node_exporter textfile collector).
+
+        Phases with the same name and labels (e.g. a table loaded in several calls) are summed.
+
+        :param filename: Name of the .prom file
+        :type filename: str
+        :rtype: None
+        """
+        merged: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Phase] = {}
+        with self.lock:
+            for phase in self.phases:
+                key = (phase.name, tuple(sorted(phase.labels.items())))
+                total = merged.setdefault(key, Phase(phase.name, phase.labels))
+                total.seconds += phase.seconds
+                total.rows += phase.rows
+                total.bytes += phase.bytes
+                total.peak_memory = max(total.peak_memory, phase.peak_memory)
+
+        lines = []
+        for metric, description, attribute in PHASE_METRICS:
+            lines += [f"# HELP {METRIC_PREFIX}_{metric} {description}", f"# TYPE {METRIC_PREFIX}_{metric} gauge"]
+            for (name, labels), phase in merged.items():
+                lines.append(f"{METRIC_PREFIX}_{metric}{_labels((('phase', name),) + labels)} "
+                             f"{_number(getattr(phase, attribute))}")
+        report = self.report()
+        lines += [f"# HELP {METRIC_PREFIX}_run_duration_seconds Wall time of the whole run",
+                  f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+                  f"{METRIC_PREFIX}_run_duration_seconds {_number(report['seconds'])}",
+                  f"# HELP {METRIC_PREFIX}_run_peak_memory_bytes Peak resident memory of the run",
+                  f"# TYPE {METRIC_PREFIX}_run_peak_memory_bytes gauge",
+                  f"{METRIC_PREFIX}_run_peak_memory_bytes {report['peak_memory_bytes']}",
+                  f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Start time of the run",
+                  f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+                  f"{METRIC_PREFIX}_run_timestamp_seconds {self.started_at.timestamp():.0f}"]
+        _write_atomically(filename, "\n".join(lines) + "\n")
+        logging.info(f"-- Prometheus metrics saved into {filename}")
+
+
+def _number(value: float) -> str:
+    """Sample value of the Prometheus text format, integers are written without exponent.
+
+    :param value: Metric value
+    :type value: float
+    :rtype: str
+    """
+    return str(value) if isinstance(value, int) else repr(round(value, 6))
+
+
+def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+    """Prometheus label set {name="value",...} with escaped values.
+
+    :param labels: Label names and values
+    :type labels: Iterable[Tuple[str, str]]
+    :rtype: str
+    """
+    pairs = []
+    for name, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _write_atomically(filename: str, text: str) -> None:
+    """Write a file through a temporary file, readers never see a half written file.
+
+    :param filename: Name of the file
+    :type filename: str
+    :param text: Content
+    :type text: str
+    :rtype: None
+    """
+    temporary_file = f"{filename}.tmp-{os.getpid()}"
+    with open(temporary_file, "w") as f:
+        f.write(text)
+    os.replace(temporary_file, filename)
+
+
+# metrics of the current run, shared by all modules like the logging configuration
+metrics = Metrics()
@@ -0,0 +1,80 @@
+import gzip
+import io
+import logging
+from typing import TextIO, Tuple
+
+from config.config import GZIP_LEVEL, ZSTD_LEVEL
+
+
+logger = logging.getLogger('output_file')
+
+# --compress choices mapped to the extension appended to the file format (query1_result.csv.gz)
+COMPRESSION_EXTENSIONS = {"gzip": "gz", "zstd": "zst"}
+
+
+class _GzipFile(gzip.GzipFile):
+    """GzipFile that also closes the file object it writes into"""
+
+    def close(self) -> None:
+        """Flush the compressed stream and close the underlying file.
+
+        :rtype: None
+        """
+        raw = self.fileobj
+        try:
+            super().close()
+        finally:
+            if raw is not None:
+                raw.close()
+
+
+def split_format(file_format: str) -> Tuple[str, str]:
+    """Split a file format like "csv.gz" into the data format and the compression extension.
+
+    :param file_format: Output format, optionally followed by "." and a compression extension
+    :type file_format: str
+    :return: Data format and compression extension ("" - not compressed)
+    :rtype: Tuple[str, str]
+    """
+    data_format, _, compression = file_format.partition(".")
+    return data_format, compression
+
+
+def open_output(filename: str, compression: str = "", encoding: str = "utf-8", errors: str = "strict",
+                buffer_size: int = -1) -> TextIO:
+    """Open a text file for writing, compressed on the fly when compression is "gz" or "zst".
+
+    Compressed files do not store the file name and modification time, so the same rows always
+    give the same bytes (cached results and checksums stay comparable).
+
+    :param filename: Name of the output file
+    :type filename: str
+    :param compression: Compression extension: "" (plain text), "gz" or "zst"
+    :type compression: str
+    :param encoding: Text encoding
+    :type encoding: str
+    :param errors: Encoding error handler
+    :type errors: str
+    :param buffer_size: Size of the output buffer in bytes (-1 - default buffering)
+    :type buffer_size: int
+    :rtype: TextIO
+    """
+    # newline="": the writers choose their line endings (csv \r\n), the same bytes on every platform and compression
+    if not compression:
+        return open(filename, "w", buffering=buffer_size, encoding=encoding, errors=errors, newline="")
+
+    raw = open(filename, "wb", buffering=buffer_size)
+    if compression == "gz":
+        stream = _GzipFile(filename="", mode="wb", compresslevel=GZIP_LEVEL, fileobj=raw, mtime=0)
+    elif compression == "zst":
+        try:
+            import zstandard  # only needed by --compress zstd, imported on first use
+        except ImportError:
+            raw.close()
+            raise ImportError("zstandard is required for zstd compression (pip install zstandard)")
+        stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, closefd=True)
+    else:
+        raw.close()
+        raise ValueError(f"Unknown compression {compression}")
+
+    return io.TextIOWrapper(stream, encoding=encoding, errors=errors, newline="")
@@ -0,0 +1,334 @@
+import logging
+import multiprocessing
+import time
+import uuid
+from queue import Empty, Full
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from psycopg2 import Error
+
+from config.config import LOADER_LOCK_TIMEOUT, LOADER_POLL_SECONDS
+from modules.Database import Database
+from modules.Metrics import metrics
+from modules.Reports import DATA_VERSION_BUMP_QUERY, DATA_VERSION_DEFER_QUERY
+
+
+logger = logging.getLogger('parallel_loader')
+
+# stop markers of the task queue: commit the loaded batches or roll them back (the producer failed)
+COMMIT = None
+ABORT = "abort"
+
+# prepared transactions of the workers which are still waiting for COMMIT / ROLLBACK PREPARED
+PREPARED_QUERY = "SELECT gid FROM pg_prepared_xacts WHERE gid = ANY(%s) AND database = current_database()"
+
+
+def _describe(error: BaseException) -> str:
+    """Error message with the exception type, str(KeyError('name')) alone is just "'name'".
+
+    :param error: Exception raised in a worker
+    :type error: BaseException
+    :rtype: str
+    """
+    return f"{type(error).__name__}: {error}"
+
+
+def _load_worker(config: dict, columns: Dict[str, Sequence[str]], method: str, init_query: Optional[str],
+                 tasks: multiprocessing.Queue, results: multiprocessing.Queue, gid: Optional[str] = None) -> None:
+    """Worker process: load batches from the task queue over its own DB connection.
+
+    Every worker works in one transaction which is committed after the COMMIT marker and rolled back
+    after the ABORT marker or any error. With a gid the transaction is only prepared (PREPARE TRANSACTION)
+    after the COMMIT marker and the coordinator commits or rolls it back. After an error the worker keeps
+    draining the queue, so the producer never blocks, and a result is always reported, whatever went wrong.
+
+    :param config: Configuration for the database connection
+    :type config: dict
+    :param columns: Names of the columns to be filled for every table the worker gets batches of
+    :type columns: Dict[str, Sequence[str]]
+    :param method: "copy" or "insert"
+    :type method: str
+    :param init_query: Query executed on the worker connection before loading, in the same transaction
+    :type init_query: Optional[str]
+    :param tasks: Queue with (table, batch of records) tuples, ended by COMMIT or ABORT
+    :type tasks: multiprocessing.Queue
+    :param results: Queue for the worker statistics (name, rows per table, seconds, error)
+    :type results: multiprocessing.Queue
+    :param gid: Global id of the two-phase transaction, None - committed by the worker
+    :type gid: Optional[str]
+    :rtype: None
+    """
+    name = multiprocessing.current_process().name
+    database = Database(config, 1, 1)  # one connection per worker process
+    load_batch = database.copy_records if method == "copy" else database.insert_records
+
+    rows: Dict[str, int] = {}
+    busy = 0.0  # seconds spent on sending data to the DB
+    error = None
+    try:
+        try:
+            database.connect(raise_error=True)
+            if gid is not None:
+                database.connection.tpc_begin(gid)
+            if init_query:
+                database.execute_query(init_query)
+        except Exception as e:
+            error = _describe(e)
+
+        while True:
+            task = tasks.get()
+            if task is COMMIT or task == ABORT:
+                break
+            if error is not None:
+                continue  # draining the queue after an error
+            table, batch = task
+            try:
+                started = time.perf_counter()
+                load_batch(table, columns[table], batch)
+                busy += time.perf_counter() - started
+                rows[table] = rows.get(table, 0) + len(batch)
+            except Exception as e:
+                error = _describe(e)
+
+        if error is None and task == ABORT:
+            error = "aborted, the producer failed"
+        if error is None:
+            started = time.perf_counter()
+            if gid is None:
+                database.commit()
+            else:
+                database.connection.tpc_prepare()
+            busy += time.perf_counter() - started
+        elif database.connection is not None and not database.connection.closed:
+            if gid is None:
+                database.rollback()
+            else:
+                database.connection.tpc_rollback()
+    except Exception as e:
+        error = _describe(e)
+    finally:
+        try:
+            database.close()  # an uncommitted transaction is rolled back by the pool
+        finally:
+            results.put((name, rows if error is None else {}, busy, error))
+
+
+def _put(queue: multiprocessing.Queue, item: object, processes: List[multiprocessing.Process]) -> bool:
+    """Put an item into a bounded task queue, waiting only while one of its consumers is alive.
+
+    :param queue: Task queue
+    :type queue: multiprocessing.Queue
+    :param item: Task or stop marker
+    :type item: object
+    :param processes: Worker processes reading the queue
+    :type processes: List[multiprocessing.Process]
+    :return: False if every consumer exited and the item was not put
+    :rtype: bool
+    """
+    while True:
+        try:
+            queue.put(item, timeout=LOADER_POLL_SECONDS)
+            return True
+        except Full:
+            if not any(process.is_alive() for process in processes):
+                return False
+
+
+def _collect(results: multiprocessing.Queue, processes: List[multiprocessing.Process]) -> List[tuple]:
+    """Wait for the result of every worker process and join them.
+
+    A process which exited without a result (killed, crashed interpreter) is reported as failed
+    instead of being waited for forever.
+
+    :param results: Queue the workers put their statistics into
+    :type results: multiprocessing.Queue
+    :param processes: Worker processes
+    :type processes: List[multiprocessing.Process]
+    :return: (name, rows per table, seconds, error) of every worker, sorted by name
+    :rtype: List[tuple]
+    """
+    stats = {}
+    while len(stats) < len(processes):
+        try:
+            stat = results.get(timeout=LOADER_POLL_SECONDS)
+            stats[stat[0]] = stat
+        except Empty:
+            # the result of a process which has just exited is already in the pipe, empty() sees it
+            exited = [process for process in processes if process.name not in stats and not process.is_alive()]
+            if exited and results.empty():
+                for process in exited:
+                    stats[process.name] = (process.name, {}, 0.0,
+                                           f"process exited with code {process.exitcode} without a result")
+    for process in processes:
+        process.join(LOADER_POLL_SECONDS)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    return sorted(stats.values())
+
+
+class ParallelLoader:
+    """Class for loading the tables over several connections in parallel, all or nothing
+
+    Records are routed to the workers by room id (rooms by id, students by room), so a worker loads
+    every room together with its students and the foreign key checks only need rows of its own
+    transaction. The workers write straight into the tables and end with PREPARE TRANSACTION; only
+    when every worker prepared, the transactions are committed with COMMIT PREPARED, otherwise they
+    are rolled back and the tables stay untouched (two-phase commit, the server needs
+    max_prepared_transactions >= workers).
+    """
+
+    def __init__(self, database: Database, workers: int, method: str = "copy",
+                 init_query: Optional[str] = None) -> None:
+        """Initialize the ParallelLoader object.
+
+        :param database: Connected database, the prepared transactions are committed over its pool
+        :type database: Database
+        :param workers: Number of worker processes (and DB connections)
+        :type workers: int
+        :param method: Bulk load method, "copy" or "insert"
+        :type method: str
+        :param init_query: Query executed in the transaction of every worker before loading
+        :type init_query: Optional[str]
+        :rtype: None
+        """
+        self.database = database
+        self.workers = workers
+        self.method = method
+        self.init_query = init_query
+
+    def check(self) -> None:
+        """Check that the server accepts a prepared transaction per worker.
+
+        :rtype: None
+        :raises Error: If max_prepared_transactions is lower than the number of workers
+        """
+        self.database.execute_query("SHOW max_prepared_transactions")
+        allowed = int(self.database.cursor.fetchone()[0])
+        if allowed < self.workers:
+            raise Error(f"a parallel load with {self.workers} workers needs max_prepared_transactions >= "
+                        f"{self.workers} in postgresql.conf (two-phase commit), the server allows {allowed}")
+
+    def load(self, tables: List[Tuple[str, Sequence[str], Iterable[dict], str]], batch_size: int) -> Dict[str, int]:
+        """Load every table, parents first, in parallel and commit the rows of all workers together.
+
+        Batches are handed out through bounded queues, so at most two batches per worker are kept
+        in memory while the producer is parsing the source files.
+
+        :param tables: (table, columns, records, room id key of the record) for every table, parents first
+        :type tables: List[Tuple[str, Sequence[str], Iterable[dict], str]]
+        :param batch_size: Number of records sent to a worker in one statement
+        :type batch_size: int
+        :return: Number of loaded rows per table
+        :rtype: Dict[str, int]
+        :raises Error: If any worker failed (no table is changed)
+        """
+        self.check()
+        prefix = f"parallel_load_{uuid.uuid4().hex[:12]}"
+        gids = [f"{prefix}_{number}" for number in range(self.workers)]
+        # the data version is bumped once after the commit: a bump per worker statement would make the
+        # workers wait for each other on its row; a lock wait on a sibling could never end (it is prepared)
+        init_query = "; ".join(query for query in (DATA_VERSION_DEFER_QUERY,
+                                                   f"SET LOCAL lock_timeout = '{LOADER_LOCK_TIMEOUT}'",
+                                                   self.init_query) if query)
+        tasks = [multiprocessing.Queue(maxsize=2) for _ in range(self.workers)]
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_load_worker, name=f"loader-{number}",
+                                             args=(self.database.config,
+                                                   {table: columns for table, columns, _, _ in tables},
+                                                   self.method, init_query, queue, results, gid))
+                     for number, (queue, gid) in enumerate(zip(tasks, gids))]
+        for process in processes:
+            process.start()
+
+        started = time.perf_counter()
+        marker = ABORT
+        try:
+            for table, _, records, key in tables:
+                table_started = time.perf_counter()
+                rows = 0
+                batches: List[List[dict]] = [[] for _ in range(self.workers)]
+                for record in records:
+                    worker = record[key] % self.workers  # a room and its students go to the same worker
+                    batches[worker].append(record)
+                    rows += 1
+                    if len(batches[worker]) >= batch_size:
+                        self._send(tasks[worker], (table, batches[worker]), processes[worker])
+                        batches[worker] = []
+                for worker, batch in enumerate(batches):
+                    if batch:
+                        self._send(tasks[worker], (table, batch), processes[worker])
+                phase = metrics.record("load", time.perf_counter() - table_started, rows, table=table,
+                                       method=self.method, workers=self.workers)
+                logging.info(f"-- {rows} rows of {table} sent to {self.workers} workers in {phase.seconds:.2f}s "
+                             f"({phase.rows_per_second:.0f} rows/sec)")
+            marker = COMMIT
+        finally:
+            for queue, process in zip(tasks, processes):
+                _put(queue, marker, [process])
+            stats = _collect(results, processes)
+            errors = [f"{name}: {error}" for name, _, _, error in stats if error is not None]
+            if marker == ABORT or errors:
+                self._finish(gids, commit=False)
+
+        loaded = {table: 0 for table, _, _, _ in tables}
+        for name, rows, busy, _ in stats:
+            logging.info(f"-- {name}: {sum(rows.values())} rows in {busy:.2f}s")
+            for table, count in rows.items():
+                loaded[table] += count
+        if errors:
+            raise Error(f"parallel load failed, no rows were committed: {'; '.join(errors)}")
+
+        self._finish(gids, commit=True, bump=any(loaded.values()))
+        logging.info(f"-- {sum(loaded.values())} rows loaded by {self.workers} workers in "
+                     f"{time.perf_counter() - started:.2f}s")
+        return loaded
+
+    @staticmethod
+    def _send(queue: multiprocessing.Queue, task: tuple, process: multiprocessing.Process) -> None:
+        """Hand a batch to a worker process.
+
+        :param queue: Task queue of the worker
+        :type queue: multiprocessing.Queue
+        :param task: (table, batch of records)
+        :type task: tuple
+        :param process: Worker process
+        :type process: multiprocessing.Process
+        :rtype: None
+        :raises Error: If the worker process exited
+        """
+        if not process.is_alive() or not _put(queue, task, [process]):
+            raise Error(f"{process.name} exited before the end of the load")
+
+    def _finish(self, gids: List[str], commit: bool, bump: bool = False) -> None:
+        """COMMIT PREPARED (and bump the data version) or ROLLBACK PREPARED the transactions of the workers.
+
+        Prepared transactions of workers that died after PREPARE are found in pg_prepared_xacts,
+        so none of them is left holding its locks.
+
+        :param gids: Global ids of the worker transactions
+        :type gids: List[str]
+        :param commit: Commit the transactions, False - roll them back
+        :type commit: bool
+        :param bump: Bump the data version after the commit (rows were loaded)
+        :type bump: bool
+        :rtype: None
+        :raises Error: If a COMMIT PREPARED failed (the transactions left are named in the message)
+        """
+        with self.database.session() as session:
+            session.cursor.execute(PREPARED_QUERY, (gids,))
+            prepared = [gid for gid, in session.cursor.fetchall()]
+            session.rollback()  # COMMIT / ROLLBACK PREPARED cannot run inside a transaction block
+            if not commit:
+                for gid in prepared:
+                    session.connection.tpc_rollback(gid)
+                return
+            for number, gid in enumerate(prepared):
+                try:
+                    session.connection.tpc_commit(gid)
+                except Error as e:
+                    raise Error(f"COMMIT PREPARED failed after {number} of {len(prepared)} workers, "
+                                f"still prepared: {', '.join(prepared[number:])}: {e}")
+            session.execute_query("SELECT to_regclass('public.data_version') IS NOT NULL")
+            if bump and session.cursor.fetchone()[0]:
+                session.execute_query(DATA_VERSION_BUMP_QUERY)
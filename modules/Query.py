@@ -1,14 +1,24 @@
+import csv
 import json
 import logging
-from typing import Any
-import xml.etree.ElementTree as ET
+import os
+from itertools import chain
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
 from psycopg2 import Error
 
-from modules import Database, XMLFile
+from config.config import FETCH_SIZE
+from modules import Database
+from modules.IndexAdvisor import IndexAdvisor
+from modules.Metrics import counted, metrics
+from modules.OutputFile import open_output, split_format
+from modules.XMLFile import XMLFile
 
 
 logger = logging.getLogger('query')
 
+# one encoder for every NDJSON line, json.dumps with non-default arguments builds a new encoder per call
+NDJSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
 
 def execute_query(connection: Database, query: str) -> Any:
     """Execute a query and return the result.
@@ -20,8 +30,7 @@ def execute_query(connection: Database, query: str) -> Any:
     :return: Query result
     :rtype: Any
     """
-    connection.execute_query(query)
-    return connection.cursor.fetchall()
+    return connection.fetch_all(query)
 
 
 def save_query_result_to_json(result: Any, filename: str) -> None:
@@ -48,8 +57,7 @@ def save_query_result_to_xml(result: Any, filename: str) -> None:
     :type filename: str
     :rtype: None
     """
-    data = {"columns": [desc[0] for desc in result.description], "rows": [dict(row) for row in result]}
-    XMLFile.save_file(data, filename)
+    XMLFile.save_rows([desc[0] for desc in result.description], result, filename)
 
 
 def execute_and_save_query_result(connection: Database, query: str, filename: str, file_format: str) -> None:
@@ -86,46 +94,9 @@ def execute_query_and_save_xml(database: Any, result: Any, filename: str) -> Non
     :type filename: str
     :rtype: None
     """
-    try:
-        # collecting column names
-        column_names = [desc[0] for desc in database.cursor.description]
-        # creating dictionary for each row
-        rows = [dict(zip(column_names, row)) for row in result]
-
-        # creating root xml element
-        root = ET.Element("data")
-
-        # creating elements for columns
-        columns_element = ET.SubElement(root, "columns")
-
-        # creating elements for each column in column_names
-        for column in column_names:
-            # creating column element inside columns element
-            column_element = ET.SubElement(columns_element, "column")
-            # setting column element text = column name
-            column_element.text = column
-
-        # creating elements for rows
-        rows_element = ET.SubElement(root, "rows")
-        # creating element for each row in rows list
-        for row in rows:
-            # creating element row in element rows
-            row_element = ET.SubElement(rows_element, "row")
-            # for each pare column-value in current row
-            for column, value in row.items():
-                # creating element with the name = column
-                column_element = ET.SubElement(row_element, column)
-                # setting element text = current
-                column_element.text = str(value)
-
-        # creating object ElementTree with root element
-        tree = ET.ElementTree(root)
-        # writing tree data to file
-        tree.write(filename)
-
-        logging.info(f"Query result saved into {filename}")
-    except Error as e:
-        logging.error(f"-- Error while creating XML file: {e}")
+    # collecting column names
+    column_names = [desc[0] for desc in database.cursor.description]
+    XMLFile.save_rows(column_names, result, filename)
 
 
 def execute_and_save_query_json(database: Any, result: Any, filename: str) -> None:
@@ -158,28 +129,256 @@ def execute_and_save_query_json(database: Any, result: Any, filename: str) -> No
         logging.error(f"json execute and save func. error: {e}")
 
 
-def create_indexes(database: Any) -> None:
-    """Create indexes in the database.
+def stream_query(database: Any, query: str, fetch_size: int = FETCH_SIZE,
+                 params: Optional[dict] = None) -> Tuple[List[str], Iterator[tuple]]:
+    """Execute a query on a named (server-side) cursor and return column names and a row iterator.
+
+    Rows are fetched fetch_size at a time, so the result is never held in memory as a whole.
+    The cursor is closed when the iterator is exhausted.
 
     :param database: Database connection
     :type database: Any
+    :param query: SQL query to be executed (a single SELECT)
+    :type query: str
+    :param fetch_size: Number of rows fetched in one round trip
+    :type fetch_size: int
+    :param params: Values for %(name)s placeholders of the query
+    :type params: Optional[dict]
+    :return: Column names and iterator over the result rows
+    :rtype: Tuple[List[str], Iterator[tuple]]
+    """
+    cursor = database.connection.cursor(name="stream_query_cursor")
+    cursor.itersize = fetch_size
+    cursor.execute(query.strip().rstrip(";"), params)
+    # a named cursor knows its description only after the first fetch
+    first_rows = cursor.fetchmany(fetch_size)
+    column_names = [desc[0] for desc in cursor.description]
+
+    def rows() -> Iterator[tuple]:
+        try:
+            yield from chain(first_rows, cursor)
+        finally:
+            cursor.close()
+
+    return column_names, rows()
+
+
+def write_json_rows(f: TextIO, column_names: Sequence[str], rows: Iterable[tuple]) -> None:
+    """Write rows to an opened file as the {"columns": [...], "rows": [...]} JSON document.
+
+    Each row is serialized and written as soon as it arrives, the output is identical to
+    json.dump of the whole document.
+
+    :param f: Opened text file
+    :type f: TextIO
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result
+    :type rows: Iterable[tuple]
     :rtype: None
     """
+    f.write('{"columns": ' + json.dumps(list(column_names)) + ', "rows": [')
+    separator = ""
+    for row in rows:
+        f.write(separator + json.dumps(dict(zip(column_names, row))))
+        separator = ", "
+    f.write("]}")
+
+
+def write_ndjson_rows(f: TextIO, column_names: Sequence[str], rows: Iterable[tuple]) -> None:
+    """Write rows to an opened file as newline-delimited JSON, one {"column": value} object per line.
+
+    Every line is a complete document, so the file can be split and read in parallel.
+
+    :param f: Opened text file
+    :type f: TextIO
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result
+    :type rows: Iterable[tuple]
+    :rtype: None
+    """
+    encode = NDJSON_ENCODER.encode
+    f.writelines(encode(dict(zip(column_names, row))) + "\n" for row in rows)
+
+
+def write_csv_rows(f: TextIO, column_names: Sequence[str], rows: Iterable[tuple]) -> None:
+    """Write rows to an opened file as CSV with a header row (NULL is written as an empty field).
+
+    :param f: Opened text file
+    :type f: TextIO
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result
+    :type rows: Iterable[tuple]
+    :rtype: None
+    """
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(column_names)
+    writer.writerows(rows)
+
+
+# writers of the text formats: (opened file, column names, rows) -> None, XML has its own in XMLFile
+ROW_WRITERS = {"json": write_json_rows, "ndjson": write_ndjson_rows, "csv": write_csv_rows}
+
+
+def save_rows(writer: Callable[[TextIO, Sequence[str], Iterable[tuple]], None], column_names: Sequence[str],
+              rows: Iterable[tuple], filename: str, compression: str = "") -> bool:
+    """Save rows to a file with one of ROW_WRITERS while they are being produced.
+
+    :param writer: Function writing the rows into an opened file
+    :type writer: Callable[[TextIO, Sequence[str], Iterable[tuple]], None]
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result, any iterable (e.g. a server-side cursor)
+    :type rows: Iterable[tuple]
+    :param filename: Name of the output file
+    :type filename: str
+    :param compression: Compression extension: "" (plain text), "gz" or "zst"
+    :type compression: str
+    :return: True if the file was saved
+    :rtype: bool
+    """
+    try:
+        with metrics.phase("export", file=os.path.basename(filename)) as phase:
+            with open_output(filename, compression) as f:
+                writer(f, column_names, counted(rows, phase))
+            phase.bytes = os.path.getsize(filename)
+        logging.info(f"-- Query result saved into file {filename}")
+        return True
+
+    except (Error, ImportError) as e:
+        logging.error(f"stream export error: {e}")
+        return False
+
+
+def save_rows_to_json(column_names: Sequence[str], rows: Iterable[tuple], filename: str,
+                      compression: str = "") -> bool:
+    """Save rows to a JSON file while they are being produced.
+
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result, any iterable (e.g. a server-side cursor)
+    :type rows: Iterable[tuple]
+    :param filename: Name of the output JSON file
+    :type filename: str
+    :param compression: Compression extension: "" (plain text), "gz" or "zst"
+    :type compression: str
+    :return: True if the file was saved
+    :rtype: bool
+    """
+    return save_rows(write_json_rows, column_names, rows, filename, compression)
+
+
+def stream_query_to_json(database: Any, query: str, filename: str, fetch_size: int = FETCH_SIZE) -> bool:
+    """Execute a query and stream its result to a JSON file row by row.
+
+    :param database: Database connection
+    :type database: Any
+    :param query: SQL query to be executed
+    :type query: str
+    :param filename: Name of the output JSON file
+    :type filename: str
+    :param fetch_size: Number of rows fetched from the server in one round trip
+    :type fetch_size: int
+    :return: True if the file was saved
+    :rtype: bool
+    """
     try:
-        create_index_query = 'CREATE INDEX IF NOT EXISTS idx_room_name ON public.room("name")'
-        database.execute_query(create_index_query)  # using cursor.execute(query)
-        logging.info("-- Index idx_room_name created")
+        column_names, rows = stream_query(database, query, fetch_size)
+        return save_rows_to_json(column_names, rows, filename)
+
+    except Error as e:
+        logging.error(f"json stream export error: {e}")
+        return False
 
-        create_index_query = "CREATE INDEX IF NOT EXISTS idx_student_birthday ON public.student(birthday)"
-        database.execute_query(create_index_query)
-        logging.info("-- Index idx_student_birthday created")
 
-        create_index_query = "CREATE INDEX IF NOT EXISTS idx_student_room ON public.student(room)"
-        database.execute_query(create_index_query)
-        logging.info("-- Index idx_student_room created")
+def stream_query_to_xml(database: Any, query: str, filename: str, fetch_size: int = FETCH_SIZE,
+                        buffer_size: int = -1) -> bool:
+    """Execute a query and stream its result to an XML file row by row.
+
+    :param database: Database connection
+    :type database: Any
+    :param query: SQL query to be executed
+    :type query: str
+    :param filename: Name of the output XML file
+    :type filename: str
+    :param fetch_size: Number of rows fetched from the server in one round trip
+    :type fetch_size: int
+    :param buffer_size: Size of the output buffer in bytes (-1 - default buffering)
+    :type buffer_size: int
+    :return: True if the file was saved
+    :rtype: bool
+    """
+    try:
+        column_names, rows = stream_query(database, query, fetch_size)
+        return XMLFile.save_rows(column_names, rows, filename, buffer_size)
+
+    except Error as e:
+        logging.error(f"xml stream export error: {e}")
+        return False
+
+
+def export_rows(column_names: Sequence[str], rows: Iterable[tuple], filename: str, file_format: str) -> bool:
+    """Stream rows into filename + "." + file_format.
+
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result
+    :type rows: Iterable[tuple]
+    :param filename: Name of the output file without extension
+    :type filename: str
+    :param file_format: Format of the output file ("json", "xml", "ndjson" or "csv"),
+        optionally compressed: "csv.gz", "ndjson.zst", ...
+    :type file_format: str
+    :return: True if the file was saved
+    :rtype: bool
+    """
+    data_format, compression = split_format(file_format)
+    if data_format == "xml":
+        return XMLFile.save_rows(column_names, rows, f"{filename}.{file_format}", compression=compression)
+    elif data_format in ROW_WRITERS:
+        return save_rows(ROW_WRITERS[data_format], column_names, rows, f"{filename}.{file_format}", compression)
+    logging.error("-- Invalid file format. Only JSON, XML, NDJSON and CSV formats are supported.")
+    return False
 
-        database.commit()  # saving changes to DB
-        logging.info("Indexes created successfully")
+
+def export_query(database: Any, query: str, filename: str, file_format: str) -> bool:
+    """Execute a query and stream its result into filename + "." + file_format.
+
+    :param database: Database connection
+    :type database: Any
+    :param query: SQL query to be executed
+    :type query: str
+    :param filename: Name of the output file without extension
+    :type filename: str
+    :param file_format: Format of the output file, see export_rows
+    :type file_format: str
+    :return: True if the file was saved
+    :rtype: bool
+    """
+    try:
+        column_names, rows = stream_query(database, query)
+        return export_rows(column_names, rows, filename, file_format)
+
+    except Error as e:
+        logging.error(f"-- Error while exporting query result {e}")
+        return False
+
+
+def create_indexes(database: Any) -> None:
+    """Create the indexes recommended by the index advisor for the report queries.
+
+    :param database: Database connection
+    :type database: Any
+    :rtype: None
+    """
+    from modules.Reports import REPORTS, render_reports  # the registry itself is built on stream_query
+
+    try:
+        recommended = IndexAdvisor(database, render_reports(database, REPORTS, {})).run(apply=True)
+        logging.info(f"{len(recommended)} indexes created successfully")
 
     except Error as e:
+        database.rollback()
         logging.error(f"-- Error while creating indexes {e}")
@@ -0,0 +1,252 @@
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+from config.config import BATCH_SIZE, QUARANTINE_FILE
+from modules.JSONFile import JSONFile
+from modules.Metrics import metrics
+
+
+logger = logging.getLogger('record_validator')
+
+# limits of the table columns, see SCHEMA_SQL
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+ROOM_NAME_LENGTH = 10
+STUDENT_NAME_LENGTH = 20
+SEXES = frozenset(("F", "M"))
+
+# birthdays the TIMESTAMP column reads as written: YYYY-MM-DD with an optional [T ]HH:MM[:SS[.ffffff]], no offset
+# (TIMESTAMP drops it); datetime.fromisoformat also takes forms the server refuses, like 2023-01-01T00 or week dates
+TIMESTAMP_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?")
+
+
+def _integer(value: Any) -> Optional[str]:
+    """Reason why the value does not fit an INTEGER column, None if it fits.
+
+    :param value: Value of the record
+    :type value: Any
+    :rtype: Optional[str]
+    """
+    if type(value) is not int:  # bool is an int too, but not a valid id
+        return f"not an integer: {value!r}"
+    if not INTEGER_MIN <= value <= INTEGER_MAX:
+        return f"out of the INTEGER range: {value}"
+    return None
+
+
+def _text(max_length: int, nullable: bool = False) -> Callable[[Any], Optional[str]]:
+    """Check of a VARCHAR(max_length) column.
+
+    :param max_length: Maximal number of characters
+    :type max_length: int
+    :param nullable: The column accepts NULL
+    :type nullable: bool
+    :rtype: Callable[[Any], Optional[str]]
+    """
+    def check(value: Any) -> Optional[str]:
+        if value is None and nullable:
+            return None
+        if type(value) is not str:
+            return f"not a string: {value!r}"
+        if len(value) > max_length:
+            return f"longer than {max_length} characters: {value!r}"
+        if "\x00" in value:
+            return "contains a NUL character"
+        return None
+    return check
+
+
+def _timestamp(value: Any) -> Optional[str]:
+    """Reason why the value is not a timestamp of TIMESTAMP_PATTERN with valid fields, None if it is one.
+
+    :param value: Value of the record
+    :type value: Any
+    :rtype: Optional[str]
+    """
+    if type(value) is not str:
+        return f"not a string: {value!r}"
+    match = TIMESTAMP_PATTERN.fullmatch(value)
+    if match is None:
+        return f"not a YYYY-MM-DD[THH:MM[:SS[.ffffff]]] timestamp: {value!r}"
+    *fields, fraction = match.groups(default="0")
+    try:
+        datetime(*map(int, fields), int(fraction.ljust(6, "0")))
+    except ValueError:
+        return f"not a date: {value!r}"
+    return None
+
+
+def _sex(value: Any) -> Optional[str]:
+    """Reason why the value is not F or M, None if it is.
+
+    :param value: Value of the record
+    :type value: Any
+    :rtype: Optional[str]
+    """
+    return None if type(value) is str and value in SEXES else f"not F or M: {value!r}"
+
+
+# checks of the columns of every table, in the order of the columns
+RULES: Dict[str, Dict[str, Callable[[Any], Optional[str]]]] = {
+    "room": {"id": _integer, "name": _text(ROOM_NAME_LENGTH, nullable=True)},
+    "student": {"id": _integer, "birthday": _timestamp, "name": _text(STUDENT_NAME_LENGTH),
+                "room": _integer, "sex": _sex},
+}
+
+
+class RecordValidator:
+    """Class for checking source records batch by batch before they are sent to the DB
+
+    Wraps a reader (JSONFile or ColumnarCache) and has the same iter_records / iter_batches
+    methods, so every loader gets only the records the tables accept: wrong types, too long
+    names, unparseable birthdays, unknown sexes, duplicate ids and students of unknown rooms
+    are written into the quarantine file (one JSON object per line with the reasons) instead
+    of aborting the load. Rooms must be read before students, as they are loaded.
+
+    Ids and room references are checked against the files: an incremental load makes the tables
+    equal to the files (rows missing in them are deleted), so the files are the whole result.
+    A load which adds the records to the rows already in the tables has to call add_existing
+    first, then ids of those rows are duplicates and their rooms are known.
+
+    The same validator can read the files again (e.g. every POST /load of the report service):
+    reading a file starts its table over, students are checked against the rooms of the last
+    read of the rooms file. The quarantine file collects the rejected records of every read.
+    """
+
+    def __init__(self, tables: Dict[str, str], reader: Any = JSONFile, quarantine_file: str = QUARANTINE_FILE,
+                 batch_size: int = BATCH_SIZE) -> None:
+        """Initialize the RecordValidator object, the quarantine file of the previous run is removed.
+
+        :param tables: Source files mapped to their tables ("room" or "student")
+        :type tables: Dict[str, str]
+        :param reader: JSONFile or ColumnarCache, source of the records
+        :type reader: Any
+        :param quarantine_file: NDJSON file for the rejected records
+        :type quarantine_file: str
+        :param batch_size: Number of records checked at once by iter_records
+        :type batch_size: int
+        :rtype: None
+        """
+        self.tables = {str(path): table for path, table in tables.items()}
+        self.reader = reader
+        self.quarantine_file = quarantine_file
+        self.batch_size = batch_size
+        self.ids: Dict[str, Set[int]] = {table: set() for table in RULES}
+        self.existing: Dict[str, Set[int]] = {table: set() for table in RULES}
+        self.rejected: Dict[str, int] = {table: 0 for table in RULES}
+        if os.path.dirname(quarantine_file):
+            os.makedirs(os.path.dirname(quarantine_file), exist_ok=True)
+        if os.path.exists(quarantine_file):
+            os.remove(quarantine_file)
+
+    def add_existing(self, database: Any) -> None:
+        """Read the ids of the rows in the tables, which are kept by a load that adds records.
+
+        :param database: Connected database
+        :type database: Database
+        :rtype: None
+        """
+        for table in RULES:
+            database.execute_query(f"SELECT id FROM {table}")
+            self.existing[table] = {row_id for row_id, in database.cursor.fetchall()}
+        logging.info(f"-- Records checked against {len(self.existing['room'])} rooms and "
+                     f"{len(self.existing['student'])} students in the DB")
+
+    def validate(self, table: str, batch: List[Any], file_path: str = "") -> List[dict]:
+        """Check a batch of records, rejected ones are appended to the quarantine file.
+
+        Every rule is called for each record, column after column, and the reasons are joined per record.
+
+        :param table: Table the records are loaded into
+        :type table: str
+        :param batch: Records of the source file
+        :type batch: List[Any]
+        :param file_path: Source file, written into the quarantine file
+        :type file_path: str
+        :return: Records accepted by the table
+        :rtype: List[dict]
+        """
+        records = [record if isinstance(record, dict) else None for record in batch]
+        reasons: List[List[str]] = [[] if record is not None else ["not a JSON object"] for record in records]
+
+        for column, check in RULES[table].items():
+            for record, record_reasons in zip(records, reasons):
+                if record is None:
+                    continue
+                if column not in record:
+                    record_reasons.append(f"{column}: missing")
+                    continue
+                reason = check(record[column])
+                if reason is not None:
+                    record_reasons.append(f"{column}: {reason}")
+
+        # primary key and foreign key, only for records that passed the column checks
+        ids, existing = self.ids[table], self.existing[table]
+        for number, record in enumerate(records):
+            if reasons[number]:
+                continue
+            if table == "student" and record["room"] not in self.ids["room"] and \
+                    record["room"] not in self.existing["room"]:
+                reasons[number].append(f"room: unknown room {record['room']}")
+            elif record["id"] in ids or record["id"] in existing:
+                reasons[number].append(f"id: duplicate id {record['id']}")
+            else:
+                ids.add(record["id"])
+
+        rejected = [(record, reason) for record, reason in zip(batch, reasons) if reason]
+        if rejected:
+            self.rejected[table] += len(rejected)
+            with open(self.quarantine_file, "a") as f:
+                for record, reason in rejected:
+                    f.write(json.dumps({"table": table, "file": file_path, "record": record, "reasons": reason},
+                                       default=str) + "\n")
+        return [record for record, reason in zip(records, reasons) if not reason]
+
+    def iter_batches(self, file_path: str, batch_size: int) -> Iterator[List[dict]]:
+        """Yield the accepted records of a source file in lists of at most batch_size records.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :param batch_size: Number of records read and checked at once
+        :type batch_size: int
+        :rtype: Iterator[List[dict]]
+        :raises ValueError: If the file has records and every one of them was rejected
+        """
+        table = self.tables[str(file_path)]
+        # the ids of the previous read of the file are not duplicates
+        self.ids[table] = set()
+        self.rejected[table] = 0
+        busy = 0.0
+        checked = 0
+        for batch in self.reader.iter_batches(file_path, batch_size):
+            started = time.perf_counter()
+            valid = self.validate(table, batch, str(file_path))
+            busy += time.perf_counter() - started
+            checked += len(batch)
+            if valid:
+                yield valid
+
+        metrics.record("validate", busy, checked, table=table)
+        if checked and self.rejected[table] == checked:
+            # an incremental load would delete every row of the table, a full one would load nothing
+            raise ValueError(f"all {checked} records of {file_path} rejected, see {self.quarantine_file}")
+        if self.rejected[table]:
+            logging.error(f"-- {self.rejected[table]} of {checked} records of {file_path} rejected, "
+                          f"see {self.quarantine_file}")
+        else:
+            logging.info(f"-- All {checked} records of {file_path} are valid")
+
+    def iter_records(self, file_path: str) -> Iterator[dict]:
+        """Yield the accepted records of a source file one by one.
+
+        :param file_path: Path to the source file
+        :type file_path: str
+        :rtype: Iterator[dict]
+        """
+        for batch in self.iter_batches(file_path, self.batch_size):
+            yield from batch
@@ -0,0 +1,346 @@
+import io
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from psycopg2 import Error
+from psycopg2.pool import PoolError
+
+from config.config import BATCH_SIZE, SERVICE_CACHE_SIZE, SERVICE_HOST, SERVICE_PORT
+from modules.Database import Database
+from modules.IncrementalLoader import IncrementalLoader
+from modules.JSONFile import JSONFile
+from modules.Query import ROW_WRITERS
+from modules.Reports import DATA_VERSION_QUERY, Report
+from modules.XMLFile import XMLFile
+
+
+logger = logging.getLogger('report_service')
+
+# content types of the formats the service renders
+CONTENT_TYPES = {"json": "application/json", "xml": "application/xml",
+                 "ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+
+def render_rows(column_names: Sequence[str], rows: Iterable[tuple], file_format: str) -> bytes:
+    """Render rows in memory, the bytes are the same as the content of the exported result file.
+
+    :param column_names: Names of the columns
+    :type column_names: Sequence[str]
+    :param rows: Rows of the result
+    :type rows: Iterable[tuple]
+    :param file_format: "json", "xml", "ndjson" or "csv"
+    :type file_format: str
+    :rtype: bytes
+    """
+    buffer = io.StringIO()
+    if file_format == "xml":
+        XMLFile.write_rows(buffer, column_names, rows)
+        return buffer.getvalue().encode("us-ascii", "xmlcharrefreplace")
+    ROW_WRITERS[file_format](buffer, column_names, rows)
+    return buffer.getvalue().encode()
+
+
+class MemoryCache:
+    """Class for the in-memory LRU cache of rendered reports, safe to use from request threads"""
+
+    def __init__(self, max_entries: int = SERVICE_CACHE_SIZE) -> None:
+        """Initialize the MemoryCache object.
+
+        :param max_entries: Number of rendered reports kept
+        :type max_entries: int
+        :rtype: None
+        """
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        """Rendered report of the key, None on a miss.
+
+        :param key: Cache key
+        :type key: tuple
+        :rtype: Optional[bytes]
+        """
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key: tuple, body: bytes) -> None:
+        """Store a rendered report, the least recently used one is evicted when the cache is full.
+
+        :param key: Cache key
+        :type key: tuple
+        :param body: Rendered report
+        :type body: bytes
+        :rtype: None
+        """
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all entries (the data changed).
+
+        :rtype: None
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class ReportService:
+    """Class for serving the reports over HTTP from warm pooled connections with an in-memory cache
+
+    GET  /reports                  - names of the reports
+    GET  /reports/<name>?format=json|xml|ndjson|csv&top_n=5&as_of=YYYY-MM-DD&room=1&room=2
+    POST /load                     - incremental reload of the source files, drops the cache
+    GET  /health                   - DB check and cache statistics
+
+    Cached reports are keyed by the report parameters and the data version of the tables, so rows
+    written by another process (e.g. main.py --incremental) invalidate the cache as well.
+    """
+
+    def __init__(self, database: Database, reports: Dict[str, Report], sources: List[Tuple[str, Sequence[str], str]],
+                 default_format: str = "json", batch_size: int = BATCH_SIZE, load_method: str = "copy",
+                 reader: Any = JSONFile, cache_size: int = SERVICE_CACHE_SIZE) -> None:
+        """Initialize the ReportService object.
+
+        :param database: Connected Database with a pool, kept open while the service runs
+        :type database: Database
+        :param reports: Report registry
+        :type reports: Dict[str, Report]
+        :param sources: (table, columns, source file) loaded by POST /load, parents first (empty - no reloads)
+        :type sources: List[Tuple[str, Sequence[str], str]]
+        :param default_format: Format of the reports requested without ?format=
+        :type default_format: str
+        :param batch_size: Number of records sent to the DB in one statement
+        :type batch_size: int
+        :param load_method: Bulk load method, "copy" or "insert"
+        :type load_method: str
+        :param reader: JSONFile or ColumnarCache, source of the records
+        :type reader: Any
+        :param cache_size: Number of rendered reports kept in memory
+        :type cache_size: int
+        :rtype: None
+        """
+        self.database = database
+        self.reports = reports
+        self.sources = sources
+        self.default_format = default_format
+        self.batch_size = batch_size
+        self.load_method = load_method
+        self.reader = reader
+        self.cache = MemoryCache(cache_size)
+        self.load_lock = threading.Lock()
+        self.version = None
+
+    def data_version(self) -> str:
+        """Current data version of the tables, the cache is dropped when it changes.
+
+        :rtype: str
+        """
+        with self.database.session() as session:
+            session.execute_query(DATA_VERSION_QUERY)
+            version = session.cursor.fetchone()[0]
+        if version != self.version:
+            self.cache.clear()
+            self.version = version
+        return version
+
+    def report(self, name: str, file_format: str, params: Dict[str, Any]) -> Tuple[bytes, bool]:
+        """Rendered report, from the cache or from a pooled connection.
+
+        :param name: Report name
+        :type name: str
+        :param file_format: "json", "xml", "ndjson" or "csv"
+        :type file_format: str
+        :param params: Keyword arguments of Report.bind
+        :type params: Dict[str, Any]
+        :return: Rendered report and True if it came from the cache
+        :rtype: Tuple[bytes, bool]
+        """
+        report = self.reports[name]
+        bound = report.bind(**params)
+        key = (name, file_format, bound["top_n"], bound["as_of"],
+               tuple(bound["room_ids"]) if bound["room_ids"] is not None else None, self.data_version())
+        body = self.cache.get(key)
+        if body is not None:
+            return body, True
+
+        # prepared statements stay on the pooled connections, repeated reports are only executed
+        with self.database.session() as session:
+            column_names, rows = report.stream(session, bound)
+            body = render_rows(column_names, rows, file_format)
+        self.cache.put(key, body)
+        return body, False
+
+    def load(self) -> Dict[str, Dict[str, int]]:
+        """Apply the source files incrementally (one load at a time) and drop the cache.
+
+        :return: Counts of inserted, updated and deleted rows per table
+        :rtype: Dict[str, Dict[str, int]]
+        """
+        with self.load_lock:
+            with self.database.session() as session:
+                loader = IncrementalLoader(session, self.batch_size, self.load_method)
+                stats = loader.load([(table, columns, self.reader.iter_records(path))
+                                     for table, columns, path in self.sources])
+            self.cache.clear()
+        return stats
+
+    def health(self) -> Dict[str, Any]:
+        """Service status: data version and cache statistics.
+
+        :rtype: Dict[str, Any]
+        """
+        return {"status": "ok", "data_version": self.data_version(), "cached_reports": len(self.cache.entries),
+                "cache_hits": self.cache.hits, "cache_misses": self.cache.misses}
+
+    def serve(self, host: str = SERVICE_HOST, port: int = SERVICE_PORT) -> None:
+        """Serve HTTP requests until interrupted (Ctrl+C), every request runs on its own thread.
+
+        :param host: Listen address
+        :type host: str
+        :param port: Listen port
+        :type port: int
+        :rtype: None
+        """
+        server = ThreadingHTTPServer((host, port), _RequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        logging.info(f"-- Report service listening on http://{host}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("-- Report service stopped")
+        finally:
+            server.server_close()
+
+
+def _parse_params(query: Dict[str, List[str]]) -> Dict[str, Any]:
+    """Report parameters from the query string (top_n, as_of, room).
+
+    :param query: Parsed query string
+    :type query: Dict[str, List[str]]
+    :rtype: Dict[str, Any]
+    :raises ValueError: If a parameter is not a valid number / date or top_n is negative
+    """
+    top_n = int(query["top_n"][0]) if "top_n" in query else None
+    if top_n is not None and top_n < 0:
+        raise ValueError(f"top_n must not be negative, got {top_n}")
+    return {"top_n": top_n,
+            "as_of": date.fromisoformat(query["as_of"][0]) if "as_of" in query else None,
+            "room_ids": [int(room) for room in query["room"]] if "room" in query else None}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Handler of the report service requests, the service is taken from the server"""
+
+    def do_GET(self) -> None:
+        """Serve /reports, /reports/<name> and /health.
+
+        :rtype: None
+        """
+        service: ReportService = self.server.service
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        started = time.perf_counter()
+        try:
+            if parts == ["health"]:
+                self._send_json(200, service.health())
+            elif parts == ["reports"]:
+                self._send_json(200, list(service.reports))
+            elif len(parts) == 2 and parts[0] == "reports":
+                query = parse_qs(url.query)
+                file_format = query.get("format", [service.default_format])[0]
+                if parts[1] not in service.reports:
+                    self._send_json(404, {"error": f"unknown report {parts[1]}"})
+                elif file_format not in CONTENT_TYPES:
+                    self._send_json(400, {"error": f"unknown format {file_format}"})
+                else:
+                    body, cached = service.report(parts[1], file_format, _parse_params(query))
+                    self._send(200, body, CONTENT_TYPES[file_format], {"X-Cache": "hit" if cached else "miss"})
+                    elapsed = (time.perf_counter() - started) * 1000
+                    logging.info(f"-- {parts[1]} {file_format} served in {elapsed:.1f} ms "
+                                 f"({'cached' if cached else 'queried'})")
+            else:
+                self._send_json(404, {"error": "not found"})
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except PoolError as e:
+            self._send_json(503, {"error": str(e)})
+        except Error as e:
+            logging.error(f"-- Error while serving {self.path} {e}")
+            self._send_json(500, {"error": str(e)})
+
+    def do_POST(self) -> None:
+        """Serve /load.
+
+        :rtype: None
+        """
+        service: ReportService = self.server.service
+        if urlsplit(self.path).path.rstrip("/") != "/load":
+            self._send_json(404, {"error": "not found"})
+            return
+        if not service.sources:
+            self._send_json(409, {"error": "the service was started without source files (main.py report --serve)"})
+            return
+        try:
+            self._send_json(200, service.load())
+        except (Error, OSError, ValueError) as e:
+            logging.error(f"-- Error while loading data {e}")
+            self._send_json(500, {"error": str(e)})
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        """Send a complete response.
+
+        :param status: HTTP status
+        :type status: int
+        :param body: Response body
+        :type body: bytes
+        :param content_type: Content-Type header
+        :type content_type: str
+        :param headers: Additional headers
+        :type headers: Optional[Dict[str, str]]
+        :rtype: None
+        """
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: Any) -> None:
+        """Send a JSON response.
+
+        :param status: HTTP status
+        :type status: int
+        :param data: Response document
+        :type data: Any
+        :rtype: None
+        """
+        self._send(status, json.dumps(data).encode(), CONTENT_TYPES["json"])
+
+    def log_message(self, format: str, *args: Any) -> None:
+        """Access log through logging instead of stderr.
+
+        :rtype: None
+        """
+        logging.debug(f"-- {self.address_string()} {format % args}")
@@ -0,0 +1,335 @@
+import logging
+import os
+from datetime import date
+from itertools import chain
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config.config import FETCH_SIZE
+from modules.Database import Database
+from modules.Query import stream_query
+
+
+logger = logging.getLogger('reports')
+
+# columns and indexes the reports rely on (idempotent migration of the sql-task.sql schema)
+STUDENT_AGE_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql-student-age.sql")
+
+# change marker bumped by every statement writing room or student, read by the report caches
+DATA_VERSION_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql-data-version.sql")
+DATA_VERSION_QUERY = "SELECT created::TEXT || ':' || version::TEXT FROM data_version"
+
+# the triggers skip the bump in a transaction with this setting, the loader bumps the version itself once
+DATA_VERSION_DEFER_QUERY = "SET LOCAL data_version.deferred = 'on'"
+DATA_VERSION_BUMP_QUERY = "UPDATE data_version SET version = version + 1"
+
+# parameters of every report in the order of the prepared statement arguments
+PARAMETERS = ("top_n", "as_of", "room_ids")
+PARAMETER_TYPES = ("integer", "timestamp", "integer[]")
+
+# placeholder shared by all reports: NULL room filter means all rooms
+ROOM_FILTER = "(%(room_ids)s::integer[] IS NULL OR public.room.id = ANY(%(room_ids)s::integer[]))"
+
+# as-of date as YYYYMMDD integer, an uncorrelated subquery is evaluated once per execution
+AS_OF_YMD = "(SELECT TO_CHAR(%(as_of)s::date, 'YYYYMMDD')::INTEGER)"
+
+
+# triggers created by sql-data-version.sql
+DATA_VERSION_TRIGGERS = [f"{table}_data_version_{event}" for table in ("room", "student")
+                         for event in ("insert", "update", "delete", "truncate")]
+
+# objects of install_schema looked up in the catalogs first, its DDL (ALTER TABLE, CREATE TRIGGER)
+# takes exclusive locks on the tables
+SCHEMA_CHECK_QUERY = """
+    SELECT EXISTS (SELECT FROM pg_attribute
+                   WHERE attrelid = to_regclass('public.student') AND attname = 'birth_ymd' AND NOT attisdropped)
+           AND to_regclass('public.idx_student_room_birth_ymd_sex') IS NOT NULL,
+           to_regclass('public.data_version') IS NOT NULL
+           AND (SELECT COUNT(*) FROM pg_trigger
+                WHERE tgrelid IN (to_regclass('public.room'), to_regclass('public.student')) AND tgname = ANY(%s)) = %s
+    """
+
+
+def schema_installed(database: Database) -> Tuple[bool, bool]:
+    """Check which parts of install_schema are in place.
+
+    :param database: Database connection
+    :type database: Database
+    :return: birth_ymd column with its index installed, data version table with its triggers installed
+    :rtype: Tuple[bool, bool]
+    """
+    database.cursor.execute(SCHEMA_CHECK_QUERY, (DATA_VERSION_TRIGGERS, len(DATA_VERSION_TRIGGERS)))
+    return database.cursor.fetchone()
+
+
+def install_schema(database: Database) -> bool:
+    """Add the generated column birth_ymd, the covering index used by the reports and the data version (without commit).
+
+    Parts already in place are skipped, so an installed database gets no DDL and no exclusive table locks.
+
+    :param database: Database connection
+    :type database: Database
+    :return: True if any DDL was executed
+    :rtype: bool
+    """
+    student_age, data_version = schema_installed(database)
+    if not student_age:
+        database.execute_file(STUDENT_AGE_SQL)
+        logging.info("-- Column student.birth_ymd and index idx_student_room_birth_ymd_sex installed")
+    if not data_version:
+        database.execute_file(DATA_VERSION_SQL)
+        logging.info("-- Table data_version and its triggers installed")
+    return not (student_age and data_version)
+
+
+class Report:
+    """Class for a report query declared once with parameters (top-N, as-of date, room filter)
+
+    Bounded reports (top-N, or any report given top_n) run as server-side prepared statements, planned
+    once per connection and executed many times. Reports of all rows are streamed from a named cursor
+    instead, because a cursor cannot be declared over EXECUTE.
+    """
+
+    def __init__(self, name: str, sql: str, top_n: Optional[int] = None) -> None:
+        """Initialize the Report object.
+
+        :param name: Report name, the result is saved as <name>_result.<format>
+        :type name: str
+        :param sql: Query with %(top_n)s, %(as_of)s and %(room_ids)s placeholders
+        :type sql: str
+        :param top_n: Default LIMIT of the report, None - all rows (LIMIT NULL)
+        :type top_n: Optional[int]
+        :rtype: None
+        """
+        self.name = name
+        self.sql = sql
+        self.top_n = top_n
+
+    @property
+    def statement(self) -> str:
+        """Name of the prepared statement.
+
+        :rtype: str
+        """
+        return f"report_{self.name}"
+
+    def bind(self, top_n: Optional[int] = None, as_of: Optional[date] = None,
+             room_ids: Optional[Sequence[int]] = None) -> Dict[str, Any]:
+        """Build report parameters, missing values are replaced by defaults.
+
+        :param top_n: Number of rows of the report, None - its default (all rows of an unbounded report)
+        :type top_n: Optional[int]
+        :param as_of: Date ages are computed at, today by default
+        :type as_of: Optional[date]
+        :param room_ids: Rooms included in the report, None - all rooms
+        :type room_ids: Optional[Sequence[int]]
+        :rtype: Dict[str, Any]
+        """
+        return {"top_n": self.top_n if top_n is None else top_n,
+                "as_of": as_of or date.today(),
+                "room_ids": list(room_ids) if room_ids is not None else None}
+
+    def render(self, database: Database, params: Dict[str, Any]) -> str:
+        """Query text with the parameters inlined (for EXPLAIN and cache keys).
+
+        :param database: Database connection
+        :type database: Database
+        :param params: Report parameters, see bind
+        :type params: Dict[str, Any]
+        :rtype: str
+        """
+        return database.cursor.mogrify(self.sql, params).decode()
+
+    def prepare(self, database: Database) -> None:
+        """PREPARE the report on the connection unless it was already prepared in this session.
+
+        :param database: Database connection
+        :type database: Database
+        :rtype: None
+        """
+        if self.statement in database.connection.prepared:
+            return
+        placeholders = {name: f"${number}" for number, name in enumerate(PARAMETERS, start=1)}
+        database.execute_query(f"PREPARE {self.statement} ({', '.join(PARAMETER_TYPES)}) AS "
+                               f"{self.sql.strip().rstrip(';') % placeholders}")
+        database.connection.prepared.add(self.statement)
+
+    def execute(self, database: Database, params: Dict[str, Any]) -> None:
+        """Execute the prepared report, rows are left in database.cursor.
+
+        :param database: Database connection
+        :type database: Database
+        :param params: Report parameters, see bind
+        :type params: Dict[str, Any]
+        :rtype: None
+        """
+        self.prepare(database)
+        database.cursor.execute(f"EXECUTE {self.statement} (%s, %s, %s)",
+                                tuple(params[name] for name in PARAMETERS))
+
+    def stream(self, database: Database, params: Dict[str, Any],
+               fetch_size: int = FETCH_SIZE) -> Tuple[List[str], Iterator[tuple]]:
+        """Run the report and return column names and a row iterator.
+
+        :param database: Database connection
+        :type database: Database
+        :param params: Report parameters, see bind
+        :type params: Dict[str, Any]
+        :param fetch_size: Number of rows fetched in one round trip
+        :type fetch_size: int
+        :return: Column names and iterator over the result rows
+        :rtype: Tuple[List[str], Iterator[tuple]]
+        """
+        if params["top_n"] is None:
+            return stream_query(database, self.sql, fetch_size, params)
+
+        self.execute(database, params)
+        cursor = database.cursor
+        column_names = [desc[0] for desc in cursor.description]
+        return column_names, chain.from_iterable(iter(lambda: cursor.fetchmany(fetch_size), []))
+
+
+def render_reports(database: Database, reports: Dict[str, Report], params: Dict[str, Any]) -> Dict[str, str]:
+    """Report names mapped to their query text with inlined parameters.
+
+    :param database: Database connection
+    :type database: Database
+    :param reports: Report registry
+    :type reports: Dict[str, Report]
+    :param params: Keyword arguments of Report.bind
+    :type params: Dict[str, Any]
+    :rtype: Dict[str, str]
+    """
+    return {name: report.render(database, report.bind(**params)) for name, report in reports.items()}
+
+
+# report registry, the result of each report is saved as <name>_result.<format>
+# top-N reports are ordered by room id on ties, so the same data always gives the same rows (the baseline
+# query3 left ties in any order: rooms 381 and 83 came out swapped and 978 instead of 213 at rank 5)
+# ages come from the integer column birth_ymd (see sql-student-age.sql) instead of age() for every student
+REPORTS = {
+    # Список комнат и количество студентов в каждой из них
+    "query1": Report("query1", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        COUNT(*) AS students_quantity
+
+        FROM public.room
+            INNER JOIN public.student
+            ON public.room.id = public.student.room
+        WHERE {ROOM_FILTER}
+        GROUP BY public.room.id
+        ORDER BY public.room.id
+        LIMIT %(top_n)s;
+        """),
+
+    # 5 комнат, где самый маленький средний возраст студентов
+    "query2": Report("query2", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        COUNT(*) AS students_quantity,
+        AVG(({AS_OF_YMD} - public.student.birth_ymd) / 10000) ::INTEGER AS average_age
+
+        FROM public.room
+            INNER JOIN public.student
+            ON public.room.id = public.student.room
+        WHERE {ROOM_FILTER}
+        GROUP BY public.room.id
+        ORDER BY average_age ASC, public.room.id
+        LIMIT %(top_n)s;
+        """, top_n=5),
+
+    # 5 комнат с самой большой разницей в возрасте студентов
+    "query3": Report("query3", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        COUNT(*) AS students_quantity,
+        ({AS_OF_YMD} - MIN(public.student.birth_ymd)) / 10000 -
+        ({AS_OF_YMD} - MAX(public.student.birth_ymd)) / 10000 AS stud_age_diff
+
+        FROM public.room
+            INNER JOIN public.student
+            ON public.room.id = public.student.room
+        WHERE {ROOM_FILTER}
+        GROUP BY public.room.id
+        ORDER BY stud_age_diff DESC, students_quantity ASC, public.room.id
+        LIMIT %(top_n)s;
+        """, top_n=5),
+
+    # Список комнат где живут разнополые студенты
+    "query4": Report("query4", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        STRING_AGG(public.student.sex, ', ' ORDER BY public.student.sex) AS genders_in_room
+
+        FROM public.room
+            INNER JOIN public.student
+            ON public.room.id = public.student.room
+        WHERE public.student.sex IN (UPPER('M'), UPPER('F')) AND {ROOM_FILTER}
+        GROUP BY public.room.id
+        HAVING COUNT(DISTINCT public.student.sex) = 2
+        ORDER BY public.room.id
+        LIMIT %(top_n)s;
+        """),
+}
+
+# the same reports read from the summary table room_stats (see sql-room-stats.sql), O(rooms) instead of O(students)
+# query2 takes the age of the average birthday, which may differ by a year from the average of integer ages
+ROOM_STATS_REPORTS = {
+    "query1": Report("stats_query1", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        public.room_stats.student_count AS students_quantity
+
+        FROM public.room
+            INNER JOIN public.room_stats
+            ON public.room.id = public.room_stats.room_id
+        WHERE public.room_stats.student_count > 0 AND {ROOM_FILTER}
+        ORDER BY public.room.id
+        LIMIT %(top_n)s;
+        """),
+
+    "query2": Report("stats_query2", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        public.room_stats.student_count AS students_quantity,
+        EXTRACT(YEAR FROM age(%(as_of)s::timestamp,
+                              to_timestamp(public.room_stats.birthday_sum / public.room_stats.birthday_count)
+                              AT TIME ZONE 'UTC')) ::INTEGER AS average_age
+
+        FROM public.room
+            INNER JOIN public.room_stats
+            ON public.room.id = public.room_stats.room_id
+        WHERE public.room_stats.birthday_count > 0 AND {ROOM_FILTER}
+        ORDER BY average_age ASC, public.room.id
+        LIMIT %(top_n)s;
+        """, top_n=5),
+
+    "query3": Report("stats_query3", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        public.room_stats.student_count AS students_quantity,
+        EXTRACT(YEAR FROM age(%(as_of)s::timestamp, public.room_stats.min_birthday)) ::INTEGER -
+        EXTRACT(YEAR FROM age(%(as_of)s::timestamp, public.room_stats.max_birthday)) ::INTEGER AS stud_age_diff
+
+        FROM public.room
+            INNER JOIN public.room_stats
+            ON public.room.id = public.room_stats.room_id
+        WHERE public.room_stats.student_count > 0 AND {ROOM_FILTER}
+        ORDER BY stud_age_diff DESC, students_quantity ASC, public.room.id
+        LIMIT %(top_n)s;
+        """, top_n=5),
+
+    "query4": Report("stats_query4", f"""
+        SELECT public.room.id AS room_id,
+        public.room."name" AS room_name,
+        ARRAY_TO_STRING(ARRAY_FILL('F'::TEXT, ARRAY[public.room_stats.female_count::INTEGER]) ||
+                        ARRAY_FILL('M'::TEXT, ARRAY[public.room_stats.male_count::INTEGER]), ', ') AS genders_in_room
+
+        FROM public.room
+            INNER JOIN public.room_stats
+            ON public.room.id = public.room_stats.room_id
+        WHERE public.room_stats.female_count > 0 AND public.room_stats.male_count > 0 AND {ROOM_FILTER}
+        ORDER BY public.room.id
+        LIMIT %(top_n)s;
+        """),
+}
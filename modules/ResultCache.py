@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from typing import Iterable
+
+from config.config import RESULT_CACHE_PATH, RESULT_CACHE_SIZE
+from modules.Database import Database
+from modules.Reports import DATA_VERSION_QUERY
+
+
+logger = logging.getLogger('result_cache')
+
+
+def data_fingerprint(database: Database, source_files: Iterable[str] = ()) -> str:
+    """Build a fingerprint of the data the reports are computed from (data version, see install_schema).
+
+    :param database: Database connection
+    :type database: Database
+    :param source_files: Source files loaded in this run, their size and mtime are part of the fingerprint
+        (a missing file loads nothing and is skipped)
+    :type source_files: Iterable[str]
+    :return: Fingerprint string
+    :rtype: str
+    """
+    database.execute_query(DATA_VERSION_QUERY)
+    parts = [database.cursor.fetchone()[0]]
+    for path in source_files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        parts.append(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+
+class ResultCache:
+    """Class for the on-disk cache of report files keyed by query text, format and data fingerprint
+
+    Entries are plain copies of the result files. The least recently used entries (by mtime,
+    refreshed on every hit) are evicted when there are more than max_entries of them.
+    """
+
+    def __init__(self, cache_path: str = RESULT_CACHE_PATH, max_entries: int = RESULT_CACHE_SIZE,
+                 refresh: bool = False) -> None:
+        """Initialize the ResultCache object.
+
+        :param cache_path: Folder for the cached files
+        :type cache_path: str
+        :param max_entries: Maximal number of cached files
+        :type max_entries: int
+        :param refresh: Ignore cached files (they are still rewritten with fresh results)
+        :type refresh: bool
+        :rtype: None
+        """
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # reports are exported from several threads
+        os.makedirs(cache_path, exist_ok=True)
+
+    @staticmethod
+    def key(query: str, file_format: str, fingerprint: str) -> str:
+        """Build the cache key.
+
+        :param query: SQL query of the report
+        :type query: str
+        :param file_format: Output format
+        :type file_format: str
+        :param fingerprint: Data fingerprint, see data_fingerprint
+        :type fingerprint: str
+        :rtype: str
+        """
+        return hashlib.sha256("\0".join((query, file_format, fingerprint)).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        """Path of the cached file for the key.
+
+        :param key: Cache key
+        :type key: str
+        :rtype: str
+        """
+        return os.path.join(self.cache_path, key)
+
+    def get(self, key: str, filename: str) -> bool:
+        """Copy the cached result into filename.
+
+        :param key: Cache key
+        :type key: str
+        :param filename: Name of the output file
+        :type filename: str
+        :return: True on cache hit
+        :rtype: bool
+        """
+        path = self._path(key)
+        if not self.refresh and os.path.exists(path):
+            try:
+                shutil.copyfile(path, filename)
+                os.utime(path)  # marking the entry as recently used
+                with self._lock:
+                    self.hits += 1
+                return True
+            except FileNotFoundError:
+                pass  # evicted by another thread in the meantime
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def put(self, key: str, filename: str) -> None:
+        """Store a copy of the result file and evict the least recently used entries.
+
+        :param key: Cache key
+        :type key: str
+        :param filename: Name of the result file
+        :type filename: str
+        :rtype: None
+        """
+        path = self._path(key)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(filename, temporary)
+        os.replace(temporary, path)  # readers never see a half written entry
+
+        with self._lock:
+            entries = [entry for entry in os.scandir(self.cache_path) if not entry.name.endswith(".tmp")]
+            entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in entries[self.max_entries:]:
+                os.remove(entry.path)
+
+    def stats(self) -> dict:
+        """Return hit / miss statistics.
+
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0}
+
+    def log_stats(self) -> None:
+        """Log hit / miss statistics.
+
+        :rtype: None
+        """
+        stats = self.stats()
+        logging.info(f"-- Result cache: {stats['hits']} hits, {stats['misses']} misses "
+                     f"(hit ratio {stats['hit_ratio']:.0%})")
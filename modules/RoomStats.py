@@ -0,0 +1,105 @@
+import logging
+import os
+
+from modules.Database import Database
+
+
+logger = logging.getLogger('room_stats')
+
+# DDL of the summary table, its functions and triggers
+ROOM_STATS_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql-room-stats.sql")
+
+# triggers created by sql-room-stats.sql, the DDL is skipped when the table and all of them exist
+TRIGGERS = [f"student_room_stats_{event}" for event in ("insert", "delete", "update", "truncate")]
+INSTALLED_QUERY = """
+    SELECT to_regclass('public.room_stats') IS NOT NULL
+           AND (SELECT COUNT(*) FROM pg_trigger WHERE tgrelid = to_regclass('public.student') AND tgname = ANY(%s)) = %s
+    """
+
+# room_stats as it would be computed from scratch, used for the consistency check
+RECOMPUTED_QUERY = """
+    SELECT room, COUNT(*), COALESCE(SUM(EXTRACT(EPOCH FROM birthday)::NUMERIC), 0), COUNT(birthday),
+           MIN(birthday), MAX(birthday),
+           COUNT(*) FILTER (WHERE sex = 'F'), COUNT(*) FILTER (WHERE sex = 'M')
+    FROM student
+    GROUP BY room
+    """
+
+STORED_QUERY = """
+    SELECT room_id, student_count, birthday_sum, birthday_count, min_birthday, max_birthday,
+           female_count, male_count
+    FROM room_stats
+    """
+
+
+class RoomStats:
+    """Class for the per-room summary table room_stats maintained by triggers on the table student"""
+
+    # setting which makes the triggers skip maintenance until the end of the transaction (the caller must rebuild)
+    DEFER_QUERY = "SET LOCAL room_stats.deferred = 'on'"
+
+    @staticmethod
+    def installed(database: Database) -> bool:
+        """Check that the table room_stats and its triggers exist.
+
+        :param database: Database connection
+        :type database: Database
+        :rtype: bool
+        """
+        database.cursor.execute(INSTALLED_QUERY, (TRIGGERS, len(TRIGGERS)))
+        return database.cursor.fetchone()[0]
+
+    @staticmethod
+    def install(database: Database) -> None:
+        """Create the table room_stats with its triggers and fill it if it did not exist (without commit).
+
+        Nothing is executed when the table and its triggers are already in place.
+
+        :param database: Database connection
+        :type database: Database
+        :rtype: None
+        """
+        if RoomStats.installed(database):
+            return
+        database.execute_query("SELECT to_regclass('public.room_stats') IS NULL")
+        created = database.cursor.fetchone()[0]
+
+        database.execute_file(ROOM_STATS_SQL)
+        logging.info("-- Table room_stats and its triggers installed")
+
+        if created:
+            RoomStats.rebuild(database)
+
+    @staticmethod
+    def rebuild(database: Database) -> None:
+        """Recompute room_stats for every room from the table student (without commit).
+
+        :param database: Database connection
+        :type database: Database
+        :rtype: None
+        """
+        database.execute_query("SELECT room_stats_refresh(NULL)")
+        logging.info("-- Table room_stats rebuilt")
+
+    @staticmethod
+    def check(database: Database) -> int:
+        """Compare room_stats with a full recompute from the table student.
+
+        :param database: Database connection
+        :type database: Database
+        :return: Number of rooms whose stored statistics differ from the recomputed ones
+        :rtype: int
+        """
+        database.execute_query(f"""
+            SELECT COUNT(*) FROM (
+                ({RECOMPUTED_QUERY} EXCEPT {STORED_QUERY})
+                UNION ALL
+                ({STORED_QUERY} EXCEPT {RECOMPUTED_QUERY})
+            ) AS mismatches
+            """)
+        mismatches = database.cursor.fetchone()[0]
+        if mismatches:
+            logging.error(f"-- room_stats is inconsistent: {mismatches} mismatched rows")
+        else:
+            logging.info("-- room_stats is consistent with the table student")
+        return mismatches
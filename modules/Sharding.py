@@ -0,0 +1,314 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by --shards
+    np = None
+
+from psycopg2 import Error
+
+from modules.Database import SCHEMA_SQL, Database, admin_execute
+from modules.LocalEngine import RoomAggregates, export_reports
+from modules.Metrics import metrics
+from modules.ParallelLoader import ABORT, COMMIT, _collect, _load_worker, _put
+from modules.Reports import AS_OF_YMD, REPORTS, ROOM_FILTER, install_schema
+
+
+logger = logging.getLogger('sharding')
+
+# per-room partial aggregates of one shard, merged by RoomAggregates.merge (sums added, min / max compared)
+PARTIAL_QUERY = f"""
+    SELECT public.room.id AS room_id,
+    public.room."name" AS room_name,
+    COUNT(*) AS students_quantity,
+    SUM(({AS_OF_YMD} - public.student.birth_ymd) / 10000) AS age_sum,
+    MIN(public.student.birth_ymd) AS min_birth_ymd,
+    MAX(public.student.birth_ymd) AS max_birth_ymd,
+    COUNT(*) FILTER (WHERE public.student.sex = 'F') AS female_quantity
+
+    FROM public.room
+        INNER JOIN public.student
+        ON public.room.id = public.student.room
+    WHERE {ROOM_FILTER}
+    GROUP BY public.room.id;
+    """
+
+
+def shard_configs(config: dict, shards: int) -> List[dict]:
+    """Connection configuration of every shard.
+
+    Shard databases are listed in DB_SHARDS of .env (comma separated names on the same server),
+    by default they are named <DB_DATABASE>_shard<number>.
+
+    :param config: Configuration for the database connection
+    :type config: dict
+    :param shards: Number of shards
+    :type shards: int
+    :rtype: List[dict]
+    """
+    names = [name.strip() for name in (config.get("DB_SHARDS") or "").split(",") if name.strip()]
+    if not names:
+        names = [f"{config['DB_DATABASE']}_shard{number}" for number in range(shards)]
+    elif len(names) < shards:
+        raise ValueError(f"DB_SHARDS lists {len(names)} databases, {shards} shards requested")
+    return [dict(config, DB_DATABASE=name) for name in names[:shards]]
+
+
+def shard_of(room_id: int, shards: int) -> int:
+    """Shard of a room, a room and all its students always live on the same shard.
+
+    :param room_id: Room id
+    :type room_id: int
+    :param shards: Number of shards
+    :type shards: int
+    :rtype: int
+    """
+    return room_id % shards
+
+
+class ShardedDatabase:
+    """Class for spreading rooms and students over several databases by room id
+
+    Every shard is loaded by its own process and queried on its own thread; the per-room partial
+    aggregates of the shards are merged and the reports are finished in Python, with the same
+    values and ordering as the single database reports.
+    """
+
+    def __init__(self, config: dict, shards: int, method: str = "copy") -> None:
+        """Initialize the ShardedDatabase object.
+
+        :param config: Configuration for the database connection (DB_DATABASE is replaced per shard)
+        :type config: dict
+        :param shards: Number of shards
+        :type shards: int
+        :param method: Bulk load method, "copy" or "insert"
+        :type method: str
+        :rtype: None
+        """
+        if np is None:
+            raise ImportError("numpy is required for the sharded mode (pip install numpy)")
+        self.configs = shard_configs(config, shards)
+        self.method = method
+
+    def install(self) -> None:
+        """Create missing shard databases, their tables and the birth_ymd column.
+
+        :rtype: None
+        """
+        for config in self.configs:
+            name = config["DB_DATABASE"]
+            if not admin_execute(config, f"SELECT 1 FROM pg_database WHERE datname = '{name}'"):
+                admin_execute(config, f'CREATE DATABASE "{name}"')
+                logging.info(f"-- Shard database {name} created")
+            database = Database(config, 1, 1)
+            database.connect(raise_error=True)
+            try:
+                database.execute_query(SCHEMA_SQL)
+                install_schema(database)
+                database.commit()
+            finally:
+                database.close()
+
+    def load(self, tables: List[Tuple[str, Sequence[str], Iterable[dict], str]], batch_size: int) -> Dict[str, int]:
+        """Replace the content of the shards with the records, one loader process per shard.
+
+        Every shard process stages all tables in one transaction, committed only if the whole input was
+        routed; afterwards every shard is truncated and filled from its staging tables in one transaction
+        per shard. A failed load (bad record, dead process, DB error) leaves every shard unchanged. The
+        final commits are not atomic across the shards (no two-phase commit), only a failure of a
+        COMMIT itself can leave some shards with the new and some with the old content.
+
+        :param tables: (table, columns, records, room id key of the record) for every table, parents first
+        :type tables: List[Tuple[str, Sequence[str], Iterable[dict], str]]
+        :param batch_size: Number of records sent to a shard in one statement
+        :type batch_size: int
+        :return: Number of loaded rows per table
+        :rtype: Dict[str, int]
+        :raises Error: If any shard failed (no shard is changed)
+        """
+        shards = len(self.configs)
+        stages = {table: f"parallel_stage_{table}" for table, _, _, _ in tables}
+        # the staging tables are created in the transaction of the worker, a failed worker leaves none behind
+        init_query = "; ".join(f"DROP TABLE IF EXISTS {stage}; "
+                               f"CREATE UNLOGGED TABLE {stage} (LIKE public.{table} INCLUDING CONSTRAINTS)"
+                               for table, stage in stages.items())
+        tasks = [multiprocessing.Queue(maxsize=2) for _ in self.configs]
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_load_worker, name=config["DB_DATABASE"],
+                                             args=(config, {stages[table]: columns for table, columns, _, _ in tables},
+                                                   self.method, init_query, queue, results))
+                     for config, queue in zip(self.configs, tasks)]
+        for process in processes:
+            process.start()
+
+        started = time.perf_counter()
+        marker = ABORT
+        try:
+            for table, _, records, key in tables:
+                table_started = time.perf_counter()
+                rows = 0
+                batches: List[List[dict]] = [[] for _ in range(shards)]
+                for record in records:
+                    shard = shard_of(record[key], shards)
+                    batches[shard].append(record)
+                    rows += 1
+                    if len(batches[shard]) >= batch_size:
+                        self._send(tasks[shard], (stages[table], batches[shard]), processes[shard])
+                        batches[shard] = []
+                for shard, batch in enumerate(batches):
+                    if batch:
+                        self._send(tasks[shard], (stages[table], batch), processes[shard])
+                phase = metrics.record("load", time.perf_counter() - table_started, rows, table=table,
+                                       method=self.method, shards=shards)
+                logging.info(f"-- {rows} rows of {table} sent to {shards} shards in {phase.seconds:.2f}s "
+                             f"({phase.rows_per_second:.0f} rows/sec)")
+            marker = COMMIT
+        finally:
+            for queue, process in zip(tasks, processes):
+                _put(queue, marker, [process])
+            stats = _collect(results, processes)
+
+        errors = []
+        for name, rows, busy, error in stats:
+            logging.info(f"-- {name}: {sum(rows.values())} rows staged in {busy:.2f}s")
+            if error is not None:
+                errors.append(f"{name}: {error}")
+        if errors:
+            self._drop_stages(stages)
+            raise Error(f"sharded load failed: {'; '.join(errors)}")
+
+        loaded = self._replace(tables, stages)
+        logging.info(f"-- {sum(loaded.values())} rows loaded on {shards} shards in "
+                     f"{time.perf_counter() - started:.2f}s")
+        return loaded
+
+    @staticmethod
+    def _send(queue: multiprocessing.Queue, task: tuple, process: multiprocessing.Process) -> None:
+        """Hand a batch to the loader process of a shard.
+
+        :param queue: Task queue of the shard
+        :type queue: multiprocessing.Queue
+        :param task: (staging table, batch of records)
+        :type task: tuple
+        :param process: Loader process of the shard
+        :type process: multiprocessing.Process
+        :rtype: None
+        :raises Error: If the loader process exited
+        """
+        if not process.is_alive() or not _put(queue, task, [process]):
+            raise Error(f"the loader process of {process.name} exited before the end of the load")
+
+    def _replace(self, tables: List[Tuple[str, Sequence[str], Iterable[dict], str]],
+                 stages: Dict[str, str]) -> Dict[str, int]:
+        """Truncate every shard and move the staged rows into its tables, then commit all shards.
+
+        :param tables: (table, columns, records, room id key of the record) for every table, parents first
+        :type tables: List[Tuple[str, Sequence[str], Iterable[dict], str]]
+        :param stages: Staging table of every table
+        :type stages: Dict[str, str]
+        :return: Number of loaded rows per table
+        :rtype: Dict[str, int]
+        :raises Error: If a shard failed before the commits (every shard is rolled back)
+        """
+        loaded = {table: 0 for table, _, _, _ in tables}
+        databases = []
+        try:
+            for config in self.configs:
+                database = Database(config, 1, 1)
+                databases.append(database)
+                database.connect(raise_error=True)
+                database.execute_query("TRUNCATE public.student, public.room")
+                for table, columns, _, _ in tables:
+                    column_list = ", ".join(f'"{column}"' for column in columns)
+                    database.execute_query(f"INSERT INTO public.{table} ({column_list}) "
+                                           f"SELECT {column_list} FROM {stages[table]}")
+                    loaded[table] += database.cursor.rowcount
+                database.execute_query("; ".join(f"DROP TABLE {stage}" for stage in stages.values()))
+            for database in databases:
+                database.commit()
+        except Error:
+            for database in databases:
+                if database.connection is not None and not database.connection.closed:
+                    database.rollback()
+            self._drop_stages(stages)
+            raise
+        finally:
+            for database in databases:
+                database.close()
+        return loaded
+
+    def _drop_stages(self, stages: Dict[str, str]) -> None:
+        """Drop the staging tables left on the shards by a failed load.
+
+        :param stages: Staging table of every table
+        :type stages: Dict[str, str]
+        :rtype: None
+        """
+        for config in self.configs:
+            database = Database(config, 1, 1)
+            if not database.connect():
+                continue  # an unreachable shard keeps its staging tables until the next load
+            try:
+                database.execute_query("; ".join(f"DROP TABLE IF EXISTS {stage}" for stage in stages.values()))
+                database.commit()
+            finally:
+                database.close()
+
+    @staticmethod
+    def _partial(config: dict, params: Dict[str, Any]) -> RoomAggregates:
+        """Per-room partial aggregates of one shard.
+
+        :param config: Configuration of the shard connection
+        :type config: dict
+        :param params: Report parameters (as_of, room_ids)
+        :type params: Dict[str, Any]
+        :rtype: RoomAggregates
+        """
+        with metrics.phase("shard_query", shard=config["DB_DATABASE"]) as phase:
+            database = Database(config, 1, 1)
+            database.connect(raise_error=True)
+            try:
+                database.cursor.execute(PARTIAL_QUERY, params)
+                rows = database.cursor.fetchall()
+                database.rollback()  # read only, closing the transaction
+            finally:
+                database.close()
+            phase.rows = len(rows)
+
+        columns = list(zip(*rows)) or [()] * 7
+        room_ids, room_names = columns[0], columns[1]
+        return RoomAggregates(*(np.array(column, dtype=np.int64) for column in (room_ids, *columns[2:])),
+                              dict(zip(room_ids, room_names)))
+
+    def aggregates(self, params: Dict[str, Any]) -> RoomAggregates:
+        """Query all shards concurrently and merge their partial aggregates.
+
+        :param params: Report parameters (as_of, room_ids)
+        :type params: Dict[str, Any]
+        :rtype: RoomAggregates
+        """
+        with ThreadPoolExecutor(max_workers=len(self.configs), thread_name_prefix="shard") as executor:
+            parts = list(executor.map(lambda config: self._partial(config, params), self.configs))
+        return RoomAggregates.merge(parts)
+
+    def run_reports(self, output_path: str, file_format: str, params: Dict[str, Any]) -> Dict[str, bool]:
+        """Compute every report of REPORTS from the merged shard aggregates and save the result files.
+
+        :param output_path: Folder of the result files
+        :type output_path: str
+        :param file_format: Output format, see export_rows ("json", "xml", "ndjson", "csv", "csv.gz", ...)
+        :type file_format: str
+        :param params: Keyword arguments of Report.bind (top_n, as_of, room_ids)
+        :type params: Dict[str, Any]
+        :return: Report names mapped to True if the file was saved
+        :rtype: Dict[str, bool]
+        """
+        bound = REPORTS["query1"].bind(**params)
+        with metrics.phase("aggregate", engine="sharded") as phase:
+            aggregates = self.aggregates({"as_of": bound["as_of"], "room_ids": bound["room_ids"]})
+            phase.rows = len(aggregates.rooms)
+        return export_reports(aggregates, output_path, file_format, params, "sharded")
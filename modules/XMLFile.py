@@ -1,14 +1,115 @@
 import logging
-import xml.etree.ElementTree as ET
+import os
+from typing import Any, Iterable, Sequence, TextIO
 from psycopg2 import Error
 
+from modules.Metrics import counted, metrics
+from modules.OutputFile import open_output
+
 
 logger = logging.getLogger('XMLFile')
 
 
+def _escape(text: str) -> str:
+    """Escape text of an XML element the same way as ElementTree does.
+
+    :param text: Text of the element
+    :type text: str
+    :rtype: str
+    """
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def _element(tag: str, value: Any) -> str:
+    """Serialize one element with text str(value), empty text gives a short element like ElementTree.
+
+    :param tag: Element name
+    :type tag: str
+    :param value: Element value
+    :type value: Any
+    :rtype: str
+    """
+    text = str(value)
+    if not text:
+        return f"<{tag} />"
+    return f"<{tag}>{_escape(text)}</{tag}>"
+
+
 class XMLFile:
     """ Class for saving query results from DB to XML file """
 
+    @staticmethod
+    def write_rows(f: TextIO, column_names: Sequence[str], rows: Iterable[Sequence[Any]]) -> None:
+        """Write the <data><columns/><rows/></data> document into an opened file row by row.
+
+        Output is byte-identical to the ElementTree document built by the previous implementation,
+        but only one row is kept in memory at a time.
+
+        :param f: Opened text file (us-ascii with xmlcharrefreplace errors, like ElementTree.write)
+        :type f: TextIO
+        :param column_names: Names of the columns (used as element names in rows)
+        :type column_names: Sequence[str]
+        :param rows: Rows of the result, values in the order of column_names
+        :type rows: Iterable[Sequence[Any]]
+        :rtype: None
+        """
+        f.write("<data>")
+
+        # writing columns element
+        if column_names:
+            f.write("<columns>" + "".join(_element("column", column) for column in column_names) + "</columns>")
+        else:
+            f.write("<columns />")
+
+        # writing rows element, opening tag is written only when the first row arrives
+        has_rows = False
+        for row in rows:
+            if not has_rows:
+                f.write("<rows>")
+                has_rows = True
+            elements = "".join(_element(column, value) for column, value in zip(column_names, row))
+            f.write(f"<row>{elements}</row>" if elements else "<row />")
+        f.write("</rows>" if has_rows else "<rows />")
+
+        f.write("</data>")
+
+    @staticmethod
+    def save_rows(column_names: Sequence[str], rows: Iterable[Sequence[Any]], filename: str,
+                  buffer_size: int = -1, compression: str = "") -> bool:
+        """Save rows to XML file (filename) while they are being produced.
+
+        :param column_names: Names of the columns
+        :type column_names: Sequence[str]
+        :param rows: Rows of the result, any iterable (e.g. a server-side cursor)
+        :type rows: Iterable[Sequence[Any]]
+        :param filename: Name of the output XML file
+        :type filename: str
+        :param buffer_size: Size of the output buffer in bytes (-1 - default buffering)
+        :type buffer_size: int
+        :param compression: Compression extension: "" (plain text), "gz" or "zst"
+        :type compression: str
+        :return: True if the file was saved
+        :rtype: bool
+        """
+        try:
+            with metrics.phase("export", file=os.path.basename(filename)) as phase:
+                with open_output(filename, compression, encoding="us-ascii", errors="xmlcharrefreplace",
+                                 buffer_size=buffer_size) as f:
+                    XMLFile.write_rows(f, column_names, counted(rows, phase))
+                phase.bytes = os.path.getsize(filename)
+
+            logging.info(f"Query result saved into {filename}")
+            return True
+        except (Error, ImportError) as e:
+            logging.error(f"-- Error while creating XML file: {e}")
+            return False
+
     @staticmethod
     def save_file(data: dict, filename: str) -> None:
         """Save incoming data to file (filename).
@@ -19,37 +120,4 @@ class XMLFile:
         :type filename: str
         :rtype: None
         """
-        try:
-            # creating root XML element
-            root = ET.Element("data")
-
-            # creating elements for columns
-            columns_element = ET.SubElement(root, "columns")
-            # creating elements for each column in column_names
-            for column in data["columns"]:
-                # creating column element inside columns element
-                column_element = ET.SubElement(columns_element, "column")
-                # setting column element text = column name
-                column_element.text = column
-
-            # creating elements for rows
-            rows_element = ET.SubElement(root, "rows")
-            # creating element for each row in rows list
-            for row in data["rows"]:
-                # creating element row in element rows
-                row_element = ET.SubElement(rows_element, "row")
-                # for each pare column-value in current row
-                for column, value in row.items():
-                    # creating element with the name = column
-                    column_element = ET.SubElement(row_element, column)
-                    # setting element text = current
-                    column_element.text = str(value)
-
-            # creating object ElementTree with root element
-            tree = ET.ElementTree(root)
-            # writing tree data to file
-            tree.write(filename)
-
-            logging.info(f"Query result saved into {filename}")
-        except Error as e:
-            logging.error(f"-- Error while creating XML file: {e}")
\ No newline at end of file
+        XMLFile.save_rows(data["columns"], (row.values() for row in data["rows"]), filename)
@@ -0,0 +1,65 @@
+-- 'change marker of the report data: every statement changing rows of room or student bumps the version,'
+-- 'so cached reports are dropped exactly when committed data changed (statistics counters are flushed lazily,'
+-- 'reset by pg_stat_reset() and stay at zero without track_counts)'
+
+CREATE TABLE IF NOT EXISTS data_version (
+				  id BOOLEAN NOT NULL PRIMARY KEY DEFAULT TRUE CHECK (id),	-- 'a single row'
+				  created TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),		-- 'a recreated database does not repeat old versions'
+				  version BIGINT NOT NULL DEFAULT 0
+				  );
+
+INSERT INTO data_version DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+-- 'statement level: one bump per COPY / INSERT ... SELECT / TRUNCATE, not per row, and none for a statement'
+-- 'which changed no row (an upsert of unchanged records fires the INSERT and the UPDATE triggers with empty sets)'
+
+CREATE OR REPLACE FUNCTION data_version_bump() RETURNS TRIGGER AS $$
+BEGIN
+	IF current_setting('data_version.deferred', true) = 'on' THEN		-- 'parallel loaders bump it once after the commit'
+		RETURN NULL;
+	END IF;
+	IF TG_OP <> 'TRUNCATE' THEN									-- 'TRUNCATE has no transition table'
+		IF NOT EXISTS (SELECT FROM changed_rows) THEN
+			RETURN NULL;
+		END IF;
+	END IF;
+	UPDATE data_version SET version = version + 1;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 'a trigger with a transition table handles a single event, so there is one trigger per event'
+
+DROP TRIGGER IF EXISTS room_data_version ON room;
+DROP TRIGGER IF EXISTS room_data_version_insert ON room;
+CREATE TRIGGER room_data_version_insert AFTER INSERT ON room
+	REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS room_data_version_update ON room;
+CREATE TRIGGER room_data_version_update AFTER UPDATE ON room
+	REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS room_data_version_delete ON room;
+CREATE TRIGGER room_data_version_delete AFTER DELETE ON room
+	REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS room_data_version_truncate ON room;
+CREATE TRIGGER room_data_version_truncate AFTER TRUNCATE ON room
+	FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS student_data_version ON student;
+DROP TRIGGER IF EXISTS student_data_version_insert ON student;
+CREATE TRIGGER student_data_version_insert AFTER INSERT ON student
+	REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS student_data_version_update ON student;
+CREATE TRIGGER student_data_version_update AFTER UPDATE ON student
+	REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS student_data_version_delete ON student;
+CREATE TRIGGER student_data_version_delete AFTER DELETE ON student
+	REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
+
+DROP TRIGGER IF EXISTS student_data_version_truncate ON student;
+CREATE TRIGGER student_data_version_truncate AFTER TRUNCATE ON student
+	FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump();
@@ -0,0 +1,101 @@
+-- 'per-room summary of the table student, kept up to date by triggers, so reports read O(rooms) rows'
+
+CREATE TABLE IF NOT EXISTS room_stats (
+				  room_id INTEGER NOT NULL PRIMARY KEY REFERENCES room(id) ON DELETE CASCADE,
+				  student_count BIGINT NOT NULL,
+				  birthday_sum NUMERIC NOT NULL,					-- 'sum of birthdays as epoch seconds, AVG = birthday_sum / birthday_count'
+				  birthday_count BIGINT NOT NULL,
+				  min_birthday TIMESTAMP,
+				  max_birthday TIMESTAMP,
+				  female_count BIGINT NOT NULL,
+				  male_count BIGINT NOT NULL
+				  );
+
+-- 'full recompute of the given rooms (all rooms if NULL) from the table student'
+
+CREATE OR REPLACE FUNCTION room_stats_refresh(room_ids INTEGER[]) RETURNS VOID AS $$
+BEGIN
+	DELETE FROM room_stats WHERE room_ids IS NULL OR room_id = ANY(room_ids);
+	INSERT INTO room_stats
+	SELECT room, COUNT(*), COALESCE(SUM(EXTRACT(EPOCH FROM birthday)::NUMERIC), 0), COUNT(birthday),
+		   MIN(birthday), MAX(birthday),
+		   COUNT(*) FILTER (WHERE sex = 'F'), COUNT(*) FILTER (WHERE sex = 'M')
+	FROM student
+	WHERE room_ids IS NULL OR room = ANY(room_ids)
+	GROUP BY room
+	ORDER BY room;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 'inserted rows are added as deltas (LEAST / GREATEST keep min and max exact)'
+
+CREATE OR REPLACE FUNCTION room_stats_on_insert() RETURNS TRIGGER AS $$
+BEGIN
+	IF current_setting('room_stats.deferred', true) = 'on' THEN		-- 'bulk loaders rebuild the table once at the end'
+		RETURN NULL;
+	END IF;
+	INSERT INTO room_stats AS rs
+	SELECT room, COUNT(*), COALESCE(SUM(EXTRACT(EPOCH FROM birthday)::NUMERIC), 0), COUNT(birthday),
+		   MIN(birthday), MAX(birthday),
+		   COUNT(*) FILTER (WHERE sex = 'F'), COUNT(*) FILTER (WHERE sex = 'M')
+	FROM new_rows
+	GROUP BY room
+	ORDER BY room													-- 'same lock order for concurrent loaders'
+	ON CONFLICT (room_id) DO UPDATE SET
+		student_count = rs.student_count + EXCLUDED.student_count,
+		birthday_sum = rs.birthday_sum + EXCLUDED.birthday_sum,
+		birthday_count = rs.birthday_count + EXCLUDED.birthday_count,
+		min_birthday = LEAST(rs.min_birthday, EXCLUDED.min_birthday),
+		max_birthday = GREATEST(rs.max_birthday, EXCLUDED.max_birthday),
+		female_count = rs.female_count + EXCLUDED.female_count,
+		male_count = rs.male_count + EXCLUDED.male_count;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 'deleted or updated rows may remove the current min / max, so only the touched rooms are recomputed'
+
+CREATE OR REPLACE FUNCTION room_stats_on_delete() RETURNS TRIGGER AS $$
+BEGIN
+	IF current_setting('room_stats.deferred', true) = 'on' THEN
+		RETURN NULL;
+	END IF;
+	PERFORM room_stats_refresh(ARRAY(SELECT DISTINCT room FROM old_rows));
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION room_stats_on_update() RETURNS TRIGGER AS $$
+BEGIN
+	IF current_setting('room_stats.deferred', true) = 'on' THEN
+		RETURN NULL;
+	END IF;
+	PERFORM room_stats_refresh(ARRAY(SELECT room FROM old_rows UNION SELECT room FROM new_rows));
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION room_stats_on_truncate() RETURNS TRIGGER AS $$
+BEGIN
+	DELETE FROM room_stats;		-- 'not TRUNCATE: TRUNCATE room, student CASCADE already holds room_stats'
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 'statement level triggers with transition tables: one aggregate per COPY / INSERT batch, not per row'
+
+DROP TRIGGER IF EXISTS student_room_stats_insert ON student;
+CREATE TRIGGER student_room_stats_insert AFTER INSERT ON student
+	REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION room_stats_on_insert();
+
+DROP TRIGGER IF EXISTS student_room_stats_delete ON student;
+CREATE TRIGGER student_room_stats_delete AFTER DELETE ON student
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION room_stats_on_delete();
+
+DROP TRIGGER IF EXISTS student_room_stats_update ON student;
+CREATE TRIGGER student_room_stats_update AFTER UPDATE ON student
+	REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION room_stats_on_update();
+
+DROP TRIGGER IF EXISTS student_room_stats_truncate ON student;
+CREATE TRIGGER student_room_stats_truncate AFTER TRUNCATE ON student
+	FOR EACH STATEMENT EXECUTE FUNCTION room_stats_on_truncate();
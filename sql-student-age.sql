@@ -0,0 +1,12 @@
+-- 'birth date as YYYYMMDD integer, age in full years at date D = (YYYYMMDD of D - birth_ymd) / 10000'
+-- 'plain integer math instead of age() per row, and the column can be stored in an index'
+
+ALTER TABLE student ADD COLUMN IF NOT EXISTS birth_ymd INTEGER GENERATED ALWAYS AS (
+					  (EXTRACT(YEAR FROM birthday) * 10000 + EXTRACT(MONTH FROM birthday) * 100 + EXTRACT(DAY FROM birthday))::INTEGER
+					  ) STORED;
+
+-- 'covering index: the reports read only (room, birth_ymd, sex), so the planner can answer them with an index-only scan'
+-- 'merge-joined to room; it chooses it on large tables (1M students in benchmarks/age_plans.py), on small ones'
+-- '(100k students) a sequential scan with a hash join stays cheaper and only the integer age math helps'
+
+CREATE INDEX IF NOT EXISTS idx_student_room_birth_ymd_sex ON public.student(room, birth_ymd, sex);
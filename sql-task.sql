@@ -13,6 +13,8 @@ CREATE TABLE IF NOT EXISTS student (									-- 'creating table student
 					  sex CHAR NOT NULL CHECK (sex IN ('F', 'M'))		-- ' Constraint CHECK that values must be F or M'
 					  );
 					 
+-- 'column birth_ymd and the covering index for the age reports: sql-student-age.sql'
+
 SELECT * FROM public.room r ;
 SELECT * FROM public.student s ;
 
@@ -21,6 +23,8 @@ TRUNCATE room RESTART IDENTITY CASCADE;                 -- 'USE IN CASE IF YOU W
 TRUNCATE student RESTART IDENTITY CASCADE;  
 */
 
+-- 'the queries below are declared with parameters (top-N, as-of date, room filter) in modules/Reports.py'
+
 -- Список комнат и количество студентов в каждой из них
 
 SELECT public.room.id AS room_id, 						-- 'selecting rows'
@@ -37,7 +41,7 @@ ORDER BY public.room.id; 								-- 'ordering rooms DEFAULT ASCENDING'
 SELECT public.room.id AS room_id, 												-- 'selecting rows'
 	   public.room."name" AS room_name, 										
 	   COUNT(public.student.id) AS students_quantity,							-- 'count students BY ID'
-	   AVG(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER AS average_age  -- 'extracting year from now and student birthday after Average it and set to Integer for better view'
+	   AVG((TO_CHAR(now(), 'YYYYMMDD')::INTEGER - public.student.birth_ymd) / 10000) ::INTEGER AS average_age  -- 'full years from YYYYMMDD integers (sql-student-age.sql), Average it and set to Integer'
 FROM public.room
 	INNER JOIN public.student		-- 'join table student BY room id'
 	ON public.room.id = public.student.room 
@@ -50,8 +54,8 @@ LIMIT 5;                    -- 'will show ONLY 5 rows'
 SELECT public.room.id AS room_id, 				-- 'selecting columns'
 	   public.room."name" AS room_name, 
 	   COUNT(public.student.id) AS students_quantity,
-	   MAX(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER -     -- 'find maximum student age and SUBSTRACT IT'
-	   MIN(EXTRACT(YEAR FROM age(now(), public.student.birthday))) ::INTEGER AS stud_age_diff  -- 'FROM minimum student age'
+	   (TO_CHAR(now(), 'YYYYMMDD')::INTEGER - MIN(public.student.birth_ymd)) / 10000 -     -- 'maximum student age (the earliest birth date) and SUBSTRACT IT'
+	   (TO_CHAR(now(), 'YYYYMMDD')::INTEGER - MAX(public.student.birth_ymd)) / 10000 AS stud_age_diff  -- 'FROM minimum student age'
 FROM public.room
 	INNER JOIN public.student         -- 'join table student by condition room.id'
 	ON public.room.id = public.student.room 
@@ -73,6 +77,7 @@ HAVING COUNT(DISTINCT public.student.sex) = 2   -- 'here we check contition if t
 ORDER BY public.room.id;  
 
 -- 'to speed up queries we can add indexes on columns which more used'
+-- 'plan-backed recommendations: python main.py ... --advise-indexes writes results/recommended_indexes.sql'
 
 CREATE INDEX IF NOT EXISTS idx_room_name ON public.room("name");  -- 'creating index on room name in the table room'
 
@@ -84,3 +89,4 @@ CREATE INDEX IF NOT EXISTS idx_student_room ON public.student(room); -- 'creatin
 
 
 
+-- 'per-room summary table room_stats with its triggers lives in sql-room-stats.sql (python main.py ... --room-stats)'